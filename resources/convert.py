@@ -17,6 +17,7 @@ import shutil
 import subprocess
 from html import unescape
 
+from PIL import ExifTags, Image, ImageOps
 import pymysql.cursors
 
 
@@ -265,6 +266,11 @@ class DB:
 
 
 def needs_reorientation(path):
+    try:
+        with Image.open(path) as img:
+            return img.getexif().get(ExifTags.Base.Orientation, 1) != 1
+    except Exception:
+        pass
     try:
         out = subprocess.check_output(['identify', '-quiet', '-format', '%[orientation]', str(path)], stderr=subprocess.DEVNULL)
         return not any(x in out for x in [b'Undefined', b'Unrecognized', b'TopLeft'])
@@ -272,6 +278,39 @@ def needs_reorientation(path):
         return False
 
 
+def save_image(img, dest_path, **kwargs):
+    fmt = Image.registered_extensions()[Path(dest_path).suffix.lower()]
+    if fmt == 'JPEG' and img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    img.save(dest_path, format=fmt, **kwargs)
+
+
+def auto_orient(src_path, dest_path):
+    """Copy an image, rotated to match its EXIF orientation.  Uses ImageMagick for formats Pillow can't decode."""
+    try:
+        with Image.open(src_path) as img:
+            fmt = img.format
+            img = ImageOps.exif_transpose(img)
+            kwargs = {'quality': 95} if fmt == 'JPEG' else {}
+            if exif := img.info.get('exif'):
+                kwargs['exif'] = exif
+            save_image(img, dest_path, **kwargs)
+    except (OSError, KeyError):
+        subprocess.check_call(['convert', src_path, '-auto-orient', dest_path])
+
+
+def make_thumbnail(src_path, dest_path, size=(150, 150)):
+    """Make a thumbnail with Pillow.  Uses ImageMagick for formats Pillow can't decode."""
+    try:
+        with Image.open(src_path) as img:
+            img.draft('RGB', size)
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail(size, reducing_gap=2.0)
+            save_image(img, dest_path)
+    except (OSError, KeyError):
+        subprocess.check_call(['convert', src_path, '-resize', f'{size[0]}x{size[1]}', '-auto-orient', dest_path])
+
+
 def read_metadata(path):
     ret = {'title': '', 'keywords': '', 'summary': '', 'description': ''}
     if path.exists():
@@ -324,7 +363,7 @@ def write_md(args, details):
             dest_path.parent.mkdir(parents=True, exist_ok=True)
             if dest_path.suffix.lower() in ('.jpg', '.png'):
                 if needs_reorientation(src_path):
-                    subprocess.check_call(['convert', src_path, '-auto-orient', dest_path])
+                    auto_orient(src_path, dest_path)
                 elif args.symlink:
                     dest_path.symlink_to(src_path)
                 else:
@@ -376,7 +415,7 @@ def write_md(args, details):
                 if thumb_path_try.exists() and thumb_path_try.stat().st_size > 0:
                     print(f'found thumb {thumb_path_try} {thumb_path}')
                     if thumb_path_try.suffix.lower() in ('.jpg', '.jpeg', '.png'):
-                        subprocess.check_call(['convert', thumb_path_try, '-auto-orient', thumb_path])
+                        auto_orient(thumb_path_try, thumb_path)
                     else:
                         shutil.copy2(thumb_path_try, thumb_path)
                     break
@@ -384,7 +423,7 @@ def write_md(args, details):
                 if thumb_path_try.exists() and thumb_path_try.stat().st_size > 0:
                     print(f'found thumb {thumb_path_try} {thumb_path}')
                     if thumb_path_try.suffix.lower() in ('.jpg', '.png'):
-                        subprocess.check_call(['convert', thumb_path_try, '-auto-orient', thumb_path])
+                        auto_orient(thumb_path_try, thumb_path)
                     else:
                         shutil.copy2(thumb_path_try, thumb_path)
                     break
@@ -395,7 +434,7 @@ def write_md(args, details):
         if not thumb_path.exists():
             print(f'generating thumbnail for {dest_path}')
             thumb_path.parent.mkdir(parents=True, exist_ok=True)
-            subprocess.check_call(['convert', dest_path, '-resize', '150x150', '-auto-orient', thumb_path])
+            make_thumbnail(dest_path, thumb_path)
         if thumb_path.exists():
             metadata['thumbnail'] = f'thumbnails/{thumb_path.name}'
 
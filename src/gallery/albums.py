@@ -1,11 +1,238 @@
+import asyncio
+import itertools
 import logging
+import os
 from pathlib import Path
+from typing import Any, Callable
 
-from PIL import Image
 from natsort import natsort_keygen, ns
 
 from .config import ENV
-from .util import read_metadata, get_type, get_mime
+from .dimensions import ImageSizeCache, read_image_size, sidecar_image_size
+from .util import json_loads, read_metadata, read_metadata_many, get_type, get_mime
+
+
+MANIFEST_NAME = '.album-manifest'
+MANIFEST_VERSION = 3
+# prefix of in-progress uploads
+UPLOAD_PREFIX = '.upload-'
+# files in an album that belong to the gallery, not the album contents
+HIDDEN_PREFIXES = (MANIFEST_NAME, UPLOAD_PREFIX)
+
+DERIVATIVE_PREFIX = '/_derivative'
+
+
+def derivative_widths() -> list[int]:
+    """Get the configured derivative widths, smallest first."""
+    return sorted(int(w) for w in ENV.DERIVATIVE_WIDTHS)
+
+
+def derivative_url(rel: Path, width: int) -> str:
+    """Get the url of an image derivative, given the image path relative to the source."""
+    return f'{DERIVATIVE_PREFIX}/{width}/{rel}.{ENV.DERIVATIVE_FORMAT}'
+
+
+class DirListing:
+    """
+    Names in an album dir and its `thumbnails/` dir, from a single scan.
+
+    Lets album children resolve their metadata and thumbnails without
+    per-child stat calls.
+
+    Args:
+        path: album file path
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self.rel = path.relative_to(ENV.SOURCE)
+        # version tokens are only known from a manifest, see `ManifestListing`
+        self.versions: dict[str, str] = {}
+        with os.scandir(path) as it:
+            self.entries = list(it)
+        self.names = {entry.name for entry in self.entries}
+        self.dirs = {entry.name for entry in self.entries if entry.is_dir()}
+        self.thumbnails: set[str] = set()
+        if 'thumbnails' in self.names:
+            try:
+                self.thumbnails = set(os.listdir(path / 'thumbnails'))
+            except OSError:
+                pass
+
+    @property
+    def children(self) -> list[str]:
+        """Names of the albums and media in the album."""
+        return [
+            e.name for e in self.entries
+            if e.name != 'thumbnails' and not e.name.endswith('.meta.json') and not e.name.startswith(HIDDEN_PREFIXES)
+        ]
+
+    def has_metadata(self, name: str) -> bool:
+        return Path(name).with_suffix('.meta.json').name in self.names
+
+    def type(self, name: str) -> str:
+        """Get the type of a child: album, image, video, or file."""
+        return 'album' if name in self.dirs else get_type(Path(name))
+
+    def entry(self, name: str) -> dict | None:
+        """Get the precomputed manifest entry for a child, if any."""
+        return None
+
+
+class ManifestListing:
+    """
+    Album listing loaded from a precomputed `.album-manifest`.
+
+    Has the same interface as `DirListing`, plus the metadata, thumbnails,
+    dimensions, and version tokens of every child, so an album can be
+    rendered without touching the rest of the directory.
+
+    Args:
+        path: album file path
+        data: manifest data
+    """
+    def __init__(self, path: Path, data: dict[str, Any]):
+        self.path = path
+        self.rel = path.relative_to(ENV.SOURCE)
+        self.data = data
+        self.entries: dict[str, dict[str, Any]] = data['children']
+        self.dirs = {name for name, entry in self.entries.items() if entry['type'] == 'album'}
+        self.thumbnails = set(data['thumbnails'])
+        self.versions: dict[str, str] = dict(data['versions'])
+        for entry in self.entries.values():
+            self.versions.update(entry['versions'])
+
+    @property
+    def children(self) -> list[str]:
+        return list(self.entries)
+
+    @property
+    def metadata(self) -> dict[Path, dict]:
+        """Metadata of the album and its children."""
+        ret = {self.path / name: entry['meta'] for name, entry in self.entries.items()}
+        ret[self.path] = self.data['meta']
+        return ret
+
+    def has_metadata(self, name: str) -> bool:
+        return name in self.entries
+
+    def type(self, name: str) -> str:
+        return self.entries[name]['type']
+
+    def entry(self, name: str) -> dict | None:
+        return self.entries.get(name)
+
+
+def read_manifest(path: Path, stamp: list[int] | None = None) -> ManifestListing | None:
+    """
+    Read an album's manifest, if it is still valid.
+
+    A manifest is valid while its mtime matches the album dir's, and the
+    rest of the `album_stamp` matches the one it was written with, so
+    adding, removing, or renaming anything in the album, or changing its
+    thumbnails or metadata, falls back to a full scan.  See
+    `manifest.update_manifest` for edits to children in place.
+
+    Args:
+        path: album file path
+        stamp: `album_stamp` of the album, if already taken
+
+    Returns:
+        the manifest listing, or None if missing or stale
+    """
+    try:
+        if stamp is None:
+            stamp = album_stamp(path)
+        with open(path / MANIFEST_NAME, 'rb') as f:
+            if os.fstat(f.fileno()).st_mtime_ns != stamp[0]:
+                return None
+            data = json_loads(f.read())
+        if data.get('version') != MANIFEST_VERSION or data.get('stamp') != stamp[1:]:
+            return None
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        logging.info('bad manifest for album %s', path, exc_info=True)
+        return None
+    return ManifestListing(path, data)
+
+
+def manifest_entry(item: 'AlbumItem', versions: dict[str, str]) -> dict[str, Any]:
+    """
+    Get the manifest entry for an album child.
+
+    Args:
+        item: album or media item
+        versions: version tokens by url
+    """
+    ret = {
+        'type': item.type,
+        'meta': item.meta,
+        'thumbnail': item.thumbnail,
+        'versions': {url: versions[url] for url in item.src_urls() if url in versions},
+    }
+    if isinstance(item, Media):
+        ret['mime'] = item.mime
+        if item.type == 'image':
+            ret['width'] = item.width
+            ret['height'] = item.height
+    return ret
+
+
+def album_thumbnail(rel: Path, meta: dict, thumbnails: set[str]) -> str:
+    """
+    Get the thumbnail url of an album.
+
+    Args:
+        rel: album path relative to the source
+        meta: album metadata
+        thumbnails: names in the album's `thumbnails/` dir
+    """
+    if 'thumbnail' in meta:
+        return str(Path('/_src') / rel / meta['thumbnail'])
+    elif 'thumb.jpg' in thumbnails:
+        return str(Path('/_src') / rel / 'thumbnails' / 'thumb.jpg')
+    else:
+        return '/static/echo/blank.gif'
+
+
+def order_children(listing: DirListing, sorting: str, get_meta: Callable[[str], dict] | None = None) -> list[tuple[str, str]]:
+    """
+    Sort the children of an album.
+
+    Args:
+        listing: listing of the album
+        sorting: sort spec from the album metadata
+        get_meta: function to get a child's metadata by name, for metadata sorting
+
+    Returns:
+        list of (type, name), with albums first, then images, videos, and files
+    """
+    groups: dict[str, list[str]] = {'album': [], 'image': [], 'video': [], 'file': []}
+    for name in listing.children:
+        groups[listing.type(name)].append(name)
+
+    if 'filename' in sorting:
+        logging.info('sort by filename')
+        sort_key = natsort_keygen(alg=ns.SIGNED|ns.LOCALE)
+    elif 'meta.' in sorting and get_meta:
+        meta_key = sorting.split(".", 1)[1]
+        logging.info('sort by meta %s', meta_key)
+        sort_key = natsort_keygen(
+            key=lambda name: get_meta(name).get(meta_key, ""), alg=ns.SIGNED|ns.LOCALE
+        )
+    else:
+        sort_key = natsort_keygen(alg=ns.SIGNED|ns.LOCALE)
+        logging.warning('unknown sorting: %r', sorting)
+
+    reverse_sort = sorting[0] == '-'
+    if reverse_sort:
+        logging.info('REVERSED sorting')
+
+    ret = []
+    for type_, names in groups.items():
+        names.sort(key=sort_key, reverse=reverse_sort)
+        ret.extend((type_, name) for name in names)
+    return ret
 
 
 class Album:
@@ -20,20 +247,40 @@ class Album:
         images: list
         videos: list
         files: list
+        total: total number of children
+        offset: index of the first child in the window
+        versions: version tokens by url, if known from a manifest
 
     albums, images, videos, and files are sorted as specified.
+    For large albums, only a window of children can be loaded, counting
+    albums first, then images, videos, and files.
 
     Args:
         path: album file path
         prefix: web prefix to add to media paths (for editing)
+        listing: listing of the album, if already scanned or read from a manifest
+        metadata: metadata of the album and its children, if already read
+        offset: index of the first child to load
+        limit: max number of children to load, or None for all
+        image_sizes: image size cache, or None to open images without a manifest or sidecar size
     """
-    def __init__(self, path: Path, prefix: Path | None = None):
+    def __init__(self, path: Path, prefix: Path | None = None, listing: DirListing | ManifestListing | None = None,
+                 metadata: dict[Path, dict] | None = None, offset: int = 0, limit: int | None = None,
+                 image_sizes: ImageSizeCache | None = None):
         logging.info('reading album %s', path)
-        basedir = Path(ENV.SOURCE)
         web_prefix = prefix if prefix else Path('/')
+        if not listing:
+            listing = DirListing(path)
+        if metadata is None:
+            metadata = {}
+        self.listing = listing
+        self.versions = dict(listing.versions)
 
-        self.url = str(web_prefix / path.relative_to(basedir))
-        self.meta = read_metadata(path)
+        self.url = str(web_prefix / listing.rel)
+        if path in metadata:
+            self.meta = metadata[path]
+        else:
+            self.meta = read_metadata(path, is_dir=True, exists='index.meta.json' in listing.names)
         if not self.meta['title']:
             self.meta['title'] = path.name
         self.albums = []
@@ -41,134 +288,391 @@ class Album:
         self.videos = []
         self.files = []
 
-        for child in path.iterdir():
-            if child.name == 'thumbnails' or child.name.endswith('.meta.json'):
-                pass
-            elif child.is_dir():
-                self.albums.append(AlbumItem(child, prefix=prefix))
+        def get_meta(name):
+            child = path / name
+            if child not in metadata:
+                if name in listing.dirs:
+                    metadata[child] = read_metadata(child, is_dir=True)
+                else:
+                    metadata[child] = read_metadata(child, is_dir=False, exists=listing.has_metadata(name))
+            meta = metadata[child]
+            if not meta['title']:
+                meta['title'] = name
+            return meta
+
+        children = order_children(listing, self.meta.get('sort', 'filename'), get_meta)
+        self.total = len(children)
+        self.offset = offset
+        self.limit = limit
+        window = children[offset:offset+limit] if limit else children[offset:]
+
+        for type_, name in window:
+            child = path / name
+            if type_ == 'album':
+                self.albums.append(AlbumItem(child, prefix=prefix, listing=listing, meta=get_meta(name)))
             else:
-                data = Media(child, prefix=prefix)
-                if data.type == 'image':
+                data = Media(child, prefix=prefix, listing=listing, meta=get_meta(name), image_sizes=image_sizes)
+                if type_ == 'image':
                     self.images.append(data)
-                elif data.type == 'video':
+                elif type_ == 'video':
                     self.videos.append(data)
                 else:
                     self.files.append(data)
 
-        sorting = self.meta.get('sort', 'filename')
-        if 'filename' in sorting:
-            logging.info('sort by filename')
-            sort_key = natsort_keygen(
-                key=lambda s: s.name, alg=ns.SIGNED|ns.LOCALE
-            )
-        elif 'meta.' in sorting:
-            meta_key = sorting.split(".", 1)[1]
-            logging.info('sort by meta %s', meta_key)
-            sort_key = natsort_keygen(
-                key=lambda s: s.meta.get(meta_key, ""), alg=ns.SIGNED|ns.LOCALE
-            )
-        else:
-            sort_key = natsort_keygen(
-                key=lambda s: s.name, alg=ns.SIGNED|ns.LOCALE
-            )
-            logging.warning('unknown sorting: %r', sorting)
+        self.thumbnail = album_thumbnail(listing.rel, self.meta, listing.thumbnails)
 
-        reverse_sort = sorting[0] == '-'
-        if reverse_sort:
-            logging.info('REVERSED sorting')
+    @property
+    def paged(self) -> bool:
+        """Whether only part of the album is loaded."""
+        return self.offset > 0 or len(self.albums) + len(self.images) + len(self.videos) + len(self.files) < self.total
 
-        self.albums.sort(key=sort_key, reverse=reverse_sort)
-        self.images.sort(key=sort_key, reverse=reverse_sort)
-        self.videos.sort(key=sort_key, reverse=reverse_sort)
-        self.files.sort(key=sort_key, reverse=reverse_sort)
+    @property
+    def from_manifest(self) -> bool:
+        return isinstance(self.listing, ManifestListing)
 
-        if 'thumbnail' in self.meta:
-            basedir = Path(ENV.SOURCE)
-            self.thumbnail = str(Path('/_src') / path.relative_to(basedir) / self.meta['thumbnail'])
-        else:
-            self.thumbnail = get_thumbnail(path)
+    def to_manifest(self, versions: dict[str, str], signatures: dict[str, str]) -> dict[str, Any]:
+        """
+        Get the manifest data for a fully loaded, scanned album.
+
+        Args:
+            versions: version tokens by url
+            signatures: `album_signatures` from before the album was scanned
+        """
+        assert isinstance(self.listing, DirListing) and not self.paged
+        children = {}
+        for item in itertools.chain(self.albums, self.images, self.videos, self.files):
+            children[item.name] = manifest_entry(item, versions)
+        return {
+            'version': MANIFEST_VERSION,
+            'meta': self.meta,
+            'thumbnails': sorted(self.listing.thumbnails),
+            'signatures': signatures,
+            'versions': {self.thumbnail: versions[self.thumbnail]} if self.thumbnail in versions else {},
+            'children': children,
+        }
+
+    def src_urls(self) -> list[str]:
+        """Get all `/_src` urls referenced by this album."""
+        ret = [self.thumbnail] if self.thumbnail.startswith('/_src/') else []
+        for item in itertools.chain(self.albums, self.images, self.videos, self.files):
+            ret.extend(item.src_urls())
+        return ret
+
+
+async def load_album(path: Path, prefix: Path | None = None, offset: int = 0, limit: int | None = None,
+                     manifest: bool = True, image_sizes: ImageSizeCache | None = None,
+                     stamp: list[int] | None = None) -> Album:
+    """
+    Load an album, reading sidecar metadata concurrently.
+
+    A valid `.album-manifest` is used if there is one.  Otherwise, when
+    sorting by filename, only the sidecars in the window are read.  The
+    `Album` itself is built in a worker thread, as it may stat or open
+    images.
+
+    Args:
+        path: album file path
+        prefix: web prefix to add to media paths (for editing)
+        offset: index of the first child to load
+        limit: max number of children to load, or None for all
+        manifest: whether to use the album manifest
+        image_sizes: image size cache, see `Album`
+        stamp: `album_stamp` of the album, if already taken
+    """
+    if manifest and ENV.ALBUM_MANIFEST:
+        if manifest_listing := await asyncio.to_thread(read_manifest, path, stamp):
+            return await asyncio.to_thread(Album, path, prefix=prefix, listing=manifest_listing,
+                                           metadata=manifest_listing.metadata, offset=offset, limit=limit,
+                                           image_sizes=image_sizes)
+
+    listing = await asyncio.to_thread(DirListing, path)
+    meta = await asyncio.to_thread(read_metadata, path, is_dir=True, exists='index.meta.json' in listing.names)
+    sorting = meta.get('sort', 'filename')
+    if 'filename' not in sorting and 'meta.' in sorting:
+        names = listing.children
+    else:
+        children = order_children(listing, sorting)
+        window = children[offset:offset+limit] if limit else children[offset:]
+        names = [name for _, name in window]
+
+    paths = []
+    dirs = set()
+    for name in names:
+        if name in listing.dirs:
+            paths.append(path / name)
+            dirs.add(path / name)
+        elif listing.has_metadata(name):
+            paths.append(path / name)
+    metadata = await read_metadata_many(paths, dirs=dirs)
+    metadata[path] = meta
+    if image_sizes:
+        await image_sizes.preload(path, [name for name in names if listing.type(name) == 'image'])
+    return await asyncio.to_thread(Album, path, prefix=prefix, listing=listing, metadata=metadata,
+                                   offset=offset, limit=limit, image_sizes=image_sizes)
+
+
+def _relpath(path: Path, listing: DirListing | ManifestListing | None) -> Path:
+    if listing:
+        return listing.rel / path.name
+    return path.relative_to(ENV.SOURCE)
 
 
 class AlbumItem:
-    def __init__(self, path: Path, prefix: Path | None = None):
-        basedir = Path(ENV.SOURCE)
+    """
+    Get information on an album entry.
+
+    Args:
+        path: file path
+        prefix: web prefix to add to media paths (for editing)
+        listing: listing of the parent album, if already scanned or read from a manifest
+        meta: metadata, if already read
+    """
+    def __init__(self, path: Path, prefix: Path | None = None, listing: DirListing | ManifestListing | None = None,
+                 meta: dict | None = None):
         if not prefix:
             prefix = Path('/')
+        rel = _relpath(path, listing)
 
-        self.url = str(prefix / path.relative_to(basedir))
-        self.album_url = str(prefix / path.relative_to(basedir).parent) + '#' + path.name
-        self.src =  str(Path('/_src') / path.relative_to(basedir))
+        self.url = str(prefix / rel)
+        self.album_url = str(prefix / rel.parent) + '#' + path.name
+        self.src =  str(Path('/_src') / rel)
         self.name = path.name
         self.type = 'album'
 
-        self.meta = read_metadata(path)
+        self.meta = meta if meta is not None else self._read_metadata(path, listing)
         if not self.meta['title']:
             self.meta['title'] = path.name
         logging.debug('meta for %s = %r', path.name, self.meta)
 
-        self.thumb(path)
+        if listing and (entry := listing.entry(path.name)):
+            self.thumbnail = entry['thumbnail']
+        else:
+            self.thumb(path, rel, listing)
+
+    def _read_metadata(self, path: Path, listing: DirListing | ManifestListing | None):
+        return read_metadata(path, is_dir=True if listing else None)
 
-    def thumb(self, path: Path):
+    def thumb(self, path: Path, rel: Path, listing: DirListing | ManifestListing | None = None):
         if 'thumbnail' in self.meta:
-            basedir = Path(ENV.SOURCE)
-            self.thumbnail = str(Path('/_src') / path.relative_to(basedir) / self.meta['thumbnail'])
+            self.thumbnail = str(Path('/_src') / rel / self.meta['thumbnail'])
         else:
-            self.thumbnail = get_thumbnail(path)
+            self.thumbnail = get_thumbnail(path, is_dir=True if listing else None)
+
+    def src_urls(self) -> list[str]:
+        """Get all `/_src` urls referenced by this item."""
+        return [url for url in (self.thumbnail, self.src) if url.startswith('/_src/')]
 
 
 class Media(AlbumItem):
-    def __init__(self, path: Path, prefix: Path | None = None):
+    def __init__(self, path: Path, prefix: Path | None = None, listing: DirListing | ManifestListing | None = None,
+                 meta: dict | None = None, image_sizes: ImageSizeCache | None = None):
         logging.debug('reading media %s', path)
-        super().__init__(path=path, prefix=prefix)
+        super().__init__(path=path, prefix=prefix, listing=listing, meta=meta)
 
         if not prefix:
             prefix = Path('/_src')
-        basedir = Path(ENV.SOURCE)
 
         # this may be a different prefix than AlbumItem
-        self.url = str(prefix / path.relative_to(basedir))
+        self.url = str(prefix / _relpath(path, listing))
         self.type = get_type(path)
         self.mime = get_mime(path)
 
+        self.derivatives: list[tuple[int, str]] = []
         if self.type == 'image':
-            self.width, self.height = get_image_size(path)
+            if listing and (entry := listing.entry(path.name)) and 'width' in entry:
+                self.width, self.height = entry['width'], entry['height']
+            else:
+                self.width, self.height = get_image_size(path, meta=self.meta, image_sizes=image_sizes)
+            # animations would lose all but the first frame
+            if path.suffix.lower() != '.gif':
+                rel = _relpath(path, listing)
+                self.derivatives = [(w, derivative_url(rel, w)) for w in derivative_widths() if w < self.width]
+
+    def _read_metadata(self, path: Path, listing: DirListing | ManifestListing | None):
+        if listing:
+            return read_metadata(path, is_dir=False, exists=listing.has_metadata(path.name))
+        return read_metadata(path)
 
-    def thumb(self, path: Path):
+    def thumb(self, path: Path, rel: Path, listing: DirListing | ManifestListing | None = None):
         if 'thumbnail' in self.meta:
-            basedir = Path(ENV.SOURCE)
-            self.thumbnail = str(Path('/_src') / path.relative_to(basedir).parent / self.meta['thumbnail'])
+            self.thumbnail = str(Path('/_src') / rel.parent / self.meta['thumbnail'])
         else:
-            self.thumbnail = get_thumbnail(path)
+            self.thumbnail = get_thumbnail(path, is_dir=False, thumbnails=listing.thumbnails if listing else None)
+
+
+class SearchResult:
+    """
+    A search result, built from the indexed doc without touching the filesystem.
+
+    Has the attributes of an `AlbumItem` or `Media` that the search page uses.
+
+    Args:
+        source: ElasticSearch `_source` of the hit, see `Indexer.index_metadata`
+    """
+    TYPES = {'Album': 'album', 'Image': 'image', 'Video': 'video'}
+
+    def __init__(self, source: dict[str, Any]):
+        rel = Path(source['path'].lstrip('/'))
+        self.name = rel.name
+        self.type = self.TYPES.get(source.get('type', ''), 'file')
+        self.src = str(Path('/_src') / rel)
+        self.url = str(Path('/') / rel) if self.type == 'album' else self.src
+        self.album_url = str(Path('/') / rel.parent) + '#' + rel.name
+        self.thumbnail = source['thumbnail']
+        self.mime = source.get('mime', '')
+        self.derivatives: list[tuple[int, str]] = []
+        if self.type == 'image':
+            self.width, self.height = source.get('width', 150), source.get('height', 150)
+            if rel.suffix.lower() != '.gif':
+                self.derivatives = [(w, derivative_url(rel, w)) for w in derivative_widths() if w < self.width]
+
+        self.meta = {key: source.get(key, '') for key in ('title', 'summary', 'keywords', 'description')}
+        if not self.meta['title']:
+            self.meta['title'] = self.name
+        if date := source.get('date'):
+            self.meta['date'] = date
+
+        self.versions: dict[str, str] = {}
+        if token := source.get('src_version'):
+            self.versions[self.src] = token
+        if token := source.get('thumbnail_version'):
+            self.versions[self.thumbnail] = token
+
+    @staticmethod
+    def indexed(source: dict[str, Any]) -> bool:
+        """Check if a doc has the fields to build a result from, as older docs do not."""
+        return 'thumbnail' in source
+
+    def src_urls(self) -> list[str]:
+        """Get all `/_src` urls referenced by this item."""
+        return [url for url in (self.thumbnail, self.src) if url.startswith('/_src/')]
+
+
+def album_stamp(path: Path) -> list[int]:
+    """
+    Get a cheap stamp of an album dir, to check cached pages and manifests against.
+
+    Holds the mtimes of the album dir, its `thumbnails/` dir, and its
+    `index.meta.json`, or 0 for those missing, so it only needs three
+    stats however big the album is.  Children edited in place are not
+    covered, see `album_signatures` for that.
+    """
+    ret = [os.stat(path).st_mtime_ns]
+    for name in ('thumbnails', 'index.meta.json'):
+        try:
+            ret.append(os.stat(path / name).st_mtime_ns)
+        except FileNotFoundError:
+            ret.append(0)
+    return ret
 
 
-def get_image_size(path: Path) -> tuple[int, int]:
+def album_signatures(path: Path) -> dict[str, str]:
+    """
+    Get a signature of everything in an album dir that its page shows.
+
+    Files, including sidecars, and thumbnails are signed with their mtime
+    and size, so they change even when written in place.  Sub-albums are
+    signed with their `index.meta.json` and default thumbnail.  Gallery
+    files such as the manifest are left out, so writing them changes
+    nothing.  Keys are paths relative to the album, with a trailing `/`
+    for sub-albums.
+
+    Needs an `os.scandir` of the album and its `thumbnails/`, and a stat
+    per entry, so it is only used when writing manifests.
+    """
+    ret = {}
+    with os.scandir(path) as it:
+        entries = list(it)
+    for entry in entries:
+        if entry.name.startswith(HIDDEN_PREFIXES):
+            continue
+        try:
+            if entry.name == 'thumbnails':
+                with os.scandir(entry.path) as it:
+                    for thumb in it:
+                        if not thumb.name.startswith(HIDDEN_PREFIXES):
+                            st = thumb.stat()
+                            ret[f'thumbnails/{thumb.name}'] = f'{st.st_mtime_ns}:{st.st_size}'
+            elif entry.is_dir():
+                ret[f'{entry.name}/'] = ''
+                for name in ('index.meta.json', 'thumbnails/thumb.jpg'):
+                    try:
+                        st = os.stat(os.path.join(entry.path, name))
+                    except FileNotFoundError:
+                        continue
+                    ret[f'{entry.name}/{name}'] = f'{st.st_mtime_ns}:{st.st_size}'
+            else:
+                st = entry.stat()
+                ret[entry.name] = f'{st.st_mtime_ns}:{st.st_size}'
+        except FileNotFoundError:
+            # removed while scanning
+            continue
+    return ret
+
+
+def album_fingerprint(path: Path, stamp: list[int] | None = None) -> str:
+    """Get a cheap fingerprint of an album directory's contents, from its `album_stamp`."""
+    if stamp is None:
+        stamp = album_stamp(path)
+    return ':'.join(str(n) for n in stamp)
+
+
+def album_key(path: Path) -> str:
+    """Get the page cache key for an album path, which is '' for the root album."""
+    rel = path.relative_to(ENV.SOURCE)
+    return '' if rel == Path('.') else str(rel)
+
+
+def get_image_size(path: Path, meta: dict | None = None, image_sizes: ImageSizeCache | None = None) -> tuple[int, int]:
+    """Get the size of an image, from its sidecar, the image size cache if given, or by opening it."""
+    if image_sizes:
+        return image_sizes.get(path, meta=meta)
     try:
-        return Image.open(str(path)).size
-    except Exception:
+        st = path.stat()
+    except OSError:
         logging.info('cannot get size of image at %s', path)
         return (150, 150)
+    if ret := sidecar_image_size(meta, st):
+        return ret
+    return read_image_size(path)
 
 
-def get_thumbnail(path: Path) -> str:
+def get_thumbnail(path: Path, is_dir: bool | None = None, thumbnails: set[str] | None = None) -> str:
+    """
+    Get the thumbnail url for an album or media file.
+
+    Args:
+        path: file path
+        is_dir: whether path is a dir, if already known
+        thumbnails: names in the parent's `thumbnails/` dir, if already known
+    """
     basedir = Path(ENV.SOURCE)
-    if path.is_dir():
+    if is_dir is None:
+        is_dir = path.is_dir()
+
+    def exists(thumb_path: Path) -> bool:
+        if thumbnails is not None and thumb_path.parent == path.parent / 'thumbnails':
+            return thumb_path.name in thumbnails
+        return thumb_path.exists()
+
+    if is_dir:
         ret = path / 'thumbnails' / 'thumb.jpg'
-        if ret.exists():
+        if exists(ret):
             return '/_src/'+str(ret.relative_to(basedir))
         else:
             return '/static/echo/blank.gif'
     elif get_type(path) == 'image':
         ret = path.parent / 'thumbnails' / path.name
-        if ret.exists():
+        if exists(ret):
             return '/_src/'+str(ret.relative_to(basedir))
-        elif ret.with_suffix('.jpg').exists():
+        elif exists(ret.with_suffix('.jpg')):
             return '/_src/'+str(ret.relative_to(basedir).with_suffix('.jpg'))
         else:
             return '/_src/'+str(path.relative_to(basedir))
     else:
         ret = path.parent / 'thumbnails' / path.name
         ret = ret.with_suffix('.jpg')
-        if ret.exists():
+        if exists(ret):
             return '/_src/'+str(ret.relative_to(basedir))
         else:
             return '/static/echo/blank.gif'
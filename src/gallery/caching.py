@@ -1,5 +1,13 @@
+import asyncio
+from collections import OrderedDict
+import gzip
+from hashlib import blake2b, sha1
 import json
 import logging
+import random
+import time
+from typing import Any, Awaitable, Callable
+import uuid
 
 from redis.backoff import ExponentialBackoff
 from redis.asyncio.retry import Retry
@@ -10,14 +18,72 @@ from redis.exceptions import (
    TimeoutError
 )
 
+import gallery
 from .config import ENV
+from .util import json_loads
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def _json_dumps(val: Any) -> bytes:
+    return json.dumps(val).encode('utf-8')
+
+
+def _raw_dumps(val: bytes | str) -> bytes:
+    if isinstance(val, str):
+        return val.encode('utf-8')
+    if not isinstance(val, (bytes, bytearray, memoryview)):
+        raise TypeError(f'raw values must be bytes, not {type(val).__name__}')
+    return bytes(val)
+
+
+def _raw_loads(val: bytes) -> bytes:
+    return val
+
+
+def _msgpack_dumps(val: Any) -> bytes:
+    if msgpack is None:
+        raise RuntimeError('the msgpack serializer needs the msgpack package')
+    return msgpack.packb(val, use_bin_type=True)
+
+
+def _msgpack_loads(val: bytes) -> Any:
+    if msgpack is None:
+        raise RuntimeError('the msgpack serializer needs the msgpack package')
+    return msgpack.unpackb(val, raw=False)
+
+
+# serializer name: (dumps, loads)
+SERIALIZERS: dict[str, tuple[Callable[[Any], bytes], Callable[[bytes], Any]]] = {
+    'json': (_json_dumps, json_loads),
+    'raw': (_raw_dumps, _raw_loads),
+    'msgpack': (_msgpack_dumps, _msgpack_loads),
+}
 
 
 class RedisInstance:
+    """
+    Redis cache, sharing one connection pool between instances.
+
+    Values are serialized with one of `SERIALIZERS`: `json` by default,
+    `raw` for bytes stored as is, or `msgpack` if installed.
+
+    Args:
+        serializer: serializer name
+    """
     redis: Redis | None = None
-    def __init__(self):
+    def __init__(self, serializer: str = 'json'):
         if not RedisInstance.redis:
             self.restart()
+        if serializer not in SERIALIZERS:
+            raise ValueError(f'unknown serializer {serializer!r}')
+        if serializer == 'msgpack' and msgpack is None:
+            raise RuntimeError('the msgpack serializer needs the msgpack package')
+        self.serializer = serializer
+        self.dumps, self.loads = SERIALIZERS[serializer]
     
     async def close(self):
         if RedisInstance.redis:
@@ -43,18 +109,530 @@ class RedisInstance:
         if not val:
             raise KeyError('not found')
         else:
-            return json.loads(val.decode('utf-8'))
+            return self.loads(val)
+
+    async def get_many(self, names) -> dict[str, Any]:
+        """Get several values in one round trip, leaving out missing ones."""
+        logging.debug('Cache-get-many: %d keys', len(names))
+        assert self.redis is not None
+        if not names:
+            return {}
+        vals = await self.redis.mget([str(n) for n in names])
+        return {n: self.loads(v) for n, v in zip(names, vals) if v}
 
-    async def set(self, name, val):
+    async def set(self, name, val, ttl: int | None = None):
         logging.debug('Cache-set: %s', name)
         assert self.redis is not None
-        await self.redis.set(str(name), json.dumps(val))
+        await self.redis.set(str(name), self.dumps(val), ex=ttl if ttl else None)
+
+    async def set_many(self, mapping, ttl: int | None = None):
+        """Set several values in one pipelined round trip."""
+        logging.debug('Cache-set-many: %d keys', len(mapping))
+        assert self.redis is not None
+        if not mapping:
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for name, val in mapping.items():
+                pipe.set(str(name), self.dumps(val), ex=ttl if ttl else None)
+            await pipe.execute()
 
     async def delete(self, name):
         logging.debug('Cache-delete: %s', name)
         assert self.redis is not None
         await self.redis.delete(str(name))
 
+    async def delete_many(self, names) -> int:
+        """Delete several keys in one round trip, returning how many existed."""
+        logging.debug('Cache-delete-many: %d keys', len(names))
+        assert self.redis is not None
+        if not names:
+            return 0
+        return await self.redis.delete(*(str(n) for n in names))
+
+    async def move_many(self, mapping, ttl: int | None = None):
+        """
+        Move keys to new names, in one pipelined round trip.
+
+        Missing keys are skipped, and existing destinations replaced.
+
+        Args:
+            mapping: dict of name: new name
+            ttl: TTL of the moved keys in seconds
+        """
+        logging.debug('Cache-move-many: %d keys', len(mapping))
+        assert self.redis is not None
+        if not mapping:
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for name, new_name in mapping.items():
+                pipe.copy(str(name), str(new_name), replace=True)
+                if ttl:
+                    pipe.expire(str(new_name), ttl)
+            pipe.delete(*(str(n) for n in mapping))
+            await pipe.execute()
+
+    async def acquire_lock(self, name, ttl: float) -> str | None:
+        """
+        Try to take a lock, which expires after `ttl` seconds.
+
+        Returns:
+            the lock token to release it with, or None if already taken
+        """
+        logging.debug('Cache-lock: %s', name)
+        assert self.redis is not None
+        token = uuid.uuid4().hex
+        if await self.redis.set(str(name), token, nx=True, px=max(1, int(ttl * 1000))):
+            return token
+        return None
+
+    # only delete the lock if still held with our token
+    RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+
+    async def release_lock(self, name, token: str):
+        logging.debug('Cache-unlock: %s', name)
+        assert self.redis is not None
+        await self.redis.eval(self.RELEASE_SCRIPT, 1, str(name), token)
+
+    # only extend the lock if still held with our token
+    EXTEND_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) else return 0 end"
+
+    async def extend_lock(self, name, token: str, ttl: float) -> bool:
+        """
+        Renew a lock for another `ttl` seconds.
+
+        Returns:
+            False if the lock expired or was taken by someone else
+        """
+        logging.debug('Cache-relock: %s', name)
+        assert self.redis is not None
+        return bool(await self.redis.eval(self.EXTEND_SCRIPT, 1, str(name), token, max(1, int(ttl * 1000))))
+
+    async def hmget(self, name, keys):
+        logging.debug('Cache-hmget: %s', name)
+        assert self.redis is not None
+        vals = await self.redis.hmget(str(name), [str(k) for k in keys])
+        return [self.loads(v) if v else None for v in vals]
+
+    async def hset(self, name, mapping, ttl: int | None = None):
+        logging.debug('Cache-hset: %s', name)
+        assert self.redis is not None
+        mapping = {str(k): self.dumps(v) for k,v in mapping.items()}
+        if not ttl:
+            await self.redis.hset(str(name), mapping=mapping)
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hset(str(name), mapping=mapping)
+            pipe.expire(str(name), ttl)
+            await pipe.execute()
+
+    async def publish(self, channel, message):
+        logging.debug('Cache-publish: %s', channel)
+        assert self.redis is not None
+        await self.redis.publish(str(channel), message)
+
     async def count(self):
         assert self.redis is not None
         return await self.redis.dbsize()
+
+
+class PageCache:
+    """
+    Cache of rendered album pages.
+
+    Each entry records the gallery version and the fingerprint of the
+    album directory it was rendered from, so it can be revalidated
+    against the filesystem instead of only relying on explicit deletes.
+
+    All pages of an album are fields of one Redis hash, so they are
+    invalidated together.  Each page has a `<page>.meta` JSON field and
+    a `<page>.body` field of raw bytes.
+
+    Bodies are stored gzip compressed, so they can be served as is to
+    clients that accept gzip.  A size-bounded LRU of recent pages is
+    kept in process, in front of Redis, and deletes are published to
+    the other processes so they drop their copies too, see `listen`.
+    Local state is shared between instances, like `RedisInstance`.
+
+    Entries also carry an ETag of the body and the time it was rendered,
+    which `get_meta` reads without the body, to answer conditional
+    requests.
+
+    Renders of the same page are coalesced, see `render_once`.  With
+    `ENV.PAGE_STALE_TTL` set, invalidated pages are kept for that long,
+    so they can be served while the page is re-rendered.
+    """
+    CHANNEL = 'page-cache'
+    STALE_SUFFIX = ':stale'
+    local: OrderedDict[tuple[str, int], dict] = OrderedDict()
+    local_size = 0
+    stats = {'hits': 0, 'redis_hits': 0, 'misses': 0, 'renders': 0, 'shared_renders': 0}
+    _renders: dict[tuple[str, int, str | None], asyncio.Task] = {}
+
+    def __init__(self):
+        self.cache = RedisInstance(serializer='raw')
+
+    @staticmethod
+    def key(path: str) -> str:
+        return 'page:' + str(path).strip('/')
+
+    @staticmethod
+    def _fresh(entry: dict, fingerprint: str | None) -> bool:
+        return entry.get('version') == gallery.__version__ and entry.get('fingerprint') == fingerprint and 'etag' in entry
+
+    @staticmethod
+    def etag(body: bytes) -> str:
+        """Get the strong ETag of an uncompressed page body, without quotes."""
+        return blake2b(body, digest_size=16).hexdigest()
+
+    @classmethod
+    def _set_local(cls, key: str, page: int, entry: dict):
+        cls._evict_local(key, page)
+        cls.local[(key, page)] = entry
+        cls.local_size += len(entry['body'])
+        while cls.local_size > ENV.PAGE_CACHE_MEMORY and cls.local:
+            _, old = cls.local.popitem(last=False)
+            cls.local_size -= len(old['body'])
+
+    @classmethod
+    def _evict_local(cls, key: str, page: int | None = None):
+        """Drop one page, or all pages of an album, from the local tier."""
+        pages = [page] if page is not None else [p for k, p in cls.local if k == key]
+        for p in pages:
+            if entry := cls.local.pop((key, p), None):
+                cls.local_size -= len(entry['body'])
+
+    @classmethod
+    def clear_local(cls):
+        cls.local.clear()
+        cls.local_size = 0
+
+    async def get_meta(self, path: str, fingerprint: str | None, page: int = 1) -> dict[str, Any]:
+        """
+        Get the metadata of a cached page, without its body.
+
+        Raises KeyError if not found or stale.
+
+        Returns:
+            dict of version, fingerprint, etag, and modified time
+        """
+        key = self.key(path)
+        if (entry := self.local.get((key, page))) and self._fresh(entry, fingerprint):
+            return {k: v for k, v in entry.items() if k != 'body'}
+        meta = (await self.cache.hmget(key, [f'{page}.meta']))[0]
+        if not meta or not self._fresh(entry := json_loads(meta), fingerprint):
+            raise KeyError('not found')
+        return entry
+
+    async def get_entry(self, path: str, fingerprint: str | None, page: int = 1) -> dict[str, Any]:
+        """
+        Get a cached page.
+
+        Raises KeyError if not found or stale.
+
+        Returns:
+            the metadata, as in `get_meta`, and the gzip compressed body
+        """
+        key = self.key(path)
+        if entry := self.local.get((key, page)):
+            if self._fresh(entry, fingerprint):
+                self.local.move_to_end((key, page))
+                self.stats['hits'] += 1
+                return entry
+            self._evict_local(key)
+
+        meta, body = await self.cache.hmget(key, [f'{page}.meta', f'{page}.body'])
+        if not meta or not body:
+            self.stats['misses'] += 1
+            raise KeyError('not found')
+        entry = json_loads(meta)
+        if not self._fresh(entry, fingerprint):
+            logging.info('stale page cache for %r', key)
+            self.stats['misses'] += 1
+            await self._remove([key])
+            raise KeyError('stale')
+        self.stats['redis_hits'] += 1
+        entry['body'] = body
+        self._set_local(key, page, entry)
+        return entry
+
+    async def get_compressed(self, path: str, fingerprint: str | None, page: int = 1) -> bytes:
+        """
+        Get a cached page body, gzip compressed.
+
+        Raises KeyError if not found or stale.
+        """
+        return (await self.get_entry(path, fingerprint, page=page))['body']
+
+    async def get_stale(self, path: str, page: int = 1) -> bytes | None:
+        """Get the gzip compressed body of a page invalidated within `ENV.PAGE_STALE_TTL`, if any."""
+        if not ENV.PAGE_STALE_TTL:
+            return None
+        meta, body = await self.cache.hmget(self.key(path) + self.STALE_SUFFIX, [f'{page}.meta', f'{page}.body'])
+        if not meta or not body or json_loads(meta).get('version') != gallery.__version__:
+            return None
+        return body
+
+    async def get(self, path: str, fingerprint: str | None, page: int = 1) -> str:
+        """
+        Get a cached page body.
+
+        Raises KeyError if not found or stale.
+        """
+        return gzip.decompress(await self.get_compressed(path, fingerprint, page=page)).decode('utf-8')
+
+    @classmethod
+    async def make_entry(cls, body: bytes, fingerprint: str | None) -> dict[str, Any]:
+        """Make a cache entry for a page body, as returned by `get_entry`."""
+        # a fixed mtime keeps the output deterministic
+        compressed = await asyncio.to_thread(gzip.compress, body, 6, mtime=0)
+        return {
+            'version': gallery.__version__,
+            'fingerprint': fingerprint,
+            'etag': cls.etag(body),
+            'modified': int(time.time()),
+            'body': compressed,
+        }
+
+    async def set_entry(self, path: str, body: str | bytes, fingerprint: str | None, page: int = 1) -> dict[str, Any]:
+        """
+        Cache a page body.
+
+        Returns:
+            the entry, as returned by `get_entry`
+        """
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        entry = await self.make_entry(body, fingerprint)
+        key = self.key(path)
+        self._set_local(key, page, entry)
+        meta = {k: v for k, v in entry.items() if k != 'body'}
+        await self.cache.hset(key, {
+            f'{page}.meta': json.dumps(meta),
+            f'{page}.body': entry['body'],
+        }, ttl=ENV.PAGE_CACHE_TTL)
+        return entry
+
+    async def set(self, path: str, body: str | bytes, fingerprint: str | None, page: int = 1) -> bytes:
+        """
+        Cache a page body.
+
+        Returns:
+            the gzip compressed body
+        """
+        return (await self.set_entry(path, body, fingerprint, page=page))['body']
+
+    async def delete(self, path: str):
+        """Delete all pages of an album, in every process."""
+        await self.delete_many([path])
+
+    async def delete_many(self, paths: list[str]):
+        """Delete all pages of several albums, in every process, in one round trip each."""
+        keys = [self.key(path) for path in paths]
+        for key in keys:
+            self._evict_local(key)
+        await self._remove(keys)
+        try:
+            await self.cache.publish(self.CHANNEL, '\n'.join(keys))
+        except Exception:
+            logging.info('cannot publish page cache delete for %r', keys, exc_info=True)
+
+    async def _remove(self, keys: list[str]):
+        """Remove albums from Redis, keeping them as stale if enabled."""
+        if ENV.PAGE_STALE_TTL:
+            await self.cache.move_many({key: key + self.STALE_SUFFIX for key in keys}, ttl=ENV.PAGE_STALE_TTL)
+        else:
+            await self.cache.delete_many(keys)
+
+    def start_render(self, path: str, fingerprint: str | None, render: Callable[[], Awaitable[bytes]], page: int = 1) -> asyncio.Task:
+        """
+        Start rendering and caching a page, unless it is already being rendered in this process.
+
+        Renders are only shared for the same fingerprint, so a newer
+        album is never answered with a render of an older one.
+
+        Returns:
+            the render task, which returns the entry, as in `get_entry`
+        """
+        key = (self.key(path), page, fingerprint)
+        if (task := self._renders.get(key)) is not None:
+            self.stats['shared_renders'] += 1
+            return task
+        task = asyncio.create_task(self._render_locked(path, fingerprint, render, page))
+        self._renders[key] = task
+
+        def done(task):
+            self._renders.pop(key, None)
+            if not task.cancelled() and task.exception():
+                logging.info('error rendering %r', key, exc_info=task.exception())
+        task.add_done_callback(done)
+        return task
+
+    async def render_once(self, path: str, fingerprint: str | None, render: Callable[[], Awaitable[bytes]], page: int = 1) -> dict[str, Any]:
+        """
+        Render and cache a page, coalescing concurrent renders.
+
+        Calls in the same process share one render.  Across processes, a
+        short Redis lock lets one process render while the others wait
+        for its result, up to `ENV.PAGE_RENDER_LOCK_TTL` seconds, before
+        rendering themselves.
+
+        Args:
+            path: album path
+            fingerprint: album fingerprint
+            render: renders the page body
+            page: page number
+
+        Returns:
+            the entry, as in `get_entry`
+        """
+        return await asyncio.shield(self.start_render(path, fingerprint, render, page))
+
+    async def _render_locked(self, path: str, fingerprint: str | None, render: Callable[[], Awaitable[bytes]], page: int) -> dict[str, Any]:
+        lock = f'lock:{self.key(path)}:{page}'
+        token = None
+        try:
+            token = await self.cache.acquire_lock(lock, ENV.PAGE_RENDER_LOCK_TTL)
+            if token is None:
+                # another process is rendering, so wait for its result
+                loop = asyncio.get_running_loop()
+                deadline = loop.time() + ENV.PAGE_RENDER_LOCK_TTL
+                while loop.time() < deadline:
+                    await asyncio.sleep(0.05)
+                    try:
+                        ret = await self.get_entry(path, fingerprint, page=page)
+                    except KeyError:
+                        if not await self.cache.contains(lock):
+                            break
+                    else:
+                        self.stats['shared_renders'] += 1
+                        return ret
+                logging.info('gave up waiting for %r, rendering it here', lock)
+        except Exception:
+            logging.info('cannot lock %r, rendering anyway', lock, exc_info=True)
+
+        try:
+            self.stats['renders'] += 1
+            body = await render()
+            try:
+                return await self.set_entry(path, body, fingerprint, page=page)
+            except Exception:
+                logging.info('cannot cache page', exc_info=True)
+                return await self.make_entry(body, fingerprint)
+        finally:
+            if token:
+                try:
+                    await self.cache.release_lock(lock, token)
+                except Exception:
+                    logging.info('cannot unlock %r', lock, exc_info=True)
+
+    async def listen(self, retry_delay: float = 5.):
+        """
+        Drop local pages deleted by other processes, until cancelled.
+
+        The local tier is cleared whenever the subscription is (re)made,
+        as deletes may have been missed in between.
+        """
+        while True:
+            try:
+                assert self.cache.redis is not None
+                async with self.cache.redis.pubsub() as pubsub:
+                    await pubsub.subscribe(self.CHANNEL)
+                    self.clear_local()
+                    async for msg in pubsub.listen():
+                        if msg['type'] == 'message':
+                            data = msg['data']
+                            for key in (data.decode('utf-8') if isinstance(data, bytes) else data).split('\n'):
+                                self._evict_local(key)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.warning('page cache subscription failed, retrying', exc_info=True)
+            self.clear_local()
+            await asyncio.sleep(retry_delay)
+
+
+class SearchCache:
+    """
+    Cache of search result pages.
+
+    Entries are keyed by the normalized query and page args under the
+    current index generation, which is replaced on every index write and
+    alias swap.  Old entries are never read again, and expire by TTL.
+
+    Concurrent misses for the same entry in a process share one search.
+    """
+    GENERATION_KEY = 'search:generation'
+    _pending: dict[str, asyncio.Task] = {}
+
+    def __init__(self):
+        self.cache = RedisInstance()
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return ' '.join(query.lower().split())
+
+    async def generation(self) -> str:
+        try:
+            return await self.cache.get(self.GENERATION_KEY)
+        except KeyError:
+            return await self.bump()
+
+    async def bump(self, index: str | None = None) -> str:
+        """
+        Start a new generation, invalidating all entries.
+
+        Args:
+            index: index the alias now points at, or None to keep the current one
+
+        Returns:
+            the new generation, as `<index>:<token>`
+        """
+        if index is None:
+            try:
+                index = (await self.cache.get(self.GENERATION_KEY)).rpartition(':')[0]
+            except KeyError:
+                index = ''
+        ret = f'{index}:{uuid.uuid4().hex[:12]}'
+        logging.info('search cache generation %s', ret)
+        await self.cache.set(self.GENERATION_KEY, ret)
+        return ret
+
+    def key(self, generation: str, query: str, **params) -> str:
+        data = json.dumps([self.normalize(query), params], sort_keys=True)
+        return f'search:{generation}:{sha1(data.encode("utf-8")).hexdigest()}'
+
+    async def get(self, query: str, fetch: Callable[[], Awaitable[Any]], ttl: int | None = None, **params) -> Any:
+        """
+        Get a cached search, or run it.
+
+        Falls back to running the search if Redis is unavailable.
+
+        Args:
+            query: query string
+            fetch: runs the search, returning a JSON-serializable result
+            ttl: entry TTL in seconds, by default `ENV.SEARCH_CACHE_TTL`
+            params: other args the result depends on
+        """
+        try:
+            key = self.key(await self.generation(), query, **params)
+            return await self.cache.get(key)
+        except KeyError:
+            pass
+        except Exception:
+            logging.info('error reading search cache', exc_info=True)
+            return await fetch()
+
+        if (task := self._pending.get(key)) is None:
+            task = asyncio.create_task(self._fill(key, fetch, ttl if ttl else ENV.SEARCH_CACHE_TTL))
+            self._pending[key] = task
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fill(self, key: str, fetch: Callable[[], Awaitable[Any]], ttl: int) -> Any:
+        ret = await fetch()
+        try:
+            # jitter expiry, so popular entries don't all expire at once
+            await self.cache.set(key, ret, ttl=max(1, round(ttl * random.uniform(0.9, 1.1))))
+        except Exception:
+            logging.info('error writing search cache', exc_info=True)
+        return ret
@@ -4,6 +4,8 @@ from pathlib import Path
 
 from wipac_dev_tools import from_environment_as_dataclass
 
+VERSION_HASH_MODES = ('full', 'fast', 'sampled')
+
 @dc.dataclass(frozen=True)
 class EnvConfig:
     SOURCE: Path = Path('albums')
@@ -14,13 +16,51 @@ class EnvConfig:
 
     SERVER_HOST: str = 'localhost'
     SERVER_PORT: int = 8080
+    # max upload size, for streamed upload requests and resumable upload sessions
+    UPLOAD_MAX_SIZE: int = 2**31
+    # resumable uploads: default and max chunk size, and how long unfinished uploads are kept
+    UPLOAD_CHUNK_SIZE: int = 8 * 1024 * 1024
+    UPLOAD_CHUNK_MAX_SIZE: int = 64 * 1024 * 1024
+    UPLOAD_SESSION_TTL: int = 7 * 24 * 3600
 
     REDIS_HOST: str = 'localhost'
     REDIS_PORT: int = 6379
+    PAGE_CACHE_TTL: int = 7 * 24 * 3600
+    # max bytes of compressed pages kept in process, in front of Redis
+    PAGE_CACHE_MEMORY: int = 64 * 1024 * 1024
+    # max seconds one process renders a page while the others wait for it
+    PAGE_RENDER_LOCK_TTL: float = 10.
+    # seconds to keep invalidated pages, to serve while re-rendering, or 0 to disable
+    PAGE_STALE_TTL: int = 0
+    # max number of album children rendered per page
+    ALBUM_PAGE_SIZE: int = 500
+    # use and maintain precomputed .album-manifest files
+    ALBUM_MANIFEST: bool = True
+
+    # source watcher mode: auto, inotify, poll, or off
+    WATCH_MODE: str = 'auto'
+    WATCH_POLL_INTERVAL: float = 300.
+    WATCH_DEBOUNCE: float = 1.
+    WATCH_REWARM: bool = True
+    # one server process watches and re-warms, holding a Redis lock renewed within this many seconds
+    WATCH_LEADER_TTL: float = 30.
 
     ES_ADDRESS: str = 'http://localhost:9200'
     ES_INDEX: str = 'gallery'
     ES_CHUNK_SIZE: int = 1000
+    # production index settings, restored after a full rebuild
+    ES_REPLICAS: int = 1
+    ES_REFRESH_INTERVAL: str = '1s'
+    # max number of bulk requests in flight, and tree walker threads, when indexing
+    ES_BULK_CONCURRENCY: int = 4
+    INDEX_WORKERS: int = 8
+    # state file for incremental indexing
+    INDEX_STATE: Path = Path('index-state.json')
+    # max search results per page, and how long a search point-in-time lives between pages
+    SEARCH_PAGE_SIZE: int = 1000
+    SEARCH_KEEP_ALIVE: str = '5m'
+    # seconds to cache first pages of search results, within an index generation
+    SEARCH_CACHE_TTL: int = 60
 
     OPENID_URL: str = 'https://keycloak.icecube.wisc.edu/auth/realms/IceCube'
     OPENID_AUDIENCE: str = ''
@@ -28,11 +68,37 @@ class EnvConfig:
     CI_TEST: bool = False
     LOG_LEVEL: str = 'INFO'
 
+    IMAGE_SIZE_CACHE_SIZE: int = 100000
+    # seconds to keep image sizes in Redis
+    IMAGE_SIZE_CACHE_TTL: int = 30 * 24 * 3600
+    THUMBNAIL_WORKERS: int = 4
+
+    # responsive image derivatives, made on first request or on upload
+    DERIVATIVES: Path = Path('derivatives')
+    DERIVATIVE_WIDTHS: list = dc.field(default_factory=lambda: [320, 1024, 2048])
+    DERIVATIVE_FORMAT: str = 'webp'
+    DERIVATIVE_QUALITY: int = 80
+    METADATA_CONCURRENCY: int = 32
+
     VERSION_HASH_DIGEST_SIZE: int = 20
     VERSION_HASH_PERSON: bytes = b'GalleryVersion'
+    VERSION_CACHE_SIZE: int = 100000
+    # seconds to keep version tokens in Redis, as every change leaves the old key behind
+    VERSION_CACHE_TTL: int = 30 * 24 * 3600
+    VERSION_HASH_WORKERS: int = 8
+    # version hash modes per media type: full, fast, or sampled
+    VERSION_HASH_IMAGE_MODE: str = 'full'
+    VERSION_HASH_VIDEO_MODE: str = 'fast'
+    VERSION_HASH_FILE_MODE: str = 'fast'
+    VERSION_HASH_EDGE_KIB: int = 64
+    VERSION_HASH_SAMPLES: int = 16
+    VERSION_HASH_SAMPLE_KIB: int = 16
 
     def __post_init__(self) -> None:
         object.__setattr__(self, 'LOG_LEVEL', self.LOG_LEVEL.upper())  # b/c frozen
+        for name in ('VERSION_HASH_IMAGE_MODE', 'VERSION_HASH_VIDEO_MODE', 'VERSION_HASH_FILE_MODE'):
+            if getattr(self, name) not in VERSION_HASH_MODES:
+                raise ValueError(f'{name} must be one of {", ".join(VERSION_HASH_MODES)}')
 
 ENV = from_environment_as_dataclass(EnvConfig, collection_sep=',')
 
@@ -15,6 +15,7 @@ var initPhotoSwipeFromDOM = function(gallerySelector) {
       figureEl,
       linkEl,
       size,
+      srcset,
       item,
       orig_src;
 
@@ -41,6 +42,12 @@ var initPhotoSwipeFromDOM = function(gallerySelector) {
           w: parseInt(size[0], 10),
           h: parseInt(size[1], 10)
         };
+        item.origW = item.w;
+        item.origH = item.h;
+        srcset = linkEl.getAttribute('data-srcset');
+        if (srcset) {
+          item.srcset = parseSrcset(srcset);
+        }
       }
       orig_src = figureEl.getAttribute('data-orig');
       if (orig_src !== null && orig_src != "") {
@@ -142,6 +149,36 @@ var initPhotoSwipeFromDOM = function(gallerySelector) {
     return params;
   };
 
+  // parse a srcset into [{src, w}], smallest first
+  var parseSrcset = function(srcset) {
+    var ret = [], parts;
+    srcset.split(',').forEach(function(candidate) {
+      parts = candidate.trim().split(/\s+/);
+      if (parts.length == 2) {
+        ret.push({src: parts[0], w: parseInt(parts[1], 10)});
+      }
+    });
+    return ret.sort(function(a, b) { return a.w - b.w; });
+  };
+
+  // pick the smallest image that fills the screen
+  var chooseSrc = function(item) {
+    var ratio = Math.min(1, window.innerWidth / item.origW, window.innerHeight / item.origH),
+      needed = item.origW * ratio * (window.devicePixelRatio || 1),
+      choice = item.srcset[item.srcset.length - 1];
+    for (var j = 0; j < item.srcset.length; j++) {
+      if (item.srcset[j].w >= needed) {
+        choice = item.srcset[j];
+        break;
+      }
+    }
+    if (item.src != choice.src) {
+      item.src = choice.src;
+      item.w = choice.w;
+      item.h = Math.round(item.origH * choice.w / item.origW);
+    }
+  };
+
   var openPhotoSwipe = function(index, galleryElement, disableAnimation, fromURL) {
     var pswpElement = document.querySelectorAll('.pswp')[0],
       gallery,
@@ -201,6 +238,11 @@ var initPhotoSwipeFromDOM = function(gallerySelector) {
 
     // Pass data to PhotoSwipe and initialize it
     gallery = new PhotoSwipe( pswpElement, PhotoSwipeUI_Default, items, options);
+    gallery.listen('gettingData', function(index, item) {
+      if (item.srcset) {
+        chooseSrc(item);
+      }
+    });
     gallery.init();
   };
 
@@ -221,3 +263,133 @@ var initPhotoSwipeFromDOM = function(gallerySelector) {
 
 // execute above function
 initPhotoSwipeFromDOM('.gallery_pswp');
+
+// load the rest of a paged album as the user scrolls
+var initAlbumScroll = function() {
+  var more = document.getElementById('album-more');
+  if (more === null || !('IntersectionObserver' in window) || !('fetch' in window)) {
+    return;
+  }
+
+  var api = more.getAttribute('data-api'),
+    offset = parseInt(more.getAttribute('data-offset'), 10),
+    limit = parseInt(more.getAttribute('data-limit'), 10),
+    total = parseInt(more.getAttribute('data-total'), 10),
+    loading = false,
+    observer;
+
+  // page links are replaced by scrolling
+  more.innerHTML = '';
+
+  var escapeHtml = function(s) {
+    return String(s).replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;').replace(/"/g, '&quot;').replace(/'/g, '&#39;');
+  };
+
+  var el = function(tag, attrs, children) {
+    var e = document.createElement(tag);
+    for (var k in attrs) {
+      e.setAttribute(k, attrs[k]);
+    }
+    for (var i = 0; i < (children || []).length; i++) {
+      var c = children[i];
+      e.appendChild(typeof c === 'string' ? document.createTextNode(c) : c);
+    }
+    return e;
+  };
+
+  // list of text lines separated by <br>
+  var lines = function(parts) {
+    var ret = [];
+    for (var i = 0; i < parts.length; i++) {
+      if (i > 0) {
+        ret.push(el('br'));
+      }
+      ret.push(parts[i]);
+    }
+    return ret;
+  };
+
+  var show = function(id) {
+    var list = document.getElementById(id);
+    list.hidden = false;
+    list.previousElementSibling.hidden = false;
+    return list;
+  };
+
+  var caption = function(item) {
+    var parts = [el('span', {'class': 'title'}, [item.title])];
+    if (item.summary) {
+      parts.push(item.summary);
+    }
+    return lines(parts);
+  };
+
+  var addItem = function(item) {
+    var thumb = el('img', {'src': '/static/echo/blank.gif', 'data-echo': item.thumbnail, 'alt': item.url, 'itemprop': 'thumbnail', 'title': item.title}),
+      link;
+    if (item.type == 'album') {
+      show('album-albums').appendChild(el('div', {'id': item.name, 'class': 'menu-img thumbnail'}, [
+        el('a', {'href': item.url}, [el('img', {'src': item.thumbnail, 'class': 'album_thumb', 'alt': item.title, 'title': item.title})]),
+        el('div', {'class': 'caption'}, caption(item))
+      ]));
+    } else if (item.type == 'image') {
+      link = el('a', {'href': item.url, 'itemprop': 'contentUrl', 'data-size': item.width + 'x' + item.height, 'data-srcset': item.srcset}, [thumb]);
+      show('album-images').appendChild(el('figure', {'id': item.name, 'class': 'gallery__img--secondary thumbnail', 'itemprop': 'associatedMedia', 'itemscope': '', 'itemtype': 'http://schema.org/ImageObject', 'data-orig': item.url}, [
+        link,
+        el('div', {'class': 'lightbox_caption', 'itemprop': 'caption description'}, lines([item.title].concat(item.summary ? [item.summary] : [], [item.description]))),
+        el('figcaption', {}, caption(item))
+      ]));
+    } else if (item.type == 'video') {
+      link = el('a', {'href': item.url, 'itemprop': 'contentUrl', 'data-type': 'video',
+        'data-video': '<div class="video"><div class="video__container"><video controls><source src="' + escapeHtml(item.url) + '" type="' + escapeHtml(item.mime) + '" /></video></div></div>'}, [
+        el('div', {'class': 'video-overlay'}, [el('span', {'class': 'material-icons'}, ['play_circle_outline'])]),
+        thumb
+      ]);
+      show('album-videos').appendChild(el('figure', {'id': item.name, 'class': 'gallery__img--secondary thumbnail video', 'itemprop': 'associatedMedia', 'itemscope': '', 'itemtype': 'http://schema.org/ImageObject', 'data-orig': item.url}, [
+        link,
+        el('div', {'class': 'lightbox_caption', 'itemprop': 'caption description'}, lines([item.title, item.description])),
+        el('figcaption', {}, caption(item))
+      ]));
+    } else {
+      show('album-files').appendChild(el('figure', {'id': item.name, 'class': 'gallery__img--secondary thumbnail file'}, [
+        el('a', {'href': item.url, 'target': '_blank'}, [thumb]),
+        el('div', {'class': 'lightbox_caption', 'itemprop': 'caption description'}, lines([item.title, item.description])),
+        el('figcaption', {}, caption(item))
+      ]));
+    }
+  };
+
+  var load = function() {
+    if (loading || offset >= total) {
+      return;
+    }
+    loading = true;
+    fetch(api + '?offset=' + offset + '&limit=' + limit, {credentials: 'same-origin'})
+      .then(function(response) {
+        return response.json();
+      })
+      .then(function(data) {
+        for (var i = 0; i < data.items.length; i++) {
+          addItem(data.items[i]);
+        }
+        offset = data.items.length ? offset + data.items.length : total;
+        loading = false;
+        echo.render();
+        // re-observe, in case the end of the page is still visible
+        observer.unobserve(more);
+        observer.observe(more);
+      })
+      .catch(function() {
+        loading = false;
+      });
+  };
+
+  observer = new IntersectionObserver(function(entries) {
+    if (entries[0].isIntersecting) {
+      load();
+    }
+  }, {rootMargin: '500px'});
+  observer.observe(more);
+};
+
+initAlbumScroll();
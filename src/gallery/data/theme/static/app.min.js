@@ -1,5 +1,5 @@
-echo.init({offset:100,throttle:250,unload:false});var initPhotoSwipeFromDOM=function(gallerySelector){var parseThumbnailElements=function(el){var thumbElements=el.childNodes,numNodes=thumbElements.length,items=[],figureEl,linkEl,size,item,orig_src;for(var i=0;i<numNodes;i++){figureEl=thumbElements[i];if(figureEl.nodeType!==1){continue;}
-linkEl=figureEl.children[0];if(linkEl.getAttribute('data-type')=='video'){item={html:linkEl.getAttribute('data-video')};}else{size=linkEl.getAttribute('data-size').split('x');item={src:linkEl.getAttribute('href'),w:parseInt(size[0],10),h:parseInt(size[1],10)};}
+echo.init({offset:100,throttle:250,unload:false});var initPhotoSwipeFromDOM=function(gallerySelector){var parseThumbnailElements=function(el){var thumbElements=el.childNodes,numNodes=thumbElements.length,items=[],figureEl,linkEl,size,srcset,item,orig_src;for(var i=0;i<numNodes;i++){figureEl=thumbElements[i];if(figureEl.nodeType!==1){continue;}
+linkEl=figureEl.children[0];if(linkEl.getAttribute('data-type')=='video'){item={html:linkEl.getAttribute('data-video')};}else{size=linkEl.getAttribute('data-size').split('x');item={src:linkEl.getAttribute('href'),w:parseInt(size[0],10),h:parseInt(size[1],10)};item.origW=item.w;item.origH=item.h;srcset=linkEl.getAttribute('data-srcset');if(srcset){item.srcset=parseSrcset(srcset);}}
 orig_src=figureEl.getAttribute('data-orig');if(orig_src!==null&&orig_src!=""){item.orig_src=orig_src;}
 if(figureEl.children.length>1){item.title=figureEl.children[1].innerHTML;}
 if(linkEl.children.length>0){item.msrc=linkEl.children[0].getAttribute('data-echo');}
@@ -14,8 +14,17 @@ var vars=hash.split('&');for(var i=0;i<vars.length;i++){if(!vars[i]){continue;}
 var pair=vars[i].split('=');if(pair.length<2){continue;}
 params[pair[0]]=pair[1];}
 if(params.gid){params.gid=parseInt(params.gid,10);}
-return params;};var openPhotoSwipe=function(index,galleryElement,disableAnimation,fromURL){var pswpElement=document.querySelectorAll('.pswp')[0],gallery,options,items;items=parseThumbnailElements(galleryElement);options={galleryUID:galleryElement.getAttribute('data-pswp-uid'),getThumbBoundsFn:function(index){var thumbnail=items[index].el.getElementsByTagName('img')[0],pageYScroll=window.pageYOffset||document.documentElement.scrollTop,rect=thumbnail.getBoundingClientRect();return{x:rect.left,y:rect.top+pageYScroll,w:rect.width};},shareButtons:[{id:'download',label:'Download Media',url:'{{raw_image_url}}',download:true}]};if(fromURL){if(options.galleryPIDs){for(var j=0;j<items.length;j++){if(items[j].pid==index){options.index=j;break;}}}else{options.index=parseInt(index,10)-1;}}else{options.index=parseInt(index,10);}
+return params;};var parseSrcset=function(srcset){var ret=[],parts;srcset.split(',').forEach(function(candidate){parts=candidate.trim().split(/\s+/);if(parts.length==2){ret.push({src:parts[0],w:parseInt(parts[1],10)});}});return ret.sort(function(a,b){return a.w-b.w;});};var chooseSrc=function(item){var ratio=Math.min(1,window.innerWidth/item.origW,window.innerHeight/item.origH),needed=item.origW*ratio*(window.devicePixelRatio||1),choice=item.srcset[item.srcset.length-1];for(var j=0;j<item.srcset.length;j++){if(item.srcset[j].w>=needed){choice=item.srcset[j];break;}}
+if(item.src!=choice.src){item.src=choice.src;item.w=choice.w;item.h=Math.round(item.origH*choice.w/item.origW);}};var openPhotoSwipe=function(index,galleryElement,disableAnimation,fromURL){var pswpElement=document.querySelectorAll('.pswp')[0],gallery,options,items;items=parseThumbnailElements(galleryElement);options={galleryUID:galleryElement.getAttribute('data-pswp-uid'),getThumbBoundsFn:function(index){var thumbnail=items[index].el.getElementsByTagName('img')[0],pageYScroll=window.pageYOffset||document.documentElement.scrollTop,rect=thumbnail.getBoundingClientRect();return{x:rect.left,y:rect.top+pageYScroll,w:rect.width};},shareButtons:[{id:'download',label:'Download Media',url:'{{raw_image_url}}',download:true}]};if(fromURL){if(options.galleryPIDs){for(var j=0;j<items.length;j++){if(items[j].pid==index){options.index=j;break;}}}else{options.index=parseInt(index,10)-1;}}else{options.index=parseInt(index,10);}
 if(isNaN(options.index)){return;}
 if(disableAnimation){options.showAnimationDuration=0;}
-gallery=new PhotoSwipe(pswpElement,PhotoSwipeUI_Default,items,options);gallery.init();};var galleryElements=document.querySelectorAll(gallerySelector);for(var i=0,l=galleryElements.length;i<l;i++){galleryElements[i].setAttribute('data-pswp-uid',i+1);galleryElements[i].onclick=onThumbnailsClick;}
-var hashData=photoswipeParseHash();if(hashData.pid&&hashData.gid){openPhotoSwipe(hashData.pid,galleryElements[hashData.gid-1],true,true);}};initPhotoSwipeFromDOM('.gallery_pswp');
\ No newline at end of file
+gallery=new PhotoSwipe(pswpElement,PhotoSwipeUI_Default,items,options);gallery.listen('gettingData',function(index,item){if(item.srcset){chooseSrc(item);}});gallery.init();};var galleryElements=document.querySelectorAll(gallerySelector);for(var i=0,l=galleryElements.length;i<l;i++){galleryElements[i].setAttribute('data-pswp-uid',i+1);galleryElements[i].onclick=onThumbnailsClick;}
+var hashData=photoswipeParseHash();if(hashData.pid&&hashData.gid){openPhotoSwipe(hashData.pid,galleryElements[hashData.gid-1],true,true);}};initPhotoSwipeFromDOM('.gallery_pswp');var initAlbumScroll=function(){var more=document.getElementById('album-more');if(more===null||!('IntersectionObserver'in window)||!('fetch'in window)){return;}
+var api=more.getAttribute('data-api'),offset=parseInt(more.getAttribute('data-offset'),10),limit=parseInt(more.getAttribute('data-limit'),10),total=parseInt(more.getAttribute('data-total'),10),loading=false,observer;more.innerHTML='';var escapeHtml=function(s){return String(s).replace(/&/g,'&amp;').replace(/</g,'&lt;').replace(/>/g,'&gt;').replace(/"/g,'&quot;').replace(/'/g,'&#39;');};var el=function(tag,attrs,children){var e=document.createElement(tag);for(var k in attrs){e.setAttribute(k,attrs[k]);}
+for(var i=0;i<(children||[]).length;i++){var c=children[i];e.appendChild(typeof c==='string'?document.createTextNode(c):c);}
+return e;};var lines=function(parts){var ret=[];for(var i=0;i<parts.length;i++){if(i>0){ret.push(el('br'));}
+ret.push(parts[i]);}
+return ret;};var show=function(id){var list=document.getElementById(id);list.hidden=false;list.previousElementSibling.hidden=false;return list;};var caption=function(item){var parts=[el('span',{'class':'title'},[item.title])];if(item.summary){parts.push(item.summary);}
+return lines(parts);};var addItem=function(item){var thumb=el('img',{'src':'/static/echo/blank.gif','data-echo':item.thumbnail,'alt':item.url,'itemprop':'thumbnail','title':item.title}),link;if(item.type=='album'){show('album-albums').appendChild(el('div',{'id':item.name,'class':'menu-img thumbnail'},[el('a',{'href':item.url},[el('img',{'src':item.thumbnail,'class':'album_thumb','alt':item.title,'title':item.title})]),el('div',{'class':'caption'},caption(item))]));}else if(item.type=='image'){link=el('a',{'href':item.url,'itemprop':'contentUrl','data-size':item.width+'x'+item.height,'data-srcset':item.srcset},[thumb]);show('album-images').appendChild(el('figure',{'id':item.name,'class':'gallery__img--secondary thumbnail','itemprop':'associatedMedia','itemscope':'','itemtype':'http://schema.org/ImageObject','data-orig':item.url},[link,el('div',{'class':'lightbox_caption','itemprop':'caption description'},lines([item.title].concat(item.summary?[item.summary]:[],[item.description]))),el('figcaption',{},caption(item))]));}else if(item.type=='video'){link=el('a',{'href':item.url,'itemprop':'contentUrl','data-type':'video','data-video':'<div class="video"><div class="video__container"><video controls><source src="'+escapeHtml(item.url)+'" type="'+escapeHtml(item.mime)+'" /></video></div></div>'},[el('div',{'class':'video-overlay'},[el('span',{'class':'material-icons'},['play_circle_outline'])]),thumb]);show('album-videos').appendChild(el('figure',{'id':item.name,'class':'gallery__img--secondary thumbnail video','itemprop':'associatedMedia','itemscope':'','itemtype':'http://schema.org/ImageObject','data-orig':item.url},[link,el('div',{'class':'lightbox_caption','itemprop':'caption description'},lines([item.title,item.description])),el('figcaption',{},caption(item))]));}else{show('album-files').appendChild(el('figure',{'id':item.name,'class':'gallery__img--secondary thumbnail file'},[el('a',{'href':item.url,'target':'_blank'},[thumb]),el('div',{'class':'lightbox_caption','itemprop':'caption description'},lines([item.title,item.description])),el('figcaption',{},caption(item))]));}};var load=function(){if(loading||offset>=total){return;}
+loading=true;fetch(api+'?offset='+offset+'&limit='+limit,{credentials:'same-origin'}).then(function(response){return response.json();}).then(function(data){for(var i=0;i<data.items.length;i++){addItem(data.items[i]);}
+offset=data.items.length?offset+data.items.length:total;loading=false;echo.render();observer.unobserve(more);observer.observe(more);}).catch(function(){loading=false;});};observer=new IntersectionObserver(function(entries){if(entries[0].isIntersecting){load();}},{rootMargin:'500px'});observer.observe(more);};initAlbumScroll();
\ No newline at end of file
@@ -0,0 +1,280 @@
+"""
+Cache image dimensions, so albums don't open every image with PIL.
+
+Dimensions are keyed on (path, mtime, size).  They are stored in the
+`.meta.json` sidecar on upload or edit, and in expiring Redis keys for
+everything else.  Run as a command to backfill the existing tree.
+"""
+import argparse
+import asyncio
+from collections import OrderedDict
+import logging
+import os
+from pathlib import Path
+import threading
+from typing import Any
+
+from PIL import Image
+
+from .caching import RedisInstance
+from .config import ENV, config_logging
+from .util import get_type, read_metadata, write_metadata
+
+
+IMAGE_SIZE_KEY = 'image_size'
+REDIS_PREFIX = 'image-size:'
+
+
+def read_image_size(path: Path) -> tuple[int, int]:
+    """Open an image with PIL to get its size."""
+    try:
+        with Image.open(str(path)) as img:
+            return img.size
+    except Exception:
+        logging.info('cannot get size of image at %s', path)
+        return (150, 150)
+
+
+def sidecar_image_size(meta: dict[str, Any] | None, st: os.stat_result) -> tuple[int, int] | None:
+    """Get the size of an image from its sidecar metadata, if recorded for the current file."""
+    if meta and (entry := meta.get(IMAGE_SIZE_KEY)):
+        if entry.get('mtime') == st.st_mtime_ns and entry.get('size') == st.st_size:
+            return (entry['width'], entry['height'])
+    return None
+
+
+def image_size_meta(path: Path) -> dict[str, int]:
+    """Get the sidecar entry for an image's size."""
+    st = path.stat()
+    width, height = read_image_size(path)
+    return {'width': width, 'height': height, 'mtime': st.st_mtime_ns, 'size': st.st_size}
+
+
+class ImageSizeCache:
+    """
+    Cache of image dimensions.
+
+    Lookups check the sidecar metadata first, then an in-process LRU
+    that is filled from Redis by `preload`.  Only on a miss is the image
+    opened, and new sizes are written back to Redis by `flush`.  Redis
+    entries are per image, and expire after `ENV.IMAGE_SIZE_CACHE_TTL`.
+
+    `get` may be called from worker threads (albums are built off the
+    event loop); the async methods run on the loop.
+
+    Args:
+        maxsize: max number of entries in the in-process LRU
+    """
+    def __init__(self, maxsize: int = ENV.IMAGE_SIZE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.lru: OrderedDict[str, list[int]] = OrderedDict()
+        self.pending: dict[str, list[int]] = {}
+        self.stats = {'hits': 0, 'redis_hits': 0, 'misses': 0}
+        self.redis = RedisInstance()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _field(path: Path) -> str:
+        try:
+            return str(path.relative_to(ENV.SOURCE))
+        except ValueError:
+            return str(path)
+
+    @staticmethod
+    def key(field: str) -> str:
+        return REDIS_PREFIX + field
+
+    def _set_local(self, field: str, val: list[int]):
+        # call with self._lock held
+        self.lru[field] = val
+        self.lru.move_to_end(field)
+        while len(self.lru) > self.maxsize:
+            self.lru.popitem(last=False)
+
+    def get(self, path: Path, meta: dict[str, Any] | None = None) -> tuple[int, int]:
+        """
+        Get the size of an image, only opening it on a cache miss.
+
+        Args:
+            path: image path
+            meta: the image's sidecar metadata, if already read
+
+        Returns:
+            (width, height)
+        """
+        try:
+            st = path.stat()
+        except OSError:
+            logging.info('cannot get size of image at %s', path)
+            return (150, 150)
+
+        field = self._field(path)
+        with self._lock:
+            if ret := sidecar_image_size(meta, st):
+                self.stats['hits'] += 1
+                return ret
+            val = self.lru.get(field)
+            if val and val[0] == st.st_mtime_ns and val[1] == st.st_size:
+                self.stats['hits'] += 1
+                self.lru.move_to_end(field)
+                return (val[2], val[3])
+            self.stats['misses'] += 1
+
+        width, height = read_image_size(path)
+        val = [st.st_mtime_ns, st.st_size, width, height]
+        with self._lock:
+            self._set_local(field, val)
+            self.pending[field] = val
+        return (width, height)
+
+    async def lookup(self, path: Path, st: os.stat_result) -> tuple[int, int] | None:
+        """
+        Get the size of an image from the LRU or Redis, without opening it.
+
+        Returns:
+            (width, height), or None if not cached for the current file
+        """
+        field = self._field(path)
+        with self._lock:
+            val = self.lru.get(field)
+        if not val:
+            try:
+                val = await self.redis.get(self.key(field))
+            except KeyError:
+                val = None
+            except Exception:
+                logging.debug('cannot get cached image size', exc_info=True)
+                val = None
+            if val:
+                with self._lock:
+                    self.stats['redis_hits'] += 1
+                    self._set_local(field, val)
+        with self._lock:
+            if val and val[0] == st.st_mtime_ns and val[1] == st.st_size:
+                self.stats['hits'] += 1
+                if field in self.lru:
+                    self.lru.move_to_end(field)
+                return (val[2], val[3])
+            self.stats['misses'] += 1
+        return None
+
+    async def store(self, path: Path, st: os.stat_result, size: tuple[int, int], batch_size: int = 1000):
+        """Cache the size of an image read elsewhere, flushing to Redis every `batch_size` sizes."""
+        field = self._field(path)
+        val = [st.st_mtime_ns, st.st_size, size[0], size[1]]
+        with self._lock:
+            self._set_local(field, val)
+            self.pending[field] = val
+            full = len(self.pending) >= batch_size
+        if full:
+            await self.flush()
+
+    async def preload(self, album_path: Path, names: list[str] | None = None):
+        """
+        Pull any sizes Redis has for images in an album into the local LRU.
+
+        Args:
+            album_path: album file path
+            names: names of the images to preload, if already listed, or None to scan the album
+        """
+        def scan():
+            with os.scandir(album_path) as it:
+                return [e.name for e in it if get_type(Path(e.name)) == 'image']
+
+        if names is None:
+            names = await asyncio.to_thread(scan)
+        fields = [self._field(album_path / name) for name in names]
+        with self._lock:
+            fields = [f for f in fields if f not in self.lru]
+        if not fields:
+            return
+        try:
+            values = await self.redis.get_many([self.key(f) for f in fields])
+        except Exception:
+            logging.debug('cannot get cached image sizes', exc_info=True)
+            return
+        with self._lock:
+            for field in fields:
+                if val := values.get(self.key(field)):
+                    self.stats['redis_hits'] += 1
+                    self._set_local(field, val)
+
+    async def flush(self):
+        """Write new sizes back to Redis."""
+        with self._lock:
+            if not self.pending:
+                return
+            pending = dict(self.pending)
+            self.pending.clear()
+        try:
+            await self.redis.set_many({self.key(f): v for f, v in pending.items()}, ttl=ENV.IMAGE_SIZE_CACHE_TTL)
+        except Exception:
+            logging.debug('cannot cache image sizes', exc_info=True)
+
+
+async def backfill(root: Path, sidecar: bool = False, batch_size: int = 1000, concurrency: int = 8):
+    """
+    Backfill the image size cache for a whole tree.
+
+    Args:
+        root: album root
+        sidecar: also write sizes to the `.meta.json` sidecars
+        batch_size: number of sizes to write to Redis at once
+        concurrency: max number of images to open at once
+    """
+    from .albums import HIDDEN_PREFIXES  # albums imports this module
+
+    def read(path: Path) -> dict[str, int]:
+        entry = image_size_meta(path)
+        if sidecar:
+            meta = read_metadata(path)
+            meta[IMAGE_SIZE_KEY] = entry
+            write_metadata(path, meta)
+        return entry
+
+    sem = asyncio.Semaphore(concurrency)
+
+    async def backfill_one(path: Path) -> tuple[str, list[int]]:
+        async with sem:
+            entry = await asyncio.to_thread(read, path)
+        logging.info('image size for %s: %dx%d', path, entry['width'], entry['height'])
+        return ImageSizeCache.key(ImageSizeCache._field(path)), [entry['mtime'], entry['size'], entry['width'], entry['height']]
+
+    redis = RedisInstance()
+    batch = {}
+    count = 0
+    walk = os.walk(root)
+    while item := await asyncio.to_thread(next, walk, None):
+        dirpath, dirs, files = item
+        dirs[:] = [d for d in dirs if d != 'thumbnails' and not d.startswith(HIDDEN_PREFIXES)]
+        paths = [Path(dirpath) / f for f in files if not f.startswith(HIDDEN_PREFIXES)]
+        paths = [path for path in paths if get_type(path) == 'image']
+        for i in range(0, len(paths), batch_size):
+            batch.update(await asyncio.gather(*(backfill_one(path) for path in paths[i:i+batch_size])))
+            count += len(paths[i:i+batch_size])
+            if len(batch) >= batch_size:
+                await redis.set_many(batch, ttl=ENV.IMAGE_SIZE_CACHE_TTL)
+                batch = {}
+    if batch:
+        await redis.set_many(batch, ttl=ENV.IMAGE_SIZE_CACHE_TTL)
+    logging.info('backfilled %d image sizes', count)
+
+
+async def main():
+    config_logging()
+
+    parser = argparse.ArgumentParser(description='Backfill the image size cache')
+    parser.add_argument('--root', type=Path, default=ENV.SOURCE, help="album root")
+    parser.add_argument('--sidecar', action='store_true', help='also write sizes to .meta.json sidecars')
+    parser.add_argument('--concurrency', type=int, default=8, help='max number of images to open at once')
+    args = parser.parse_args()
+
+    redis = RedisInstance()
+    try:
+        await backfill(args.root, sidecar=args.sidecar, concurrency=args.concurrency)
+    finally:
+        await redis.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
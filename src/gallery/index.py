@@ -1,46 +1,177 @@
-"""Index images in ElasticSearch"""
+"""
+Index images in ElasticSearch
+
+A full run builds a new index and swaps the alias over to it.  An
+incremental run compares the tree against a state file of what was
+indexed last time, and only sends the changes to the live alias.
+
+Docs also store what search results are rendered from (thumbnail,
+media type, mime, dimensions, and version tokens), so the search page
+never touches the filesystem.
+"""
 
 import argparse
 import asyncio
+import base64
+import binascii
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from datetime import datetime
 import hashlib
+import json
 import logging
+import os
 from pathlib import Path
 import re
-from typing import Any, cast
+import threading
+import time
+from typing import Any, Callable, Iterable, Iterator, cast
 
 
-from elasticsearch import AsyncElasticsearch, BadRequestError
+from elasticsearch import AsyncElasticsearch, BadRequestError, NotFoundError
 from elasticsearch.client import IndicesClient
 from elasticsearch.helpers import async_streaming_bulk
 
+from .albums import HIDDEN_PREFIXES, get_thumbnail
+from .caching import RedisInstance, SearchCache
 from .config import ENV, config_logging
-from .util import read_metadata, get_type, now
+from .dimensions import ImageSizeCache, read_image_size, sidecar_image_size
+from .util import json_loads, read_metadata, get_mime, get_type, now
+from .versions import VersionCache
+
+
+# bump when the doc format changes, so incremental runs reindex everything
+STATE_VERSION = 3
 
 
 def hash(s):
     return re.sub(r'[ \;\"\*\+\/\\\|\?\#\>\<]','', s).lower()
 
 
+def doc_id(doc_path: str) -> str:
+    return hashlib.sha1(doc_path.encode('utf8')).hexdigest()
+
+
+def encode_cursor(pit: str, search_after: list, offset: int) -> str:
+    """Encode the position of the next search page as an opaque url-safe string."""
+    data = json.dumps({'pit': pit, 'after': search_after, 'offset': offset}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple[str, list, int]:
+    """
+    Decode a search cursor, raising ValueError if it is malformed.
+
+    Returns:
+        (point-in-time id or '' for none yet, search_after sort values, offset)
+    """
+    try:
+        data = json_loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return str(data['pit']), list(data['after']), int(data['offset'])
+    except (binascii.Error, KeyError, TypeError) as e:
+        raise ValueError('bad search cursor') from e
+
+
+def load_state(path: Path, index: str) -> dict[str, list[int]]:
+    """
+    Load the incremental index state.
+
+    Returns:
+        dict of doc id: [mtime, size, sidecar mtime], empty if missing or for a different index.
+        For albums, the mtime is that of their `thumbnails` dir, and the size is 0.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = json_loads(f.read())
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        logging.warning('bad index state file %s', path, exc_info=True)
+        return {}
+    if data.get('version') != STATE_VERSION or data.get('index') != index:
+        logging.info('index state file %s is for a different index', path)
+        return {}
+    return data['docs']
+
+
+def save_state(path: Path, index: str, docs: dict[str, list[int]]):
+    """Atomically write the incremental index state."""
+    tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': STATE_VERSION, 'index': index, 'docs': docs}, f, separators=(',', ':'))
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
 
 class Indexer:
-    def __init__(self, es, es_index):
+    """
+    Index albums and media in ElasticSearch.
+
+    Args:
+        es: ElasticSearch client
+        es_index: index alias
+        version_cache: version cache to get the version tokens stored in docs, if any
+        search_cache: search cache to invalidate on writes, if any
+        image_sizes: image size cache to look up dimensions in before opening images, if any
+    """
+    def __init__(self, es, es_index, version_cache: VersionCache | None = None, search_cache: SearchCache | None = None,
+                 image_sizes: ImageSizeCache | None = None):
         self.es = es
         self.es_index = es_index
         self.index_name = es_index
+        self.version_cache = version_cache
+        self.search_cache = search_cache
+        self.image_sizes = image_sizes
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self._refresh_task: asyncio.Task | None = None
+        self._refresh_pending = False
 
     @asynccontextmanager
-    async def swap_index(self):
+    async def swap_index(self, force_merge: bool = False):
+        """
+        Build a new index, then point the alias at it.
+
+        The index is created tuned for bulk loading, without refreshes or
+        replicas, and gets the production settings back once loaded.  If
+        loading fails, the new index is removed and the alias left alone.
+
+        Args:
+            force_merge: force merge the new index down to one segment before swapping
+
+        Yields:
+            stats dict, filled with the doc count and the time taken by each phase
+        """
         ic = cast(Any, IndicesClient(client=self.es))
         index_name = f'{self.es_index}-{now().strftime("%Y%m%dt%H%M%S")}'
+        stats: dict[str, Any] = {'index': index_name}
+
+        @asynccontextmanager
+        async def phase(name):
+            start = time.monotonic()
+            yield
+            stats[f'{name}_seconds'] = round(time.monotonic() - start, 3)
+            logging.info('%s %s took %.1fs', name, index_name, stats[f'{name}_seconds'])
 
         # create index
         try:
             await ic.create(index=index_name, body={
+                'settings': {
+                    'index': {
+                        'refresh_interval': '-1',
+                        'number_of_replicas': 0,
+                        'translog': {
+                            'durability': 'async',
+                            'flush_threshold_size': '1gb',
+                        },
+                    },
+                },
                 'mappings': {
                     'properties': {
-                        'path': {'type': 'text'},
+                        # the keyword is only for sorting, as a unique search tiebreaker
+                        'path': {'type': 'text', 'fields': {'sort': {'type': 'keyword', 'index': False, 'ignore_above': 8191}}},
                         'title': {'type': 'text'},
                         'keywords': {'type': 'text'},
                         'summary': {'type': 'text'},
@@ -49,6 +180,13 @@ class Indexer:
                         'moddate': {'type': 'date', 'format': 'strict_date_optional_time||epoch_second'},
                         'date': {'type': 'text'},
                         'type': {'type': 'text'},
+                        # only used to render results
+                        'thumbnail': {'type': 'keyword', 'index': False},
+                        'mime': {'type': 'keyword', 'index': False},
+                        'width': {'type': 'integer', 'index': False},
+                        'height': {'type': 'integer', 'index': False},
+                        'src_version': {'type': 'keyword', 'index': False},
+                        'thumbnail_version': {'type': 'keyword', 'index': False},
                     }
                 }
             }) 
@@ -58,10 +196,36 @@ class Indexer:
 
         try:
             self.index_name = index_name
-            yield
+            async with phase('load'):
+                yield stats
+        except BaseException:
+            logging.warning('failed to build %s, removing it', index_name)
+            await ic.delete(index=index_name)
+            raise
         finally:
             self.index_name = self.es_index
 
+        # restore production settings
+        async with phase('restore'):
+            await ic.put_settings(index=index_name, settings={
+                'index': {
+                    'refresh_interval': ENV.ES_REFRESH_INTERVAL,
+                    'number_of_replicas': ENV.ES_REPLICAS,
+                    'translog': {
+                        'durability': 'request',
+                        'flush_threshold_size': None,
+                    },
+                },
+            })
+        async with phase('refresh'):
+            await ic.refresh(index=index_name)
+        if force_merge:
+            async with phase('merge'):
+                merge_ic = cast(Any, IndicesClient(client=self.es.options(request_timeout=3600)))
+                await merge_ic.forcemerge(index=index_name, max_num_segments=1)
+        stats['count'] = (await self.es.count(index=index_name))['count']
+
+        async with phase('swap'):
             # swap alias
             if await ic.exists_alias(name=self.es_index):
                 await ic.delete_alias(index='_all', name=self.es_index)
@@ -72,18 +236,106 @@ class Indexer:
             for index in ret:
                 if index not in (self.es_index, index_name):
                     await ic.delete(index=index)
+        await self._invalidate(index_name)
+        logging.info('built %s with %d docs: %r', index_name, stats['count'], stats)
+
+    async def _invalidate(self, index: str | None = None):
+        """Invalidate cached searches after a write, or an alias swap to `index`."""
+        if not self.search_cache:
+            return
+        try:
+            await self.search_cache.bump(index)
+        except Exception:
+            logging.warning('cannot invalidate the search cache', exc_info=True)
+
+    def _schedule_refresh(self):
+        """
+        Refresh the index in the background, then invalidate cached searches again.
+
+        Searches between a write and the next refresh can cache stale
+        results, so they are dropped once the write is searchable.
+        Writes during a refresh are covered by one more refresh.
+        """
+        if not self.search_cache:
+            return
+        self._refresh_pending = True
+        if not self._refresh_task or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh())
+
+    async def _refresh(self):
+        while self._refresh_pending:
+            self._refresh_pending = False
+            try:
+                await self.es.options(request_timeout=5).indices.refresh(index=self.index_name)
+            except Exception:
+                logging.warning('cannot refresh the index', exc_info=True)
+            await self._invalidate()
+
+    def _on_worker_thread(self) -> bool:
+        """Whether async caches can be run on the indexer's event loop from here."""
+        if not self.loop:
+            return False
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return True
+        return False
+
+    def _versions(self, urls: list[str]) -> dict[str, str]:
+        """
+        Get version tokens for `/_src` urls from a worker thread.
+
+        The version cache is async, so it is run on the indexer's event
+        loop, which must not be the calling thread.
+        """
+        if not self.version_cache or not urls:
+            return {}
+        if not self._on_worker_thread():
+            logging.debug('not on a worker thread, so leaving out version tokens')
+            return {}
+        assert self.loop
+        fut = asyncio.run_coroutine_threadsafe(self.version_cache.get_urls(urls), self.loop)
+        return fut.result()
 
-    def index_metadata(self, path: Path, meta: dict | None = None) -> dict[str, Any]:
+    def _image_size(self, path: Path, meta: dict[str, Any]) -> tuple[int, int]:
+        """
+        Get the size of an image from a worker thread.
+
+        Checks the sidecar, then the image size cache on the indexer's
+        event loop, and only opens the image if neither has it.
+        """
+        st = path.stat()
+        if ret := sidecar_image_size(meta, st):
+            return ret
+        cache = self.image_sizes if self._on_worker_thread() else None
+        if cache:
+            assert self.loop
+            if ret := asyncio.run_coroutine_threadsafe(cache.lookup(path, st), self.loop).result():
+                return ret
+        ret = read_image_size(path)
+        if cache:
+            assert self.loop
+            asyncio.run_coroutine_threadsafe(cache.store(path, st, ret), self.loop).result()
+        return ret
+
+    def index_metadata(self, path: Path, meta: dict | None = None, is_dir: bool | None = None, has_sidecar: bool | None = None) -> dict[str, Any]:
+        """
+        Make the doc for an album or media file.
+
+        Blocks on filesystem access, so call it from a worker thread.
+        """
         root_path = ENV.SOURCE
         doc_path = str(path.relative_to(root_path))
         doc = {
             '_index': self.index_name,
-            '_id': hashlib.sha1(doc_path.encode('utf8')).hexdigest(),
+            '_id': doc_id(doc_path),
             'path': doc_path,
         }
 
+        if is_dir is None:
+            is_dir = path.is_dir()
         if not meta:
-            meta = read_metadata(path)
+            meta = read_metadata(path, is_dir=is_dir, exists=has_sidecar)
         for key in ('title', 'summary', 'keywords', 'description', 'user'):
             if value := meta.get(key, '').strip():
                 doc[key] = str(value)
@@ -95,7 +347,7 @@ class Indexer:
                 logging.error("bad createdate: %r", createdate)
                 raise
 
-        if path.is_dir():
+        if is_dir:
             doc['type'] = 'Album'
         else:
             type_ = get_type(path)
@@ -106,66 +358,357 @@ class Indexer:
             else:
                 doc['type'] = 'Other Media'
 
+        # what search results are rendered from, as in `AlbumItem` and `Media`
+        rel = Path(doc_path)
+        src = str(Path('/_src') / rel)
+        if 'thumbnail' in meta:
+            doc['thumbnail'] = str(Path('/_src') / (rel if is_dir else rel.parent) / meta['thumbnail'])
+        else:
+            doc['thumbnail'] = get_thumbnail(path, is_dir=is_dir)
+        urls = [doc['thumbnail']]
+        if not is_dir:
+            doc['mime'] = get_mime(path)
+            if doc['type'] == 'Image':
+                doc['width'], doc['height'] = self._image_size(path, meta)
+            urls.append(src)
+        versions = self._versions([url for url in urls if url.startswith('/_src/')])
+        if token := versions.get(src):
+            doc['src_version'] = token
+        if token := versions.get(doc['thumbnail']):
+            doc['thumbnail_version'] = token
+
         logging.debug('indexing %r', doc)
         return doc
 
-    async def generate_files(self, root_path: Path):
-        for root,dirs,files in root_path.walk(top_down=True):
-            for f in list(dirs):
-                if f == 'thumbnails':
-                    dirs.remove(f)
-                    continue
-                path = root / f
-                logging.info('processing %s', path)
-                doc = self.index_metadata(path)
-                yield doc
+    @staticmethod
+    def walk(root_path: Path, recursive: bool = True) -> Iterator[tuple[Path, bool, str, list[int]]]:
+        """
+        Walk a tree for documents to index.
+
+        The root itself is not included.
+
+        Args:
+            root_path: dir to walk
+            recursive: walk subdirs, or only the top level
+
+        Yields:
+            (path, is dir, doc id, state entry of [mtime, size, sidecar mtime]),
+            where an album's mtime is that of its `thumbnails` dir
+        """
+        for root, dirs, files in os.walk(root_path):
+            root = Path(root)
+            dirs[:] = [d for d in dirs if d != 'thumbnails' and not d.startswith(HIDDEN_PREFIXES)]
+            sidecars = {}
             for f in files:
                 if f.endswith('.meta.json'):
+                    try:
+                        sidecars[f] = os.stat(root / f).st_mtime_ns
+                    except FileNotFoundError:
+                        continue
+
+            for f in dirs:
+                path = root / f
+                try:
+                    sidecar_mtime = os.stat(path / 'index.meta.json').st_mtime_ns
+                except FileNotFoundError:
+                    sidecar_mtime = 0
+                try:
+                    thumbnails_mtime = os.stat(path / 'thumbnails').st_mtime_ns
+                except FileNotFoundError:
+                    thumbnails_mtime = 0
+                # album docs depend on the album sidecar, and the thumbnail and its version
+                yield path, True, doc_id(str(path.relative_to(ENV.SOURCE))), [thumbnails_mtime, 0, sidecar_mtime]
+            for f in files:
+                if f.endswith('.meta.json') or f.startswith(HIDDEN_PREFIXES):
                     continue
                 path = root / f
-                logging.info('processing %s', path)
-                doc = self.index_metadata(path)
-                yield doc
+                try:
+                    st = path.stat()
+                except FileNotFoundError:
+                    continue
+                sidecar_mtime = sidecars.get(path.with_suffix('.meta.json').name, 0)
+                yield path, False, doc_id(str(path.relative_to(ENV.SOURCE))), [st.st_mtime_ns, st.st_size, sidecar_mtime]
+            if not recursive:
+                break
 
-    async def stream(self, root_path, chunk_size=1000):
-        """Recursively add documents"""
-        async for ok, result in async_streaming_bulk(client=self.es, actions=self.generate_files(root_path), chunk_size=chunk_size, max_retries=2, yield_ok=False, request_timeout=60):
-            action, result = result.popitem()
-            if not ok:
-                logging.warning('failed to process: %r', result)
-                raise RuntimeError('failed to process')
+    async def _walk_parallel(self, root_path: Path, handle: Callable[[Path, bool, str, list[int]], dict[str, Any] | None],
+                             queue: asyncio.Queue, stop: threading.Event, workers: int):
+        """
+        Walk a tree on a thread pool, one top-level subtree per task.
+
+        Docs returned by `handle` are put on the queue, and the walkers
+        block while it is full.
+        """
+        loop = asyncio.get_running_loop()
+
+        def put(doc: dict[str, Any]):
+            fut = asyncio.run_coroutine_threadsafe(queue.put(doc), loop)
+            while True:
+                try:
+                    return fut.result(timeout=1)
+                except TimeoutError:
+                    if stop.is_set():
+                        fut.cancel()
+                        raise asyncio.CancelledError()
+
+        def walk(path: Path, recursive: bool):
+            for entry in self.walk(path, recursive=recursive):
+                if stop.is_set():
+                    raise asyncio.CancelledError()
+                if (doc := handle(*entry)) is not None:
+                    put(doc)
+
+        subtrees = [(root_path, False)]
+        subtrees += [(path, True) for path, is_dir, _, _ in self.walk(root_path, recursive=False) if is_dir]
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='index-walk')
+        try:
+            await asyncio.gather(*(loop.run_in_executor(executor, walk, path, recursive) for path, recursive in subtrees))
+        finally:
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def parallel_bulk(self, root_path: Path, handle: Callable[[Path, bool, str, list[int]], dict[str, Any] | None],
+                            on_failure: Callable[[str, dict[str, Any]], None], tail: Callable[[], Iterable[dict[str, Any]]] | None = None,
+                            chunk_size: int = 1000, concurrency: int = ENV.ES_BULK_CONCURRENCY, workers: int = ENV.INDEX_WORKERS):
+        """
+        Walk a tree and send bulk actions to ElasticSearch, both in parallel.
+
+        The walk runs on a thread pool, feeding a bounded queue that
+        `concurrency` bulk streams consume, so filesystem and ES I/O
+        overlap without the whole tree being held in memory.
+
+        Args:
+            root_path: album root
+            handle: called from the walkers for each entry, returns the action to send, if any
+            on_failure: called with (action type, result) for each failed action
+            tail: called after the walk for any more actions to send
+            chunk_size: ElasticSearch upload chunk size
+            concurrency: max number of bulk requests in flight
+            workers: number of walker threads
+        """
+        self.loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=chunk_size * concurrency * 2)
+        stop = threading.Event()
+
+        async def actions():
+            while (action := await queue.get()) is not None:
+                yield action
+
+        async def consume():
+            async for ok, result in async_streaming_bulk(client=self.es, actions=actions(), chunk_size=chunk_size, max_retries=2, raise_on_error=False, yield_ok=False, request_timeout=60):
+                on_failure(*result.popitem())
+
+        async def produce():
+            await self._walk_parallel(root_path, handle, queue, stop, workers)
+            if tail:
+                for action in tail():
+                    await queue.put(action)
+            for _ in range(concurrency):
+                await queue.put(None)
+
+        try:
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(produce())
+                for _ in range(concurrency):
+                    tg.create_task(consume())
+        finally:
+            stop.set()
+            if self.image_sizes:
+                await self.image_sizes.flush()
+
+    async def stream(self, root_path, chunk_size=1000, state: dict[str, list[int]] | None = None):
+        """
+        Recursively add documents
+
+        Args:
+            root_path: album root
+            chunk_size: ElasticSearch upload chunk size
+            state: dict to fill with the incremental index state, if given
+        """
+        def handle(path, is_dir, id_, entry):
+            logging.info('processing %s', path)
+            if state is not None:
+                state[id_] = entry
+            return self.index_metadata(path, is_dir=is_dir, has_sidecar=entry[2] != 0)
+
+        failed = []
+
+        def on_failure(action, result):
+            logging.warning('failed to process: %r', result)
+            failed.append(result)
+
+        await self.parallel_bulk(root_path, handle, on_failure, chunk_size=chunk_size)
+        if failed:
+            raise RuntimeError(f'failed to process {len(failed)} documents')
+
+    async def update(self, root_path: Path, state_path: Path, chunk_size: int = 1000) -> dict[str, int]:
+        """
+        Incrementally update the live index with what changed since the last run.
+
+        Failed documents are left out of the saved state, so they are
+        retried on the next run.
+
+        Args:
+            root_path: album root
+            state_path: incremental index state file
+            chunk_size: ElasticSearch upload chunk size
+
+        Returns:
+            counts of indexed, deleted, and failed documents
+        """
+        old_state = await asyncio.to_thread(load_state, state_path, self.es_index)
+        if not old_state:
+            logging.warning('no index state, so reindexing everything in place')
+        state: dict[str, list[int]] = {}
+        counts = {'index': 0, 'delete': 0, 'failed': 0}
+
+        def handle(path, is_dir, id_, entry):
+            state[id_] = entry
+            if old_state.get(id_) == entry:
+                return None
+            logging.info('processing %s', path)
+            return self.index_metadata(path, is_dir=is_dir, has_sidecar=entry[2] != 0)
+
+        def deletes():
+            for id_ in old_state.keys() - state.keys():
+                logging.info('deleting %s', id_)
+                counts['delete'] += 1
+                yield {'_op_type': 'delete', '_index': self.index_name, '_id': id_}
+
+        def on_failure(action, result):
+            if action == 'delete' and result.get('status') == 404:
+                return
+            logging.warning('failed to process: %r', result)
+            counts['failed'] += 1
+            if action == 'delete':
+                state[result['_id']] = old_state[result['_id']]
+            else:
+                state.pop(result['_id'], None)
+
+        await self.parallel_bulk(root_path, handle, on_failure, tail=deletes, chunk_size=chunk_size)
+        counts['index'] = sum(1 for id_, entry in state.items() if old_state.get(id_) != entry)
+
+        await asyncio.to_thread(save_state, state_path, self.es_index, state)
+        if counts['index'] or counts['delete']:
+            await self._invalidate()
+        logging.info('indexed %d, deleted %d, failed %d documents', counts['index'], counts['delete'], counts['failed'])
+        return counts
 
     async def add_one(self, path: Path, meta: dict | None = None):
-        """Add a single document"""
+        """
+        Add a single document.
+
+        With a search cache, cached searches are invalidated now, and
+        again after a background refresh makes the doc searchable.
+        """
+        self.loop = asyncio.get_running_loop()
         docs = [
-            self.index_metadata(path, meta=meta)
+            await asyncio.to_thread(self.index_metadata, path, meta=meta)
         ]
+        if self.image_sizes:
+            await self.image_sizes.flush()
         async for ok, result in async_streaming_bulk(client=self.es, actions=docs, chunk_size=1000, max_retries=2, yield_ok=False, request_timeout=1):
             action, result = result.popitem()
             if not ok:
                 logging.warning('failed to process: %r', result)
                 raise RuntimeError('failed to process')
+        await self._invalidate()
+        self._schedule_refresh()
 
     async def remove_one(self, path):
         """Remove a single document"""
         root_path = ENV.SOURCE
-        doc_path = str(path.relative_to(root_path))
-        id_ = hashlib.sha1(doc_path.encode('utf8')).hexdigest()
+        id_ = doc_id(str(path.relative_to(root_path)))
         await self.es.delete(index=self.index_name, id=id_, timeout='1s')
+        await self._invalidate()
+        self._schedule_refresh()
 
-    async def search(self, query, limit=100):
-        return await self.es.search(index=self.es_index, body={
-                'query': {
-                    'combined_fields': {
-                        'query': query,
-                        'fields': ['title^3','keywords^10','summary^5','description^3','path','date^2','type'],
-                        'operator': 'or',
-                        'minimum_should_match': '3<66%',
-                    }
-                },
-                'size': limit
-            })
+    async def search(self, query: str, limit: int = 100, search_after: list | None = None, pit: str | None = None,
+                     source: list[str] | None = None):
+        """
+        Search the index.
 
+        Hits are sorted by score, then path, so pages after the first can
+        be fetched with the sort values of the previous page's last hit.
+        Those are searched within a point-in-time, so they stay consistent
+        while the index changes.
+
+        Args:
+            query: query string
+            limit: number of hits to return
+            search_after: sort values of the last hit of the previous page
+            pit: point-in-time id, see `open_pit`
+            source: `_source` fields to return, or None for all
+        """
+        body: dict[str, Any] = {
+            'query': {
+                'combined_fields': {
+                    'query': query,
+                    'fields': ['title^3','keywords^10','summary^5','description^3','path','date^2','type'],
+                    'operator': 'or',
+                    'minimum_should_match': '3<66%',
+                }
+            },
+            'size': limit,
+            # unmapped in indexes built before the path sort field was added
+            'sort': [{'_score': 'desc'}, {'path.sort': {'order': 'asc', 'unmapped_type': 'keyword'}}],
+        }
+        if source is not None:
+            body['_source'] = source
+        if search_after:
+            body['search_after'] = search_after
+        if not pit:
+            return await self.es.search(index=self.es_index, body=body)
+
+        body['pit'] = {'id': pit, 'keep_alive': ENV.SEARCH_KEEP_ALIVE}
+        return await self.es.search(body=body)
+
+    async def search_page(self, query: str, limit: int = 100, cursor: str | None = None,
+                          source: list[str] | None = None) -> tuple[Any, int, str | None]:
+        """
+        Get a page of search results.
+
+        The first page is a plain search, since most searches are never
+        paged, and its cursor holds no point-in-time.  One is opened when
+        such a cursor is followed, and closed again after the last page.
+        Raises ValueError for a bad cursor, and NotFoundError if its
+        point-in-time has expired.
+
+        Args:
+            query: query string
+            limit: page size
+            cursor: cursor from the previous page, or None for the first page
+            source: `_source` fields to return, or None for all
+
+        Returns:
+            (ElasticSearch response, offset of the page, cursor for the next page or None)
+        """
+        if cursor:
+            pit, search_after, offset = decode_cursor(cursor)
+            if not pit:
+                pit = await self.open_pit()
+        else:
+            pit, search_after, offset = '', None, 0
+        ret = await self.search(query, limit, search_after=search_after, pit=pit, source=source)
+        pit = ret.get('pit_id', pit)
+        hits = ret['hits']['hits']
+        total = ret['hits']['total']
+        if len(hits) == limit and (total.get('relation') == 'gte' or offset + limit < total['value']):
+            return ret, offset, encode_cursor(pit, hits[-1]['sort'], offset + limit)
+        if pit:
+            await self.close_pit(pit)
+        return ret, offset, None
+
+    async def open_pit(self) -> str:
+        """Open a point-in-time of the index to page through."""
+        ret = await self.es.open_point_in_time(index=self.es_index, keep_alive=ENV.SEARCH_KEEP_ALIVE)
+        return ret['id']
+
+    async def close_pit(self, pit: str):
+        try:
+            await self.es.close_point_in_time(id=pit)
+        except NotFoundError:
+            pass
 
 async def main():
     config_logging()
@@ -175,15 +718,30 @@ async def main():
     parser.add_argument('-a', '--address', default=ENV.ES_ADDRESS, help='ElasticSearch address')
     parser.add_argument('-n', '--index-name', default=ENV.ES_INDEX, help='ElasticSearch index name')
     parser.add_argument('--chunk-size', default=ENV.ES_CHUNK_SIZE, type=int, help='ElasticSearch upload chunk size')
+    parser.add_argument('--incremental', action='store_true', help='only index what changed since the last run, in place')
+    parser.add_argument('--force-merge', action='store_true', help='force merge a full rebuild before swapping it in')
+    parser.add_argument('--state', type=Path, default=ENV.INDEX_STATE, help='incremental index state file')
+    parser.add_argument('--no-versions', action='store_true', help='leave out version tokens')
     args = parser.parse_args()
 
     es = AsyncElasticsearch(hosts=args.address)
-    es_indexer = Indexer(es, args.index_name)
+    redis = RedisInstance()
+    version_cache = None if args.no_versions else VersionCache()
+    es_indexer = Indexer(es, args.index_name, version_cache=version_cache, search_cache=SearchCache(),
+                         image_sizes=ImageSizeCache())
 
     try:
-        async with es_indexer.swap_index():
-            await es_indexer.stream(args.root)
+        if args.incremental:
+            await es_indexer.update(args.root, args.state, chunk_size=args.chunk_size)
+        else:
+            state: dict[str, list[int]] = {}
+            async with es_indexer.swap_index(force_merge=args.force_merge):
+                await es_indexer.stream(args.root, chunk_size=args.chunk_size, state=state)
+            save_state(args.state, args.index_name, state)
     finally:
+        if version_cache:
+            version_cache.close()
+        await redis.close()
         await es.close()
 
 
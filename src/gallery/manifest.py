@@ -0,0 +1,291 @@
+"""
+Build and maintain per-album `.album-manifest` files.
+
+A manifest holds everything needed to render an album: child names and
+types, merged metadata, thumbnails, dimensions, and version tokens, so
+an album loads with a single read.  See `albums.read_manifest` for when
+a manifest is valid.
+
+Edits made through the gallery update manifests in place, and albums
+without a valid manifest get one built in the background the first
+time they are viewed.  Run as a command to build manifests for the
+existing tree.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any
+import weakref
+
+from .albums import (HIDDEN_PREFIXES, MANIFEST_NAME, AlbumItem, DirListing, Media, album_signatures, album_stamp,
+                     album_thumbnail, load_album, manifest_entry, read_manifest)
+from .caching import RedisInstance
+from .config import ENV, config_logging
+from .dimensions import ImageSizeCache
+from .util import json_loads, read_metadata, read_metadata_many
+from .versions import VersionCache
+
+
+def write_manifest(path: Path, data: dict[str, Any]) -> bool:
+    """
+    Atomically write an album manifest, then mark it as valid.
+
+    The album is checked against the signatures the data was built from
+    both before and after writing, so nothing changed in between is
+    missed, as `albums.read_manifest` only checks the `album_stamp`.
+
+    Args:
+        path: album file path
+        data: manifest data, with the signatures it was built from
+
+    Returns:
+        True if the manifest was written, or False if the album has changed since
+    """
+    stamp = album_stamp(path)
+    if album_signatures(path) != data['signatures']:
+        logging.info('album %s changed while building its manifest', path)
+        return False
+    data['stamp'] = stamp[1:]
+    manifest_path = path / MANIFEST_NAME
+    tmp_path = path / f'{MANIFEST_NAME}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, manifest_path)
+    # put back the dir mtime the rename changed, so the album stamp (and
+    # the cached pages checked against it) is unchanged, then mark the
+    # manifest as matching it
+    st = path.stat()
+    try:
+        os.utime(path, ns=(st.st_atime_ns, stamp[0]))
+        mtime = stamp[0]
+    except OSError:
+        mtime = st.st_mtime_ns
+    os.utime(manifest_path, ns=(st.st_atime_ns, mtime))
+    if album_signatures(path) != data['signatures'] or album_stamp(path)[1:] != stamp[1:]:
+        logging.info('album %s changed while writing its manifest', path)
+        os.utime(manifest_path, ns=(0, 0))
+        # the change may have been hidden by putting back the mtime
+        os.utime(path)
+        return False
+    return True
+
+
+def _read_manifest_data(path: Path) -> dict[str, Any] | None:
+    try:
+        with open(path / MANIFEST_NAME, 'rb') as f:
+            return json_loads(f.read())
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        logging.info('bad manifest for album %s', path, exc_info=True)
+        return None
+
+
+_locks: weakref.WeakValueDictionary[Path, asyncio.Lock] = weakref.WeakValueDictionary()
+
+
+def _lock(path: Path) -> asyncio.Lock:
+    """Get the lock serializing manifest writes for an album."""
+    if (lock := _locks.get(path)) is None:
+        lock = _locks[path] = asyncio.Lock()
+    return lock
+
+
+async def build_manifest(path: Path, version_cache: VersionCache | None = None,
+                         image_sizes: ImageSizeCache | None = None) -> bool:
+    """
+    Scan an album and write its manifest.
+
+    Args:
+        path: album file path
+        version_cache: version cache to get version tokens from, or None to leave them out
+        image_sizes: image size cache, or None to open images without a sidecar size
+
+    Returns:
+        True if the manifest was written
+    """
+    async with _lock(path):
+        return await _build_manifest(path, version_cache, image_sizes)
+
+
+async def _build_manifest(path: Path, version_cache: VersionCache | None, image_sizes: ImageSizeCache | None) -> bool:
+    # signed first, so changes made while scanning leave the manifest stale
+    signatures = await asyncio.to_thread(album_signatures, path)
+    album = await load_album(path, manifest=False, image_sizes=image_sizes)
+    if image_sizes:
+        await image_sizes.flush()
+    versions = await version_cache.get_urls(album.src_urls()) if version_cache else {}
+    return await asyncio.to_thread(write_manifest, path, album.to_manifest(versions, signatures))
+
+
+async def update_manifest(path: Path, names: list[str] | None = None, version_cache: VersionCache | None = None,
+                          image_sizes: ImageSizeCache | None = None) -> bool:
+    """
+    Update an album's manifest in place after an edit.
+
+    Only the album metadata and the named children are re-read.  Albums
+    without a manifest are left alone, and a manifest that does not match
+    the album contents is rebuilt.  A manifest that cannot be updated
+    because the album keeps changing is left for the next edit to fix.
+
+    Args:
+        path: album file path
+        names: names of children that were added, changed, or removed
+        version_cache: version cache to get version tokens from, or None to leave them out
+        image_sizes: image size cache, or None to open images without a sidecar size
+
+    Returns:
+        True if the manifest was written
+    """
+    if not ENV.ALBUM_MANIFEST:
+        return False
+    async with _lock(path):
+        if not await asyncio.to_thread((path / MANIFEST_NAME).exists):
+            return False
+        if await _update_manifest(path, names if names else [], version_cache, image_sizes):
+            return True
+        # the album changed while updating, so try a full rebuild once
+        logging.info('album %s changed while updating its manifest, rebuilding', path)
+        if await _build_manifest(path, version_cache, image_sizes):
+            return True
+        # still changing, so leave it to the next edit: the stale manifest
+        # no longer matches the album signatures, so it is never read
+        logging.info('cannot update manifest for %s, leaving it stale', path)
+        return False
+
+
+async def _update_manifest(path: Path, names: list[str], version_cache: VersionCache | None,
+                           image_sizes: ImageSizeCache | None) -> bool:
+    signatures = await asyncio.to_thread(album_signatures, path)
+    listing = await asyncio.to_thread(DirListing, path)
+    data = await asyncio.to_thread(_read_manifest_data, path)
+    if data is None:
+        return False
+
+    # children sharing a name stem also share thumbnail names, so re-read them together
+    stems = {Path(name).stem for name in names}
+    names = list(dict.fromkeys(names + [name for name in listing.children if Path(name).stem in stems]))
+    children = data['children']
+    expected = set(listing.children)
+    changed = [name for name in names if name in expected]
+    old_signatures = data.get('signatures', {})
+    if ((set(children) - set(names)) | set(changed) != expected or
+            any(old_signatures.get(key) != signatures.get(key) and not _touched(key, names, stems)
+                for key in old_signatures.keys() | signatures.keys())):
+        logging.info('manifest for %s is out of date, rebuilding', path)
+        return await _build_manifest(path, version_cache, image_sizes)
+
+    meta = await asyncio.to_thread(read_metadata, path, is_dir=True, exists='index.meta.json' in listing.names)
+    if not meta['title']:
+        meta['title'] = path.name
+    dirs = {path / name for name in changed if name in listing.dirs}
+    metadata = await read_metadata_many([path / name for name in changed], dirs=dirs)
+
+    def make_items():
+        items = []
+        for name in changed:
+            child = path / name
+            if child in dirs:
+                items.append(AlbumItem(child, listing=listing, meta=metadata[child]))
+            else:
+                items.append(Media(child, listing=listing, meta=metadata[child], image_sizes=image_sizes))
+        return items
+
+    items = await asyncio.to_thread(make_items)
+    thumbnail = album_thumbnail(listing.rel, meta, listing.thumbnails)
+    if image_sizes:
+        await image_sizes.flush()
+
+    urls = [thumbnail] + [url for item in items for url in item.src_urls()]
+    versions = await version_cache.get_urls(urls) if version_cache else {}
+
+    for name in names:
+        children.pop(name, None)
+    for item in items:
+        children[item.name] = manifest_entry(item, versions)
+    data['meta'] = meta
+    data['thumbnails'] = sorted(listing.thumbnails)
+    data['signatures'] = signatures
+    data['versions'] = {thumbnail: versions[thumbnail]} if thumbnail in versions else {}
+    return await asyncio.to_thread(write_manifest, path, data)
+
+
+def _touched(key: str, names: list[str], stems: set[str]) -> bool:
+    """Check if an `album_signatures` key is re-read when updating the named children of an album."""
+    first, sep, rest = key.partition('/')
+    if first == 'thumbnails':
+        # the album thumbnail is always re-read
+        return Path(rest).stem in stems | {'thumb'}
+    if sep:
+        return first in names
+    if key == 'index.meta.json':
+        return True
+    if key.endswith('.meta.json'):
+        return key.removesuffix('.meta.json') in stems
+    return key in names
+
+
+_building: dict[Path, asyncio.Task] = {}
+
+
+async def _build(path: Path, version_cache: VersionCache | None, image_sizes: ImageSizeCache | None):
+    try:
+        if await build_manifest(path, version_cache, image_sizes):
+            logging.info('built manifest for album %s', path)
+    except Exception:
+        logging.info('cannot build manifest for album %s', path, exc_info=True)
+
+
+def schedule_build(path: Path, version_cache: VersionCache | None = None, image_sizes: ImageSizeCache | None = None):
+    """Build an album's manifest in the background, if not already building."""
+    if not ENV.ALBUM_MANIFEST or path in _building:
+        return
+    task = asyncio.create_task(_build(path, version_cache, image_sizes))
+    _building[path] = task
+    task.add_done_callback(lambda _: _building.pop(path, None))
+
+
+async def backfill(root: Path, version_cache: VersionCache | None = None, image_sizes: ImageSizeCache | None = None):
+    """
+    Build manifests for a whole tree, skipping albums that have a valid one.
+
+    Args:
+        root: album root
+        version_cache: version cache to get version tokens from, or None to leave them out
+        image_sizes: image size cache, or None to open images without a sidecar size
+    """
+    count = 0
+    for dirpath, dirs, _ in os.walk(root):
+        dirs[:] = [d for d in dirs if d != 'thumbnails' and not d.startswith(HIDDEN_PREFIXES)]
+        path = Path(dirpath)
+        if await asyncio.to_thread(read_manifest, path):
+            continue
+        if await build_manifest(path, version_cache, image_sizes):
+            logging.info('built manifest for album %s', path)
+            count += 1
+    logging.info('built %d manifests', count)
+
+
+async def main():
+    config_logging()
+
+    parser = argparse.ArgumentParser(description='Build album manifests')
+    parser.add_argument('--root', type=Path, default=ENV.SOURCE, help="album root")
+    parser.add_argument('--no-versions', action='store_true', help='leave out version tokens')
+    args = parser.parse_args()
+
+    redis = RedisInstance()
+    version_cache = None if args.no_versions else VersionCache()
+    try:
+        await backfill(args.root, version_cache, ImageSizeCache())
+    finally:
+        if version_cache:
+            version_cache.close()
+        await redis.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
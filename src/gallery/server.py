@@ -1,26 +1,39 @@
 """
 Credentials store and refresh.
 """
-from datetime import datetime
-from hashlib import blake2b
+import asyncio
+from datetime import datetime, timezone
+import email.utils
+import gzip
+import itertools
 import logging
+import math
 from pathlib import Path
 import shutil
-import subprocess
 import time
 from typing import Any
 
-from elasticsearch import AsyncElasticsearch
+from elasticsearch import AsyncElasticsearch, NotFoundError
 from rest_tools.server import catch_error, RestServer, RestHandlerSetup, KeycloakUsernameMixin
 from tornado.web import HTTPError
-from tornado.web import RequestHandler, StaticFileHandler
+from tornado.httputil import parse_body_arguments
+from tornado.iostream import StreamClosedError
+from tornado.web import RequestHandler, StaticFileHandler, stream_request_body
 
 import gallery
-from .albums import Album, AlbumItem, Media
+from .albums import (Album, AlbumItem, Media, SearchResult, album_fingerprint, album_key, album_stamp, derivative_widths,
+                     load_album)
 from .config import ENV
+from .dimensions import IMAGE_SIZE_KEY, ImageSizeCache, image_size_meta
 from .index import Indexer
-from .caching import RedisInstance
-from .util import read_metadata, write_metadata
+from .manifest import schedule_build, update_manifest
+from .caching import PageCache, SearchCache
+from .util import accepts_encoding, get_type, json_loads, read_metadata, read_metadata_many, update_metadata, write_metadata
+from .thumbnails import ThumbnailJob, ThumbnailQueue
+from .uploads import (MultipartError, MultipartParser, UploadFile, UploadSession, UploadTooLarge, cleanup_sessions,
+                      get_boundary, parse_disposition)
+from .versions import VersionCache
+from .watcher import Watcher
 
 
 logger = logging.getLogger('server')
@@ -30,12 +43,17 @@ ROLES = {'read', 'upload', 'admin'}
 
 
 class BaseHandler(KeycloakUsernameMixin, RequestHandler):
-    def initialize(self, debug, indexer, auth, **kwargs):
+    def initialize(self, debug, indexer, auth, version_cache, thumbnails, image_sizes, **kwargs):
         self.debug = debug
         self.auth = auth
         self.auth_data = {}
         self.indexer = indexer
-        self.page_cache = RedisInstance()
+        self.version_cache = version_cache
+        self.thumbnails = thumbnails
+        self.versions: dict[str, str] = {}
+        self.page_cache = PageCache()
+        self.search_cache = SearchCache()
+        self.image_sizes = image_sizes
 
     def set_default_headers(self):
         self._headers['Server'] = 'Gallery/' + gallery.__version__
@@ -58,22 +76,79 @@ class BaseHandler(KeycloakUsernameMixin, RequestHandler):
 
         return None
 
+    async def _prepare_versions(self, urls: list[str]):
+        """
+        Compute version tokens for `/_src` urls before rendering.
+
+        Hashing is done on the version cache's thread pool, so templates
+        only look up precomputed values in `version_hash`.  Urls that
+        already have a token, e.g. from an album manifest, are skipped.
+        """
+        urls = [url for url in urls if url not in self.versions]
+        self.versions.update(await self.version_cache.get_urls(urls))
+
+    async def _load_album(self, path: Path, prefix: Path | None = None, offset: int = 0, limit: int | None = None,
+                          stamp: list[int] | None = None) -> Album:
+        """
+        Load an album and prepare everything needed to render it.
+
+        Albums without a valid manifest get one built in the background.
+        """
+        album = await load_album(path, prefix=prefix, offset=offset, limit=limit, image_sizes=self.image_sizes,
+                                 stamp=stamp)
+        self.versions.update(album.versions)
+        await self._prepare_versions(album.src_urls())
+        await self.image_sizes.flush()
+        if not album.from_manifest:
+            schedule_build(path, self.version_cache, self.image_sizes)
+        return album
+
+    async def _update_manifest(self, path: Path, names: list[str] | None = None):
+        """Update an album's manifest after an edit."""
+        try:
+            await update_manifest(path, names, version_cache=self.version_cache, image_sizes=self.image_sizes)
+        except Exception:
+            logging.info('error updating manifest for %s', path, exc_info=True)
+
     def version_hash(self, url):
+        if token := self.versions.get(url):
+            return f'{url}?v={token}'
         if url.startswith('/_src'):
-            path = ENV.SOURCE / Path(url[6:])
-            try:
-                hasher = blake2b(digest_size=ENV.VERSION_HASH_DIGEST_SIZE, person=ENV.VERSION_HASH_PERSON)
-                b = bytearray(128 * 1024)
-                mv = memoryview(b)
-                with path.open('rb') as f:
-                    # Known issue with MyPy: https://github.com/python/typeshed/issues/2166
-                    for n in iter(lambda: f.readinto(mv), 0):
-                        hasher.update(mv[:n])
-                return f'{url}?v={hasher.hexdigest()}'
-            except Exception:
-                logging.info('cannot hash %s', url, exc_info=True)
+            logging.info('no version hash for %s', url)
         return url
 
+    def srcset(self, media: Media | SearchResult) -> str:
+        """
+        Get the srcset of an image's derivatives and original.
+
+        Derivatives are versioned with the original's token.
+        """
+        ret = []
+        token = self.versions.get(media.src)
+        for width, url in media.derivatives:
+            ret.append(f'{url}?v={token} {width}w' if token else f'{url} {width}w')
+        ret.append(f'{self.version_hash(media.url)} {media.width}w')
+        return ', '.join(ret)
+
+    def _api_item(self, item: AlbumItem | SearchResult) -> dict[str, Any]:
+        """Get the JSON for an album child or search result."""
+        ret = {
+            'type': item.type,
+            'name': item.name,
+            'url': item.meta.get('link', item.url) if item.type == 'album' else self.version_hash(item.url),
+            'thumbnail': self.version_hash(item.thumbnail),
+            'title': item.meta['title'],
+            'summary': item.meta.get('summary', ''),
+            'description': item.meta.get('description', ''),
+        }
+        if isinstance(item, (Media, SearchResult)) and item.type != 'album':
+            ret['mime'] = item.mime
+            if item.type == 'image':
+                ret['width'] = item.width
+                ret['height'] = item.height
+                ret['srcset'] = self.srcset(item)
+        return ret
+
     def get_template_namespace(self):
         data = super().get_template_namespace()
         data.update({
@@ -86,6 +161,7 @@ class BaseHandler(KeycloakUsernameMixin, RequestHandler):
             'auth_data': self.auth_data,
             'template_url': '/static',
             'version_hash': self.version_hash,
+            'srcset': self.srcset,
         })
         logging.info("namespace: %r", data)
         return data
@@ -144,88 +220,218 @@ class BaseHandler(KeycloakUsernameMixin, RequestHandler):
 
         return ret
 
-    def _handle_thumbnail(self, path: Path, upload_thumb: Any = None, prev_thumb: str|None = None) -> str | None:
-        if path.is_dir():
-            thumb_path = path / 'thumbnails' / 'thumb.jpg'
-        else:
-            thumb_path = path.parent / 'thumbnails' / path.name
-        thumb_path.parent.mkdir(exist_ok=True)
+    def _handle_thumbnail(self, path: Path, upload_thumb: Any = None, prev_thumb: str | None = None, orient: bool = False):
+        """
+        Queue a thumbnail to be made in the background.
+
+        The sidecar gets the new thumbnail when the job finishes.
+
+        Args:
+            path: album dir or media file
+            upload_thumb: uploaded thumbnail file, or None to make one from the media
+            prev_thumb: current thumbnail, which is kept unless a new one is uploaded
+            orient: auto-orient the media file in place first
+        """
         if upload_thumb:
             logging.info("thumbnail upload: %r", upload_thumb['filename'])
-            thumb_path = thumb_path.with_suffix(Path(upload_thumb['filename']).suffix)
-            with thumb_path.open('wb') as f:
-                f.write(upload_thumb['body'])
-            try:
-                subprocess.check_call(['convert', str(thumb_path), '-resize', '150x150', '-auto-orient', str(thumb_path)])
-            except Exception:
-                return None
+            job = ThumbnailJob(path, upload=upload_thumb['body'], upload_suffix=Path(upload_thumb['filename']).suffix,
+                               prev_thumb=prev_thumb, orient=orient)
+        elif prev_thumb:
+            return
         else:
-            if prev_thumb:
-                return None
-            if path.is_dir():
-                logging.info("auto thumbnail for dir")
-                for src_path in path.iterdir():
-                    if src_path.name == 'thumbnails' or src_path.name.endswith('.meta.json'):
-                        continue
-                    if src_path.is_file() and src_path.suffix in ENV.IMG_EXTENSIONS:
-                        break
-                else:
-                    return None
-            else:
-                logging.info("auto thumbnail for media")
-                src_path = path
-            try:
-                subprocess.check_call(['convert', str(src_path), '-resize', '150x150', '-auto-orient', str(thumb_path)])
-            except Exception:
-                return None
+            job = ThumbnailJob(path, orient=orient)
+        self.thumbnails.put(job)
 
-        if prev_thumb:
-            if prev_thumb != 'thumbnails/' + thumb_path.name:
-                (thumb_path.parent.parent / prev_thumb).unlink(missing_ok=True)
-        return 'thumbnails/' + thumb_path.name
+    def _edit_album_path(self, web_path: str) -> Path:
+        """Get the album path for an album edit url."""
+        return ENV.SOURCE / Path(web_path).relative_to('/edit')
+
+    async def _add_upload(self, album_path: Path, upload: UploadFile) -> str:
+        """
+        Move a finished upload into an album, then record and index it.
+
+        Returns:
+            the media file name
+        """
+        name = sanitize_name(upload.filename)
+        media_path = album_path / name
+        await asyncio.to_thread(upload.commit, media_path)
+        try:
+            await self.version_cache.prime(media_path, upload.token)
+        except Exception:
+            logging.info('cannot record version of %s', media_path, exc_info=True)
+
+        updates = {'title': upload.filename, 'createdate': time.time()}
+        if self.current_user:
+            updates['user'] = self.current_user
+        meta = await asyncio.to_thread(update_metadata, media_path, updates)
+        await self._add_to_es(media_path, meta=meta)
+        # orientation and image size are handled with the thumbnail
+        self._handle_thumbnail(media_path, orient=get_type(media_path) == 'image')
+        return name
+
+    async def _uncache_album(self, album_path: Path):
+        path = album_key(album_path)
+        try:
+            await self.page_cache.delete(path)
+        except Exception as e:
+            logging.info('error removing %s from cache: %r', path, e)
 
 
 class AlbumHandler(BaseHandler):
+    def compute_etag(self):
+        # validators come from the page cache, see `_not_modified`
+        return None
+
+    def _accepts_gzip(self) -> bool:
+        return accepts_encoding(self.request.headers.get('Accept-Encoding', ''), 'gzip')
+
+    def _write_gzip(self, body: bytes) -> int:
+        """
+        Write a gzip compressed body as is, or decompressed if the client does not accept gzip.
+
+        Returns:
+            the number of bytes written
+        """
+        self.set_header('Vary', 'Accept-Encoding')
+        if self._accepts_gzip():
+            self.set_header('Content-Encoding', 'gzip')
+        else:
+            body = gzip.decompress(body)
+        self.write(body)
+        return len(body)
+
+    def _not_modified(self, meta: dict[str, Any]) -> bool:
+        """
+        Set the ETag and Last-Modified of a cached page.
+
+        The ETag is per content encoding, as the gzip and plain bodies differ.
+
+        Returns:
+            True if the client's conditional headers show it already has the page
+        """
+        etag = meta['etag'] + ('-gzip' if self._accepts_gzip() else '')
+        self.set_header('Etag', f'"{etag}"')
+        self.set_header('Last-Modified', datetime.fromtimestamp(meta['modified'], timezone.utc))
+        self.set_header('Cache-Control', 'no-cache')
+        self.set_header('Vary', 'Accept-Encoding')
+        if self.request.headers.get('If-None-Match'):
+            return self.check_etag_header()
+        if since := self.request.headers.get('If-Modified-Since'):
+            try:
+                return meta['modified'] <= email.utils.parsedate_to_datetime(since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    async def _stamp(self, media_path: Path) -> list[int] | None:
+        try:
+            return await asyncio.to_thread(album_stamp, media_path)
+        except OSError:
+            return None
+
+    async def _render(self, media_path: Path, page: int, stamp: list[int] | None = None) -> bytes:
+        start = time.monotonic()
+        size = ENV.ALBUM_PAGE_SIZE
+        album = await self._load_album(media_path, offset=(page-1)*size, limit=size, stamp=stamp)
+        title = f'Gallery - {media_path.name}'
+        pages = max(1, math.ceil(album.total / size))
+        if page > pages:
+            # raised before anything is cached, so bad page numbers can't fill the cache
+            raise HTTPError(404, reason='page not found')
+        body = self.render_string('album.html', title=title, album=album, page=page, pages=pages,
+                                  breadcrumbs=self._breadcrumbs(media_path))
+        logging.info('rendered album %s in %.3fs, version cache %r', media_path, time.monotonic()-start, self.version_cache.stats)
+        return body
+
     async def get(self, path):
+        basedir = Path(ENV.SOURCE)
+        media_path = basedir / path.strip('/')
+        try:
+            page = max(1, int(self.get_argument('page', '1')))
+        except ValueError:
+            page = 1
+        # taken once, to check both the page cache and the album manifest against
+        stamp = await self._stamp(media_path)
+        fingerprint = album_fingerprint(media_path, stamp) if stamp else None
+
         try:
-            ret = await self.page_cache.get(str(path))
+            if 'If-None-Match' in self.request.headers or 'If-Modified-Since' in self.request.headers:
+                # answer from the metadata, without loading the body
+                if self._not_modified(await self.page_cache.get_meta(path, fingerprint, page=page)):
+                    self.set_status(304)
+                    return
+            entry = await self.page_cache.get_entry(path, fingerprint, page=page)
         except KeyError:
-            pass
+            self.clear_header('Etag')
+            self.clear_header('Last-Modified')
         except Exception:
             logging.info('bad cache get', exc_info=True)
         else:
-            if ret['version'] != gallery.__version__:
-                await self.page_cache.delete(str(path))
-            else:
-                self.write(ret['body'])
-                return
+            self._not_modified(entry)
+            self._write_gzip(entry['body'])
+            return
 
-        basedir = Path(ENV.SOURCE)
         if not basedir.exists():
             logging.warning('album basedir %s does not exist', basedir)
             raise HTTPError(500, reason='album source does not exist')
 
-        media_path = basedir / path.strip('/')
         if not media_path.exists():
             logging.warning('album path %s does not exist', media_path)
             raise HTTPError(500, reason='album path does not exist')
-        elif media_path.is_dir():
-            album = Album(media_path)
-            title = f'Gallery - {media_path.name}'
-            body = self.render_string('album.html', title=title, album=album, breadcrumbs=self._breadcrumbs(media_path))
-        else:
+        elif not media_path.is_dir():
             self.redirect('/_src/'+path)
             return
 
+        async def render():
+            return await self._render(media_path, page, stamp)
+
+        stale = None
         try:
-            await self.page_cache.set(str(path), {
-                'version': gallery.__version__,
-                'body': body.decode('utf-8'),
-            })
+            stale = await self.page_cache.get_stale(path, page=page)
         except Exception:
-            logging.info('cannot cache page', exc_info=True)
+            logging.info('bad stale cache get', exc_info=True)
+        if stale:
+            # serve the previous page while it is re-rendered, but only finish
+            # once the render is done, as it renders with this handler
+            task = self.page_cache.start_render(path, fingerprint, render, page=page)
+            self.set_header('Content-Length', self._write_gzip(stale))
+            try:
+                await self.flush()
+            except StreamClosedError:
+                pass
+            try:
+                await asyncio.shield(task)
+            except Exception:
+                pass  # logged by the page cache
+        else:
+            entry = await self.page_cache.render_once(path, fingerprint, render, page=page)
+            if self._not_modified(entry):
+                self.set_status(304)
+                return
+            self._write_gzip(entry['body'])
 
-        self.write(body)
+
+class AlbumApiHandler(BaseHandler):
+    """
+    Get a window of album children as JSON, for infinite scrolling.
+    """
+    async def get(self, path):
+        media_path = Path(ENV.SOURCE) / path.strip('/')
+        try:
+            offset = max(0, int(self.get_argument('offset', '0')))
+            limit = int(self.get_argument('limit', str(ENV.ALBUM_PAGE_SIZE)))
+        except ValueError:
+            raise HTTPError(400, reason='bad offset or limit')
+        limit = min(max(1, limit), ENV.ALBUM_PAGE_SIZE)
+
+        if not media_path.is_dir():
+            raise HTTPError(404, reason='album not found')
+
+        album = await self._load_album(media_path, offset=offset, limit=limit)
+
+        items = [self._api_item(item) for item in itertools.chain(album.albums, album.images, album.videos, album.files)]
+        self.write({'total': album.total, 'offset': album.offset, 'items': items})
 
 
 class EditHandler(BaseHandler):
@@ -240,14 +446,14 @@ class EditHandler(BaseHandler):
         return data
 
     async def _get_album(self, album_path):
-        album = Album(album_path, prefix=Path('/edit'))
+        album = await self._load_album(album_path, prefix=Path('/edit'))
         title = f'Editor - {album_path.name}'
         self.render('album_edit.html', title=title, album=album, breadcrumbs=self._breadcrumbs(album_path, prefix=Path('/edit')))
 
     async def _update_album(self, album_path):
         ret = True
         if self.get_argument('delete', None) == 'delete':
-            album = Album(album_path, prefix=Path('/edit'))
+            album = await load_album(album_path, prefix=Path('/edit'))
             if album.albums or album.images or album.videos or album.files:
                 raise HTTPError(400, reason="Cannot delete non-empty album")
             basedir = Path(ENV.SOURCE)
@@ -255,53 +461,58 @@ class EditHandler(BaseHandler):
             logging.info('deleting %s', album_path)
             shutil.rmtree(album_path)
             await self._remove_from_es(album_path)
+            await self._update_manifest(album_path.parent, [album_path.name])
             self.redirect(str(web_path.parent))
             ret = False
         else:
             meta = read_metadata(album_path)
-            meta['title'] = self.get_argument('title')
-            meta['summary'] = self.get_argument('summary')
-            meta['keywords'] = self.get_argument('keywords')
-            meta['description'] = self.get_argument('description')
-            meta['sort'] = self.get_argument('sort')
+            updates = {
+                'title': self.get_argument('title'),
+                'summary': self.get_argument('summary'),
+                'keywords': self.get_argument('keywords'),
+                'description': self.get_argument('description'),
+                'sort': self.get_argument('sort'),
+            }
             if self.get_argument('sort_reverse', 'false') == 'true':
-                meta['sort'] = '-' + meta['sort']
+                updates['sort'] = '-' + updates['sort']
 
             thumbnail = None
             for _, items in self.request.files.items():
                 for item in items:
                     thumbnail = item
-            thumbnail = self._handle_thumbnail(album_path, upload_thumb=thumbnail, prev_thumb=meta.get('thumbnail'))
-            if thumbnail:
-                logging.info("set thumbnail: %s", thumbnail)
-                meta['thumbnail'] = thumbnail
+            self._handle_thumbnail(album_path, upload_thumb=thumbnail, prev_thumb=meta.get('thumbnail'))
 
-            write_metadata(album_path, meta)
+            meta = await asyncio.to_thread(update_metadata, album_path, updates)
 
+            changed = []
             if meta['sort'][0].strip('-') == 'meta.orderweight':
                 for k, v in self.request.body_arguments.items():
                     if k.startswith('orderweight-'):
                         filename = k.lstrip('orderweight-')
                         path = album_path / filename
-                        meta2 = read_metadata(path)
-                        meta2['orderweight'] = v[0].decode('utf-8')
-                        write_metadata(path, meta2)
+                        await asyncio.to_thread(update_metadata, path, {'orderweight': v[0].decode('utf-8')})
+                        changed.append(filename)
 
             await self._add_to_es(album_path, meta=meta)
+            await self._update_manifest(album_path, changed)
+            if album_path != ENV.SOURCE:
+                await self._update_manifest(album_path.parent, [album_path.name])
 
-        path = str(album_path.relative_to(ENV.SOURCE)).strip('/')
+        path = album_key(album_path)
         try:
-            await self.page_cache.delete(path)
-            if path != '':
-                parent_path = str(album_path.parent.relative_to(ENV.SOURCE)).strip('/')
-                await self.page_cache.delete(parent_path)
+            paths = [path]
+            if album_path != ENV.SOURCE:
+                paths.append(album_key(album_path.parent))
+            await self.page_cache.delete_many(paths)
         except Exception as e:
             logging.info('error removng %s from cache: %r', path, e)
 
         return ret
 
     async def _get_media(self, media_path):
-        media = Media(media_path, prefix=Path('/edit'))
+        media = await asyncio.to_thread(Media, media_path, prefix=Path('/edit'), image_sizes=self.image_sizes)
+        await self._prepare_versions(media.src_urls())
+        await self.image_sizes.flush()
         title = f'Editor - {media.name}'
         self.render('media_edit.html', title=title, media=media, breadcrumbs=self._breadcrumbs(media_path, prefix=Path('/edit')))
 
@@ -322,6 +533,7 @@ class EditHandler(BaseHandler):
                 if thumb_path.exists():
                     thumb_path.unlink()
             await self._remove_from_es(media_path)
+            await self._update_manifest(media_path.parent, [media_path.name])
             self.redirect(str(web_path.parent))
             ret = False
         elif action == 'move':
@@ -346,35 +558,39 @@ class EditHandler(BaseHandler):
 
             await self._remove_from_es(media_path)
             await self._add_to_es(new_media_path)
+            await self._update_manifest(media_path.parent, [media_path.name])
+            await self._update_manifest(new_media_path.parent, [new_media_path.name])
 
             web_path = Path('/edit') / new_media_path.relative_to(basedir)
             self.redirect(str(web_path))
             ret = False
 
-            path = str(new_media_path.parent.relative_to(ENV.SOURCE)).strip('/')
+            path = album_key(new_media_path.parent)
             try:
                 await self.page_cache.delete(path)
             except Exception as e:
                 logging.info('error removing %s from cache: %r', path, e)
         else:
-            meta['title'] = self.get_argument('title')
-            meta['summary'] = self.get_argument('summary')
-            meta['keywords'] = self.get_argument('keywords')
-            meta['description'] = self.get_argument('description')
+            updates = {
+                'title': self.get_argument('title'),
+                'summary': self.get_argument('summary'),
+                'keywords': self.get_argument('keywords'),
+                'description': self.get_argument('description'),
+            }
+            if get_type(media_path) == 'image':
+                updates[IMAGE_SIZE_KEY] = await asyncio.to_thread(image_size_meta, media_path)
 
             thumbnail = None
             for _, items in self.request.files.items():
                 for item in items:
                     thumbnail = item
-            thumbnail = self._handle_thumbnail(media_path, upload_thumb=thumbnail, prev_thumb=meta.get('thumbnail'))
-            if thumbnail:
-                logging.info("set thumbnail: %s", thumbnail)
-                meta['thumbnail'] = thumbnail
+            self._handle_thumbnail(media_path, upload_thumb=thumbnail, prev_thumb=meta.get('thumbnail'))
 
-            write_metadata(media_path, meta)
+            meta = await asyncio.to_thread(update_metadata, media_path, updates)
             await self._add_to_es(media_path, meta=meta)
+            await self._update_manifest(media_path.parent, [media_path.name])
 
-        path = str(media_path.parent.relative_to(ENV.SOURCE)).strip('/')
+        path = album_key(media_path.parent)
         try:
             await self.page_cache.delete(path)
         except Exception as e:
@@ -419,30 +635,133 @@ class EditHandler(BaseHandler):
 def sanitize_name(name):
     return ''.join(x for x in name.replace(' ', '-') if (x.isalnum() or x in '-_.'))
 
+# max size of a form field that is not a file
+MAX_FIELD_SIZE = 1024 * 1024
+
+
+@stream_request_body
 class UploadHandler(BaseHandler):
     """
     Handle file uploads
+
+    The body is streamed, so files are written to temp files in the album
+    as they arrive instead of being held in memory.
     """
+    def prepare(self):
+        self.request.connection.set_max_body_size(ENV.UPLOAD_MAX_SIZE)
+        self.uploads: list[UploadFile] = []
+        self._part: UploadFile | bytearray | None = None
+        self._field = ''
+        self._error: str | None = None
+        self._body = bytearray()
+        self.parser = None
+        content_type = self.request.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            try:
+                self.parser = MultipartParser(get_boundary(content_type))
+            except MultipartError as e:
+                self._error = str(e)
+
+    def _album_path(self) -> Path:
+        return self._edit_album_path(self.get_argument('album', '/edit'))
+
+    def _upload_dir(self) -> Path:
+        # form fields come before files, so the album is usually known by now
+        try:
+            album_path = self._album_path()
+        except ValueError:
+            return ENV.SOURCE
+        return album_path if album_path.is_dir() else ENV.SOURCE
+
+    def _add_argument(self, name: str, value: bytes):
+        self.request.body_arguments.setdefault(name, []).append(value)
+        self.request.arguments.setdefault(name, []).append(value)
+
+    async def data_received(self, chunk: bytes):
+        if self._error:
+            return
+        if self.parser is None:
+            # not multipart, so a small form
+            self._body += chunk
+            if len(self._body) > MAX_FIELD_SIZE:
+                self._error = 'form too large'
+            return
+
+        try:
+            events = self.parser.feed(chunk)
+        except MultipartError as e:
+            self._error = str(e)
+            return
+        for event, value in events:
+            if event == 'part':
+                self._field, filename = parse_disposition(value.get('Content-Disposition', ''))
+                if filename:
+                    self._part = await asyncio.to_thread(lambda: UploadFile(self._upload_dir(), filename, self._field))
+                    self.uploads.append(self._part)
+                else:
+                    self._part = bytearray()
+            elif event == 'data':
+                if isinstance(self._part, UploadFile):
+                    await asyncio.to_thread(self._part.write, value)
+                elif self._part is not None:
+                    self._part += value
+                    if len(self._part) > MAX_FIELD_SIZE:
+                        self._error = f'form field {self._field} too large'
+                        return
+            elif event == 'end':
+                if isinstance(self._part, UploadFile):
+                    await asyncio.to_thread(self._part.close)
+                    logging.info('received upload %r, %d bytes', self._part.filename, self._part.size)
+                elif self._part is not None:
+                    self._add_argument(self._field, bytes(self._part))
+                self._part = None
+
+    def _discard_uploads(self):
+        for upload in self.uploads:
+            try:
+                upload.discard()
+            except OSError:
+                logging.info('cannot remove %s', upload.tmp_path, exc_info=True)
+        self.uploads = []
+
+    def on_connection_close(self):
+        self._discard_uploads()
+        super().on_connection_close()
+
+    def on_finish(self):
+        self._discard_uploads()
+
     @catch_error
     async def post(self):
+        if self.parser is None and not self._error:
+            parse_body_arguments(self.request.headers.get('Content-Type', ''), bytes(self._body),
+                                 self.request.body_arguments, {}, self.request.headers)
+            for name, values in self.request.body_arguments.items():
+                self.request.arguments.setdefault(name, []).extend(values)
+        elif self.parser and not self._error:
+            try:
+                self.parser.close()
+            except MultipartError as e:
+                self._error = str(e)
+        if self._error:
+            raise HTTPError(400, reason=self._error)
+
         web_redirect = self.get_argument('album', '/edit')
-        web_path = Path(web_redirect)
 
         basedir = ENV.SOURCE
         if not basedir.exists():
             logging.warning('album basedir %s does not exist', basedir)
             raise HTTPError(500, reason='album source does not exist')
 
-        album_path = basedir / web_path.relative_to('/edit')
+        album_path = self._album_path()
         logging.info('album_path: %s', album_path)
 
         if newdir := self.get_argument('newdir', None):
             logging.info("New Subalbum!")
             logging.info("name: %s", newdir)
             thumbnail = None
-            for _, items in self.request.files.items():
-                for item in items:
-                    thumbnail = item
+            for upload in self.uploads:
+                thumbnail = upload
 
             new_album_path = album_path / sanitize_name(newdir)
             if not new_album_path.exists():
@@ -452,96 +771,249 @@ class UploadHandler(BaseHandler):
                 if self.current_user:
                     meta['user'] = self.current_user
                 meta['createdate'] = time.time()
-                thumbnail = self._handle_thumbnail(new_album_path, upload_thumb=thumbnail)
-                if thumbnail:
-                    logging.info("set thumbnail: %s", thumbnail)
-                    meta['thumbnail'] = thumbnail
                 write_metadata(new_album_path, meta)
+                upload_thumb = None
+                if thumbnail:
+                    upload_thumb = {'filename': thumbnail.filename, 'body': await asyncio.to_thread(thumbnail.read_bytes)}
+                self._handle_thumbnail(new_album_path, upload_thumb=upload_thumb)
             await self._add_to_es(new_album_path, meta=meta)
+            await self._update_manifest(album_path, [new_album_path.name])
         else:
             logging.info("Upload!")
             logging.info("Args: %r", self.request.body_arguments)
             files = []
-            for _, items in self.request.files.items():
-                for item in items:
-                    name = sanitize_name(item['filename'])
-                    media_path = album_path / name
-                    with open(media_path, 'wb') as f:
-                        f.write(item['body'])
-                    try:
-                        subprocess.check_call(['convert', str(media_path), '-auto-orient', str(media_path)])
-                    except Exception:
-                        return None
-
-                    meta = read_metadata(media_path)
-                    meta['title'] = item['filename']
-                    if self.current_user:
-                        meta['user'] = self.current_user
-                    meta['createdate'] = time.time()
-                    thumbnail = self._handle_thumbnail(media_path)
-                    if thumbnail:
-                        logging.info("set thumbnail: %s", thumbnail)
-                        meta['thumbnail'] = thumbnail
-                    write_metadata(media_path, meta)
-                    await self._add_to_es(media_path, meta=meta)
-
-                    files.append(item['filename'])
+            names = []
+            for upload in self.uploads:
+                names.append(await self._add_upload(album_path, upload))
+                files.append(upload.filename)
             logging.info("Files: %d %r", len(files), files)
+            await self._update_manifest(album_path, names)
+
+        await self._uncache_album(album_path)
+        self.redirect(str(web_redirect))
+
+
+class UploadSessionsHandler(BaseHandler):
+    """
+    Start resumable uploads.
 
-        path = str(album_path.relative_to(ENV.SOURCE)).strip('/')
+    POST a JSON body of `album` (edit url), `filename`, `size`, and an
+    optional `chunk_size`, and get back the session status.
+    """
+    @catch_error
+    async def post(self):
         try:
-            await self.page_cache.delete(path)
-        except Exception as e:
-            logging.info('error removing %s from cache: %r', path, e)
+            args = json_loads(self.request.body)
+            album = str(args['album'])
+            filename = str(args['filename'])
+            size = int(args['size'])
+            chunk_size = int(args.get('chunk_size', 0))
+        except (ValueError, KeyError, TypeError):
+            raise HTTPError(400, reason='bad upload session arguments')
 
-        self.redirect(str(web_redirect))
+        try:
+            album_path = self._edit_album_path(album)
+        except ValueError:
+            raise HTTPError(400, reason='bad album')
+        if not sanitize_name(filename) or not await asyncio.to_thread(album_path.is_dir):
+            raise HTTPError(400, reason='bad album or filename')
+
+        await asyncio.to_thread(cleanup_sessions)
+        try:
+            session = await asyncio.to_thread(UploadSession.create, album, filename, size, chunk_size, self.current_user)
+        except UploadTooLarge as e:
+            raise HTTPError(413, reason=str(e))
+        except ValueError as e:
+            raise HTTPError(400, reason=str(e))
+        logging.info('started upload session %s for %s in %s', session.id, filename, album)
+        self.set_status(201)
+        self.write(session.status())
+
+
+class UploadSessionHandler(BaseHandler):
+    """
+    Resumable upload session.
+
+    PUT numbered chunks, GET the received ranges, POST to finalize,
+    or DELETE to abort.  Chunks may send their sha256 hex digest in the
+    `X-Chunk-SHA256` header to have them verified.
+    """
+    # sessions being finalized, so a retried finalize doesn't add the file twice
+    finalizing: set[str] = set()
+
+    async def _session(self, session_id: str) -> UploadSession:
+        try:
+            return await asyncio.to_thread(UploadSession, session_id)
+        except FileNotFoundError:
+            raise HTTPError(404, reason='upload session not found')
+
+    @catch_error
+    async def get(self, session_id, chunk=None):
+        session = await self._session(session_id)
+        self.write(await asyncio.to_thread(session.status))
+
+    @catch_error
+    async def put(self, session_id, chunk=None):
+        if chunk is None:
+            raise HTTPError(405)
+        session = await self._session(session_id)
+        try:
+            digest = await asyncio.to_thread(session.write_chunk, int(chunk), self.request.body,
+                                             self.request.headers.get('X-Chunk-SHA256'))
+        except ValueError as e:
+            raise HTTPError(400, reason=str(e))
+        self.write({'chunk': int(chunk), 'sha256': digest})
+
+    @catch_error
+    async def post(self, session_id, chunk=None):
+        if chunk is not None:
+            raise HTTPError(405)
+        if session_id in self.finalizing:
+            raise HTTPError(409, reason='upload session is already finalizing')
+        self.finalizing.add(session_id)
+        try:
+            session = await self._session(session_id)
+            album_path = self._edit_album_path(session.info['album'])
+            try:
+                upload = await asyncio.to_thread(session.assemble, album_path)
+            except ValueError as e:
+                raise HTTPError(409, reason=str(e))
+            try:
+                name = await self._add_upload(album_path, upload)
+            finally:
+                await asyncio.to_thread(upload.discard)
+            await asyncio.to_thread(session.remove)
+        finally:
+            self.finalizing.discard(session_id)
+        logging.info('finished upload session %s as %s', session_id, album_path / name)
+
+        await self._update_manifest(album_path, [name])
+        await self._uncache_album(album_path)
+        self.write({'name': name, 'url': str(Path('/') / (album_path / name).relative_to(ENV.SOURCE))})
+
+    @catch_error
+    async def delete(self, session_id, chunk=None):
+        if chunk is not None:
+            raise HTTPError(405)
+        session = await self._session(session_id)
+        await asyncio.to_thread(session.remove)
+        self.set_status(204)
 
 
 class SearchHandler(BaseHandler):
     """
     Handle searches
     """
-    def _process_results(self, results):
-        basedir = ENV.SOURCE
-        ret = []
-        for row in results:
-            doc = row['_source']
-            media_path = basedir / doc['path'].lstrip('/')
-            logging.info('processing search result %s', media_path)
+    async def _process_results(self, results):
+        """
+        Build results from the indexed docs.
 
-            if media_path.is_dir():
-                media = AlbumItem(media_path)
+        Only docs indexed before they stored the rendering fields are
+        read from the filesystem, until the next reindex.
+        """
+        basedir = ENV.SOURCE
+        ret: list[AlbumItem | SearchResult | None] = []
+        old = {}
+        for i, row in enumerate(results):
+            source = row['_source']
+            if SearchResult.indexed(source):
+                media = SearchResult(source)
+                self.versions.update(media.versions)
+                ret.append(media)
             else:
-                media = Media(media_path)
-
-            ret.append(media)
+                old[i] = basedir / source['path'].lstrip('/')
+                ret.append(None)
+
+        if old:
+            logging.info('reading %d search results from the filesystem', len(old))
+            paths = list(old.values())
+            dirs = await asyncio.to_thread(lambda: {path for path in paths if path.is_dir()})
+            metadata = await read_metadata_many(paths, dirs=dirs)
+
+            def make_items():
+                for i, media_path in old.items():
+                    if media_path in dirs:
+                        ret[i] = AlbumItem(media_path, meta=metadata[media_path])
+                    else:
+                        ret[i] = Media(media_path, meta=metadata[media_path], image_sizes=self.image_sizes)
+
+            await asyncio.to_thread(make_items)
         return ret
 
-    @catch_error
-    async def get(self):
+    async def _search(self, source: list[str] | None = None) -> dict[str, Any]:
+        """
+        Get a page of search results, from the `query`, `limit`, and `cursor` args.
+
+        First pages are cached, and later pages are fetched from a
+        point-in-time opened when a first page's cursor is followed.
+
+        Returns:
+            dict of query, limit, total, offset, ES hits, and the cursor for the next page
+        """
         query = self.get_argument('query', '')
         try:
             limit = int(self.get_argument('limit', '100'))
         except (TypeError, ValueError):
             limit = 100
+        limit = min(max(1, limit), ENV.SEARCH_PAGE_SIZE)
+        cursor = self.get_argument('cursor', None)
 
         logging.info('limit: %d, query: %s', limit, query)
-        if query:
-            ret = await self.indexer.search(query, limit)
-            #logging.info('ret: %r', ret)
-            total = ret['hits']['total']['value']
-            results = self._process_results(ret['hits']['hits'])
+        ret = {'query': query, 'limit': limit, 'total': 0, 'offset': 0, 'hits': [], 'cursor': None}
+        if not query:
+            return ret
+
+        async def fetch():
+            try:
+                res, offset, next_cursor = await self.indexer.search_page(query, limit, cursor=cursor, source=source)
+            except ValueError as e:
+                raise HTTPError(400, reason=str(e))
+            except NotFoundError:
+                raise HTTPError(410, reason='search cursor expired')
+            return {'total': res['hits']['total']['value'], 'offset': offset, 'hits': res['hits']['hits'], 'cursor': next_cursor}
+
+        if cursor:
+            ret.update(await fetch())
         else:
-            total = 0
-            results = []
+            ret.update(await self.search_cache.get(query, fetch, limit=limit, source=source))
+        return ret
+
+    @catch_error
+    async def get(self):
+        page = await self._search()
+        results = await self._process_results(page.pop('hits'))
+        await self._prepare_versions([url for media in results for url in media.src_urls()])
+        await self.image_sizes.flush()
 
         title = 'Gallery - Search'
-        self.render('search.html', title=title, query=query, limit=limit, total=total, results=results)
+        self.render('search.html', title=title, results=results, **page)
 
     async def post(self):
         await self.get()
 
 
+class SearchApiHandler(SearchHandler):
+    """
+    Get a page of search results as JSON.
+
+    Pass the returned `cursor` to get the next page.  With a `fields`
+    arg, only those fields of the indexed docs are returned.
+    """
+    @catch_error
+    async def get(self):
+        fields = self.get_argument('fields', None)
+        if fields is not None:
+            page = await self._search(source=[f for f in fields.split(',') if f])
+            page['items'] = [{'id': hit['_id'], 'score': hit['_score'], **hit.get('_source', {})} for hit in page.pop('hits')]
+        else:
+            page = await self._search()
+            results = await self._process_results(page.pop('hits'))
+            await self._prepare_versions([url for media in results for url in media.src_urls()])
+            await self.image_sizes.flush()
+            page['items'] = [dict(self._api_item(media), album_url=media.album_url) for media in results]
+        self.write(page)
+
+
 class HealthHandler(BaseHandler):
     """
     Handle health requests.
@@ -563,6 +1035,7 @@ class HealthHandler(BaseHandler):
             status['es'] = 'fail'
             self.send_error(500, reason='error from elasticsearch')
 
+        status['version_cache'] = dict(self.version_cache.stats, size=len(self.version_cache.lru))
         self.write(status)
 
 
@@ -571,6 +1044,37 @@ class StaticServer(StaticFileHandler):
         self._headers['Server'] = 'Gallery/' + gallery.__version__
 
 
+class DerivativeHandler(StaticServer):
+    """
+    Serve screen sized image derivatives, making them on first request.
+
+    Urls are `/_derivative/<width>/<image path>.<format>`.
+    """
+    def initialize(self, path, thumbnails):
+        super().initialize(path=path)
+        self.thumbnails = thumbnails
+
+    async def get(self, path, include_body=True):
+        width, _, rel = path.partition('/')
+        suffix = '.' + ENV.DERIVATIVE_FORMAT
+        if not width.isdigit() or int(width) not in derivative_widths() or not rel.endswith(suffix):
+            raise HTTPError(404)
+        rel_path = Path(rel[:-len(suffix)])
+        if '..' in rel_path.parts or rel_path.is_absolute():
+            raise HTTPError(404)
+        src = ENV.SOURCE / rel_path
+        if get_type(src) != 'image' or not await asyncio.to_thread(src.is_file):
+            raise HTTPError(404)
+
+        try:
+            await self.thumbnails.derivative(src, int(width))
+        except Exception:
+            logging.info('cannot make derivative %s', path, exc_info=True)
+            self.redirect('/_src/' + str(rel_path))
+            return
+        await super().get(path, include_body)
+
+
 class Server:
     def __init__(self):
         template_path = ENV.THEME / 'templates'
@@ -588,6 +1092,10 @@ class Server:
         if not source_path.is_dir():
             raise Exception('bad src path')
 
+        derivative_path = ENV.DERIVATIVES
+        logging.info('derivative path: %s', derivative_path)
+        derivative_path.mkdir(parents=True, exist_ok=True)
+
         rest_config: dict[str, Any] = {
             'debug': ENV.CI_TEST,
         }
@@ -599,20 +1107,30 @@ class Server:
 
         handler_args = RestHandlerSetup(rest_config)
         self.es = AsyncElasticsearch(hosts=ENV.ES_ADDRESS)
-        handler_args['indexer'] = Indexer(self.es, ENV.ES_INDEX)
+        self.version_cache = VersionCache()
+        handler_args['version_cache'] = self.version_cache
+        handler_args['image_sizes'] = ImageSizeCache()
+        handler_args['indexer'] = Indexer(self.es, ENV.ES_INDEX, version_cache=self.version_cache, search_cache=SearchCache(),
+                                          image_sizes=handler_args['image_sizes'])
+        self.thumbnails = ThumbnailQueue(self.version_cache, indexer=handler_args['indexer'])
+        handler_args['thumbnails'] = self.thumbnails
 
         server = RestServer(
             debug=ENV.CI_TEST,
             serve_traceback=False,
             template_path=str(template_path),
-            max_body_size=2**31,  # support 2GB uploads
         )
 
         server.add_route('/edit/_upload', UploadHandler, handler_args)
+        server.add_route('/edit/_upload/session', UploadSessionsHandler, handler_args)
+        server.add_route(r'/edit/_upload/session/(?P<session_id>[0-9a-f]{32})(?:/(?P<chunk>[0-9]+))?', UploadSessionHandler, handler_args)
         server.add_route(r'/edit(?P<path>.*)', EditHandler, handler_args)
         server.add_route('/search', SearchHandler, handler_args)
+        server.add_route('/_api/search', SearchApiHandler, handler_args)
         server.add_route('/healthz', HealthHandler, handler_args)
+        server.add_route(r'/_api/album(?P<path>.*)', AlbumApiHandler, handler_args)
         server.add_route(r'/_src/(.*)', StaticServer, {"path": str(source_path)})
+        server.add_route(r'/_derivative/(.*)', DerivativeHandler, {"path": str(derivative_path), "thumbnails": self.thumbnails})
         server.add_route(r'/static/(.*)', StaticServer, {"path": str(static_path)})
         server.add_route('/(favicon.ico)', StaticServer, {"path": str(static_path)})
         server.add_route(r'/(?P<path>.*)', AlbumHandler, handler_args)
@@ -620,10 +1138,28 @@ class Server:
         server.startup(address=ENV.SERVER_HOST, port=ENV.SERVER_PORT)
 
         self.server = server
+        self.watcher = None
+        self.page_cache_listener: asyncio.Task | None = None
 
     async def start(self):
-        return
+        self.thumbnails.start()
+        self.page_cache_listener = asyncio.create_task(PageCache().listen())
+        if ENV.WATCH_MODE != 'off':
+            rewarm_url = None
+            if ENV.WATCH_REWARM:
+                host = ENV.SERVER_HOST if ENV.SERVER_HOST not in ('', '0.0.0.0', '::') else 'localhost'
+                rewarm_url = f'http://{host}:{ENV.SERVER_PORT}'
+            self.watcher = Watcher(PageCache(), rewarm_url=rewarm_url, version_cache=self.version_cache,
+                                   image_sizes=ImageSizeCache())
+            await self.watcher.start()
 
     async def stop(self):
+        if self.watcher:
+            await self.watcher.stop()
+        await self.thumbnails.stop()
+        if self.page_cache_listener:
+            self.page_cache_listener.cancel()
+            await asyncio.gather(self.page_cache_listener, return_exceptions=True)
         await self.server.stop()
         await self.es.close()
+        self.version_cache.close()
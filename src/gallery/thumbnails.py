@@ -0,0 +1,359 @@
+"""
+Make thumbnails and image derivatives in the background, off the event loop.
+
+Thumbnails are made with Pillow on a process pool, fed by a queue with
+at most `ENV.THUMBNAIL_WORKERS` jobs running at once, so handlers can
+respond as soon as an upload is written.  ImageMagick is only used as a
+fallback for formats Pillow cannot decode.  When a job finishes, the
+sidecar, album manifest, page cache, and search index are updated.
+
+Derivatives are screen sized copies of images, stored in a tree under
+`ENV.DERIVATIVES` that mirrors the source.  They are made eagerly on
+upload, or on first request.
+"""
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+import logging
+import multiprocessing
+import os
+from pathlib import Path
+import subprocess
+from typing import Any
+
+from PIL import ExifTags, Image, ImageOps
+
+from .albums import UPLOAD_PREFIX, album_key, derivative_widths
+from .caching import PageCache
+from .config import ENV
+from .dimensions import IMAGE_SIZE_KEY, image_size_meta, read_image_size
+from .index import Indexer
+from .manifest import update_manifest
+from .util import get_type, update_metadata
+from .versions import VersionCache
+
+
+logger = logging.getLogger('thumbnails')
+
+
+THUMBNAIL_SIZE = (150, 150)
+
+# formats that need to be saved without transparency
+RGB_FORMATS = {'JPEG'}
+
+
+def _save(img: Image.Image, dest: Path, **kwargs):
+    """Save an image atomically, in the format given by the file suffix."""
+    fmt = Image.registered_extensions().get(dest.suffix.lower())
+    if not fmt:
+        raise ValueError(f'unknown image format for {dest}')
+    if fmt in RGB_FORMATS and img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    # hidden from album listings, the watcher, and the indexer until renamed
+    tmp_path = dest.with_name(f'{UPLOAD_PREFIX}{dest.name}.{os.getpid()}.tmp')
+    try:
+        img.save(tmp_path, format=fmt, **kwargs)
+        os.replace(tmp_path, dest)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def make_thumbnail(src: Path, dest: Path, size: tuple[int, int] = THUMBNAIL_SIZE):
+    """
+    Make a thumbnail with Pillow.
+
+    JPEGs are downscaled while decoding with `draft`, so full size images
+    are never decoded, then the image is oriented by its EXIF tag and
+    reduced to fit within `size`.
+
+    Raises OSError if Pillow cannot decode the image.
+    """
+    with Image.open(src) as img:
+        img.draft('RGB', size)
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail(size, reducing_gap=2.0)
+        _save(img, dest)
+
+
+def make_derivative(src: Path, dest: Path, width: int, quality: int = 80):
+    """
+    Make a derivative of an image, scaled down to a width.
+
+    The derivative gets the same mtime as the source, to tell when it is
+    out of date.
+
+    Raises OSError if Pillow cannot decode the image.
+    """
+    st = src.stat()
+    with Image.open(src) as img:
+        w, h = img.size
+        height = max(1, round(h * width / w))
+        if img.getexif().get(ExifTags.Base.Orientation, 1) in (5, 6, 7, 8):
+            # rotated by 90 degrees, so the target width is the stored height
+            height = max(1, round(w * width / h))
+            img.draft('RGB', (height, width))
+        else:
+            img.draft('RGB', (width, height))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((width, height), reducing_gap=3.0)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        _save(img, dest, quality=quality)
+    os.utime(dest, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+def derivative_path(src: Path, width: int) -> Path:
+    """Get the derivative path for an image in the source tree."""
+    rel = src.relative_to(ENV.SOURCE)
+    return ENV.DERIVATIVES / str(width) / f'{rel}.{ENV.DERIVATIVE_FORMAT}'
+
+
+def _is_fresh(src: Path, dest: Path) -> bool:
+    try:
+        return dest.stat().st_mtime_ns == src.stat().st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def orient_image(path: Path) -> bool:
+    """
+    Rotate an image in place to match its EXIF orientation tag.
+
+    Raises OSError if Pillow cannot decode the image.
+
+    Returns:
+        True if the image was rotated
+    """
+    with Image.open(path) as img:
+        if img.getexif().get(ExifTags.Base.Orientation, 1) == 1:
+            return False
+        fmt = img.format
+        rotated = ImageOps.exif_transpose(img)
+    kwargs = {'quality': 95} if fmt == 'JPEG' else {}
+    if exif := rotated.info.get('exif'):
+        kwargs['exif'] = exif
+    _save(rotated, path, **kwargs)
+    return True
+
+
+async def run_convert(*args: str | Path):
+    """Run ImageMagick `convert`, raising RuntimeError on failure."""
+    proc = await asyncio.create_subprocess_exec(
+        'convert', *(str(a) for a in args),
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+    _, stderr = await proc.communicate()
+    if proc.returncode:
+        raise RuntimeError(f'convert failed: {stderr.decode("utf-8", errors="replace").strip()}')
+
+
+def thumbnail_path(path: Path) -> Path:
+    """Get the default thumbnail path for an album or media file."""
+    if path.is_dir():
+        return path / 'thumbnails' / 'thumb.jpg'
+    else:
+        return path.parent / 'thumbnails' / path.name
+
+
+def find_album_image(path: Path) -> Path | None:
+    """Find an image in an album to make the album thumbnail from."""
+    for src_path in sorted(path.iterdir()):
+        if src_path.is_file() and get_type(src_path) == 'image':
+            return src_path
+    return None
+
+
+@dataclass
+class ThumbnailJob:
+    """
+    A thumbnail to make for an album or media file.
+
+    Args:
+        path: album dir or media file
+        upload: uploaded thumbnail contents, or None to make one from the media
+        upload_suffix: file suffix of the uploaded thumbnail
+        prev_thumb: previous thumbnail, relative to the album, to remove when replaced
+        orient: auto-orient the media file in place first
+    """
+    path: Path
+    upload: bytes | None = None
+    upload_suffix: str = '.jpg'
+    prev_thumb: str | None = None
+    orient: bool = False
+
+
+class ThumbnailQueue:
+    """
+    Queue of thumbnail jobs, run by a bounded pool of background workers.
+
+    Args:
+        version_cache: version cache used when updating album manifests
+        workers: max number of jobs to run at once
+        indexer: search indexer to update with the new thumbnail, if any
+    """
+    def __init__(self, version_cache: VersionCache | None = None, workers: int = ENV.THUMBNAIL_WORKERS,
+                 indexer: Indexer | None = None):
+        self.version_cache = version_cache
+        self.indexer = indexer
+        self.workers = workers
+        self.queue: asyncio.Queue[ThumbnailJob] = asyncio.Queue()
+        self.page_cache = PageCache()
+        # the server runs many threads, which forked workers could inherit held locks from
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(
+            'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'))
+        self._tasks: list[asyncio.Task] = []
+        self._derivatives: dict[Path, asyncio.Future] = {}
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def put(self, job: ThumbnailJob):
+        logger.info('queueing thumbnail for %s', job.path)
+        self.queue.put_nowait(job)
+
+    async def join(self):
+        """Wait for all queued jobs to finish."""
+        await self.queue.join()
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self.run(job)
+            except Exception:
+                logger.warning('cannot make thumbnail for %s', job.path, exc_info=True)
+            finally:
+                self.queue.task_done()
+
+    async def orient(self, path: Path):
+        """Auto-orient an image in place."""
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.executor, orient_image, path)
+        except OSError:
+            logger.info('cannot orient %s with Pillow, trying ImageMagick', path, exc_info=True)
+            await run_convert(path, '-auto-orient', path)
+
+    async def thumbnail(self, src: Path, dest: Path):
+        """Make a thumbnail."""
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.executor, make_thumbnail, src, dest)
+        except (OSError, ValueError):
+            logger.info('cannot make thumbnail of %s with Pillow, trying ImageMagick', src, exc_info=True)
+            w, h = THUMBNAIL_SIZE
+            await run_convert(src, '-resize', f'{w}x{h}', '-auto-orient', dest)
+
+    async def derivative(self, src: Path, width: int) -> Path:
+        """
+        Get a derivative of an image, making it if missing or out of date.
+
+        Concurrent requests for the same derivative share a single job.
+
+        Args:
+            src: image path in the source tree
+            width: derivative width
+
+        Returns:
+            the derivative path
+        """
+        dest = derivative_path(src, width)
+        if await asyncio.to_thread(_is_fresh, src, dest):
+            return dest
+        if (fut := self._derivatives.get(dest)) is None:
+            logger.info('making %dpx derivative of %s', width, src)
+            loop = asyncio.get_running_loop()
+            fut = loop.run_in_executor(self.executor, make_derivative, src, dest, width, ENV.DERIVATIVE_QUALITY)
+            self._derivatives[dest] = fut
+            fut.add_done_callback(lambda _: self._derivatives.pop(dest, None))
+        await asyncio.shield(fut)
+        return dest
+
+    async def make_derivatives(self, src: Path):
+        """Make all the derivatives smaller than an image."""
+        width, _ = await asyncio.to_thread(read_image_size, src)
+        for w in derivative_widths():
+            if w < width:
+                await self.derivative(src, w)
+
+    async def run(self, job: ThumbnailJob) -> str | None:
+        """
+        Make a thumbnail, then record it.
+
+        Returns:
+            the thumbnail path relative to the album, or None if there is nothing to make one from
+        """
+        if job.orient:
+            await self.orient(job.path)
+
+        thumb_path = thumbnail_path(job.path)
+        await asyncio.to_thread(thumb_path.parent.mkdir, exist_ok=True)
+        if job.upload is not None:
+            thumb_path = thumb_path.with_suffix(job.upload_suffix)
+            await asyncio.to_thread(thumb_path.write_bytes, job.upload)
+            src_path: Path | None = thumb_path
+        elif job.path.is_dir():
+            src_path = await asyncio.to_thread(find_album_image, job.path)
+        else:
+            src_path = job.path
+        if not src_path:
+            logger.info('no image to make a thumbnail for %s', job.path)
+            return None
+
+        await self.thumbnail(src_path, thumb_path)
+        thumbnail = 'thumbnails/' + thumb_path.name
+        await asyncio.to_thread(self._write_metadata, job, thumbnail)
+        await self._invalidate(job.path)
+        await self._reindex(job.path)
+        logger.info('made thumbnail %s for %s', thumbnail, job.path)
+
+        if job.orient and get_type(job.path) == 'image' and job.path.suffix.lower() != '.gif':
+            try:
+                await self.make_derivatives(job.path)
+            except Exception:
+                logger.info('cannot make derivatives of %s', job.path, exc_info=True)
+        return thumbnail
+
+    @staticmethod
+    def _write_metadata(job: ThumbnailJob, thumbnail: str):
+        # only set our keys, so edits made while the job was queued are kept
+        updates: dict[str, Any] = {'thumbnail': thumbnail}
+        if job.orient and get_type(job.path) == 'image':
+            updates[IMAGE_SIZE_KEY] = image_size_meta(job.path)
+        update_metadata(job.path, updates)
+        if job.prev_thumb and job.prev_thumb != thumbnail:
+            album = job.path if job.path.is_dir() else job.path.parent
+            (album / job.prev_thumb).unlink(missing_ok=True)
+
+    async def _invalidate(self, path: Path):
+        """Update the manifests and page cache for the albums showing a path."""
+        albums = [(path.parent, [path.name])]
+        if path.is_dir():
+            albums.insert(0, (path, []))
+        for album, names in albums:
+            if album != ENV.SOURCE and ENV.SOURCE not in album.parents:
+                continue
+            try:
+                await update_manifest(album, names, version_cache=self.version_cache)
+            except Exception:
+                logger.info('error updating manifest for %s', album, exc_info=True)
+            key = album_key(album)
+            try:
+                await self.page_cache.delete(key)
+            except Exception:
+                logger.info('error removing %s from cache', key, exc_info=True)
+
+    async def _reindex(self, path: Path):
+        """Update the search doc, which stores the thumbnail url and version."""
+        if not self.indexer:
+            return
+        try:
+            await self.indexer.add_one(path)
+        except Exception:
+            logger.info('error reindexing %s', path, exc_info=True)
@@ -0,0 +1,411 @@
+"""
+Stream multipart uploads to disk, and stage resumable chunked uploads.
+
+Tornado buffers whole request bodies in memory, so uploads are parsed
+incrementally instead.  Each file part is written straight to a temp
+file in the target album and hashed as it arrives, then renamed into
+place when the request completes.
+
+Resumable uploads are sent as numbered chunks, which are kept in a
+staging dir under `ENV.SOURCE` until the upload is finalized, so a
+dropped connection only loses the chunk in flight.
+"""
+import email.message
+import email.utils
+from hashlib import sha256
+import json
+import logging
+import math
+import os
+from pathlib import Path
+import shutil
+import time
+from typing import Any
+import uuid
+
+from tornado.httputil import HTTPHeaders, HTTPInputError
+
+from .albums import UPLOAD_PREFIX
+from .config import ENV
+from .util import json_loads
+from .versions import version_hasher
+
+
+STAGING_NAME = UPLOAD_PREFIX + 'staging'
+
+
+class MultipartError(ValueError):
+    pass
+
+
+class UploadTooLarge(ValueError):
+    pass
+
+
+def get_boundary(content_type: str) -> bytes:
+    """Get the boundary of a multipart/form-data Content-Type header."""
+    for field in content_type.split(';')[1:]:
+        key, _, val = field.strip().partition('=')
+        if key.lower() == 'boundary' and val:
+            return val.strip('"').encode('latin1')
+    raise MultipartError('missing multipart boundary')
+
+
+def parse_disposition(value: str) -> tuple[str, str | None]:
+    """Get the form field name and filename from a Content-Disposition header."""
+    msg = email.message.Message()
+    msg['Content-Disposition'] = value
+    name = msg.get_param('name', '', header='Content-Disposition')
+    return email.utils.collapse_rfc2231_value(name), msg.get_filename()
+
+
+class MultipartParser:
+    """
+    Incremental parser for multipart/form-data bodies.
+
+    Feed it chunks of the body as they arrive, and it returns parse
+    events for each chunk:
+
+        ('part', headers): start of a part
+        ('data', bytes): part contents, in one or more pieces
+        ('end', None): end of a part
+
+    At most a delimiter's worth of the body is held back between chunks.
+
+    Args:
+        boundary: multipart boundary, see `get_boundary`
+        max_header_size: max size of the headers of a part
+    """
+    def __init__(self, boundary: bytes, max_header_size: int = 64 * 1024):
+        self.delimiter = b'--' + boundary
+        self.separator = b'\r\n--' + boundary
+        self.max_header_size = max_header_size
+        self.buffer = bytearray()
+        self.state = 'preamble'
+
+    @property
+    def finished(self) -> bool:
+        return self.state == 'done'
+
+    def feed(self, chunk: bytes) -> list[tuple[str, Any]]:
+        """
+        Parse the next chunk of the body.
+
+        Raises MultipartError if the body is malformed.
+        """
+        self.buffer += chunk
+        events: list[tuple[str, Any]] = []
+        while True:
+            if self.state == 'preamble':
+                idx = self.buffer.find(self.delimiter)
+                if idx < 0:
+                    del self.buffer[:-len(self.delimiter)]
+                    break
+                del self.buffer[:idx + len(self.delimiter)]
+                self.state = 'boundary'
+
+            elif self.state == 'boundary':
+                if len(self.buffer) < 2:
+                    break
+                if self.buffer.startswith(b'--'):
+                    # ignore the epilogue
+                    self.state = 'done'
+                    continue
+                idx = self.buffer.find(b'\r\n')
+                if idx < 0:
+                    if len(self.buffer) > 1024:
+                        raise MultipartError('bad multipart boundary')
+                    break
+                if self.buffer[:idx].strip(b' \t'):
+                    raise MultipartError('bad multipart boundary')
+                del self.buffer[:idx + 2]
+                self.state = 'headers'
+
+            elif self.state == 'headers':
+                if self.buffer.startswith(b'\r\n'):
+                    idx, end = 0, 2
+                else:
+                    idx = self.buffer.find(b'\r\n\r\n')
+                    end = idx + 4
+                if idx < 0:
+                    if len(self.buffer) > self.max_header_size:
+                        raise MultipartError('multipart headers too large')
+                    break
+                try:
+                    headers = HTTPHeaders.parse(self.buffer[:idx].decode('utf-8'))
+                except (UnicodeDecodeError, HTTPInputError) as e:
+                    raise MultipartError('bad multipart headers') from e
+                del self.buffer[:end]
+                events.append(('part', headers))
+                self.state = 'body'
+
+            elif self.state == 'body':
+                idx = self.buffer.find(self.separator)
+                if idx < 0:
+                    # hold back what could be the start of a separator
+                    keep = len(self.separator) - 1
+                    if len(self.buffer) > keep:
+                        events.append(('data', bytes(self.buffer[:-keep])))
+                        del self.buffer[:-keep]
+                    break
+                if idx:
+                    events.append(('data', bytes(self.buffer[:idx])))
+                events.append(('end', None))
+                del self.buffer[:idx + len(self.separator)]
+                self.state = 'boundary'
+
+            else:
+                self.buffer.clear()
+                break
+        return events
+
+    def close(self):
+        """Raises MultipartError if the body was truncated."""
+        if not self.finished:
+            raise MultipartError('truncated multipart body')
+
+
+class UploadFile:
+    """
+    An uploaded file, streamed to a temp file and hashed as it is written.
+
+    The temp file is hidden from album listings until `commit` renames it
+    into place.
+
+    Args:
+        dirpath: dir to write the temp file in, on the same filesystem as the destination
+        filename: filename given by the client
+        field: form field name
+    """
+    def __init__(self, dirpath: Path, filename: str, field: str = ''):
+        self.filename = filename
+        self.field = field
+        self.tmp_path = dirpath / f'{UPLOAD_PREFIX}{uuid.uuid4().hex}.tmp'
+        self.size = 0
+        self.hasher = version_hasher()
+        self.committed = False
+        self.f = open(self.tmp_path, 'xb')
+
+    def write(self, data: bytes):
+        self.f.write(data)
+        self.hasher.update(data)
+        self.size += len(data)
+
+    def close(self):
+        self.f.close()
+
+    @property
+    def token(self) -> str:
+        """Full content version token, see `versions.hash_file`."""
+        return self.hasher.hexdigest()
+
+    def read_bytes(self) -> bytes:
+        self.f.close()
+        return self.tmp_path.read_bytes()
+
+    def commit(self, dest: Path):
+        """Atomically move the upload into place."""
+        self.f.close()
+        os.replace(self.tmp_path, dest)
+        self.committed = True
+
+    def discard(self):
+        """Remove the temp file, unless committed."""
+        self.f.close()
+        if not self.committed:
+            self.tmp_path.unlink(missing_ok=True)
+
+
+class UploadSession:
+    """
+    A resumable upload, staged as numbered chunks.
+
+    Each chunk is stored as `<index>.<sha256>.chunk` in the session dir,
+    so chunks can be written concurrently and re-sent without any shared
+    state to update.  All chunks are `chunk_size` long, except the last.
+
+    Raises FileNotFoundError if the session does not exist.
+
+    Args:
+        session_id: session id
+    """
+    INFO_NAME = 'session.json'
+
+    def __init__(self, session_id: str):
+        self.id = session_id
+        self.path = staging_dir() / session_id
+        with open(self.path / self.INFO_NAME, 'rb') as f:
+            self.info: dict[str, Any] = json_loads(f.read())
+
+    @classmethod
+    def create(cls, album: str, filename: str, size: int, chunk_size: int = 0, user: str | None = None) -> 'UploadSession':
+        """
+        Create a new upload session.
+
+        Args:
+            album: album edit url, as in the upload form
+            filename: filename given by the client
+            size: total file size
+            chunk_size: requested chunk size, or 0 for the default
+            user: uploading user
+
+        Returns:
+            the new session
+        """
+        if size < 0:
+            raise ValueError('bad size')
+        if size > ENV.UPLOAD_MAX_SIZE:
+            raise UploadTooLarge(f'upload is larger than {ENV.UPLOAD_MAX_SIZE} bytes')
+        if not chunk_size:
+            chunk_size = ENV.UPLOAD_CHUNK_SIZE
+        if not 1024 <= chunk_size <= ENV.UPLOAD_CHUNK_MAX_SIZE:
+            raise ValueError('bad chunk size')
+        session_id = uuid.uuid4().hex
+        path = staging_dir() / session_id
+        path.mkdir(parents=True)
+        info = {
+            'album': album,
+            'filename': filename,
+            'size': size,
+            'chunk_size': chunk_size,
+            'user': user,
+            'created': time.time(),
+        }
+        with open(path / cls.INFO_NAME, 'w') as f:
+            json.dump(info, f)
+        return cls(session_id)
+
+    @property
+    def num_chunks(self) -> int:
+        return math.ceil(self.info['size'] / self.info['chunk_size'])
+
+    def chunk_length(self, index: int) -> int:
+        """Get the expected length of a chunk, raising ValueError for a bad index."""
+        if not 0 <= index < self.num_chunks:
+            raise ValueError(f'bad chunk index {index}')
+        return min(self.info['chunk_size'], self.info['size'] - index * self.info['chunk_size'])
+
+    def chunks(self) -> dict[int, tuple[Path, str]]:
+        """Get the received chunks, as index: (path, checksum)."""
+        ret = {}
+        for entry in os.scandir(self.path):
+            parts = entry.name.split('.')
+            if len(parts) == 3 and parts[2] == 'chunk' and parts[0].isdigit():
+                ret[int(parts[0])] = (Path(entry.path), parts[1])
+        return ret
+
+    def write_chunk(self, index: int, data: bytes, checksum: str | None = None) -> str:
+        """
+        Atomically store a chunk, replacing any earlier copy.
+
+        Args:
+            index: chunk index
+            data: chunk contents
+            checksum: sha256 hex digest sent by the client, to verify the chunk
+
+        Returns:
+            the sha256 hex digest of the chunk
+        """
+        if len(data) != self.chunk_length(index):
+            raise ValueError(f'chunk {index} should be {self.chunk_length(index)} bytes')
+        digest = sha256(data).hexdigest()
+        if checksum and checksum.lower() != digest:
+            raise ValueError(f'checksum mismatch for chunk {index}')
+
+        old = self.chunks().get(index)
+        dest = self.path / f'{index}.{digest}.chunk'
+        tmp_path = self.path / f'.{index}.{uuid.uuid4().hex}.tmp'
+        try:
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, dest)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        if old and old[0] != dest:
+            old[0].unlink(missing_ok=True)
+        return digest
+
+    def missing(self) -> list[int]:
+        chunks = self.chunks()
+        return [i for i in range(self.num_chunks) if i not in chunks]
+
+    def received(self) -> list[list[int]]:
+        """Get the received byte ranges, as merged [start, end) pairs."""
+        ret: list[list[int]] = []
+        chunk_size = self.info['chunk_size']
+        for index in sorted(self.chunks()):
+            start = index * chunk_size
+            end = start + self.chunk_length(index)
+            if ret and ret[-1][1] == start:
+                ret[-1][1] = end
+            else:
+                ret.append([start, end])
+        return ret
+
+    def status(self) -> dict[str, Any]:
+        return {
+            'id': self.id,
+            'filename': self.info['filename'],
+            'size': self.info['size'],
+            'chunk_size': self.info['chunk_size'],
+            'chunks': self.num_chunks,
+            'received': self.received(),
+            'missing': self.missing(),
+        }
+
+    def assemble(self, dirpath: Path) -> UploadFile:
+        """
+        Join the chunks into an upload, verifying each chunk's checksum.
+
+        Chunks that fail verification are removed, so they can be sent again.
+
+        Args:
+            dirpath: dir to write the upload temp file in, see `UploadFile`
+
+        Returns:
+            the upload, ready to commit
+        """
+        chunks = self.chunks()
+        if missing := [i for i in range(self.num_chunks) if i not in chunks]:
+            raise ValueError(f'missing chunks {missing}')
+        upload = UploadFile(dirpath, self.info['filename'])
+        try:
+            for index in range(self.num_chunks):
+                path, checksum = chunks[index]
+                data = path.read_bytes()
+                if sha256(data).hexdigest() != checksum:
+                    path.unlink(missing_ok=True)
+                    raise ValueError(f'chunk {index} is corrupt')
+                upload.write(data)
+            upload.close()
+            if upload.size != self.info['size']:
+                raise ValueError(f'upload should be {self.info["size"]} bytes, got {upload.size}')
+        except BaseException:
+            upload.discard()
+            raise
+        return upload
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def staging_dir() -> Path:
+    """Get the dir resumable uploads are staged in."""
+    return ENV.SOURCE / STAGING_NAME
+
+
+def cleanup_sessions(max_age: float | None = None):
+    """Remove upload sessions older than `max_age` seconds, by default `ENV.UPLOAD_SESSION_TTL`."""
+    if max_age is None:
+        max_age = ENV.UPLOAD_SESSION_TTL
+    cutoff = time.time() - max_age
+    try:
+        entries = list(os.scandir(staging_dir()))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        try:
+            if entry.stat().st_mtime < cutoff:
+                logging.info('removing expired upload session %s', entry.name)
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            continue
@@ -1,8 +1,16 @@
+import asyncio
 from datetime import datetime, timezone
 import json
 from pathlib import Path
+import threading
 from typing import Any
 
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 from .config import ENV
 
 
@@ -43,19 +51,83 @@ def get_mime(path: Path) -> str:
     return MIME_TYPES.get(ext, 'application/octet-stream')
 
 
-def read_metadata(path: Path) -> dict[str, Any]:
-    if path.is_dir():
+def accepts_encoding(header: str, coding: str) -> bool:
+    """
+    Check whether an `Accept-Encoding` header accepts a content coding.
+
+    Codings with a q-value of 0 are refused, and `*` covers any coding
+    not listed by name.
+    """
+    qvalues = {}
+    for part in header.split(','):
+        name, *params = [p.strip() for p in part.split(';')]
+        if not name:
+            continue
+        q = 1.
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.
+        qvalues[name.lower()] = q
+    q = qvalues.get(coding.lower(), qvalues.get('*', 0.))
+    return q > 0
+
+
+def read_metadata(path: Path, is_dir: bool | None = None, exists: bool | None = None) -> dict[str, Any]:
+    """
+    Read the `.meta.json` sidecar for a file or dir.
+
+    Args:
+        path: file path
+        is_dir: whether path is a dir, if already known
+        exists: whether the sidecar exists, if already known
+    """
+    if is_dir is None:
+        is_dir = path.is_dir()
+    if is_dir:
         path = path / 'index.meta.json'
     else:
         path = path.with_suffix('.meta.json')
 
     ret = {'title': '', 'keywords': '', 'summary': '', 'description': ''}
-    if path.exists():
-        with open(path) as f:
-            ret.update(json.load(f))
+    if exists is not False:
+        try:
+            with open(path, 'rb') as f:
+                ret.update(json_loads(f.read()))
+        except FileNotFoundError:
+            pass
     return ret
 
 
+async def read_metadata_many(paths: list[Path], dirs: set[Path] | None = None, concurrency: int | None = None) -> dict[Path, dict[str, Any]]:
+    """
+    Read many `.meta.json` sidecars concurrently.
+
+    Sidecars are read on worker threads, with at most `concurrency`
+    in flight, so latency on network storage scales with concurrency
+    instead of the number of files.
+
+    Args:
+        paths: file paths
+        dirs: which of the paths are dirs, if already known
+        concurrency: max number of sidecars to read at once
+
+    Returns:
+        dict of path: metadata
+    """
+    sem = asyncio.Semaphore(concurrency if concurrency else ENV.METADATA_CONCURRENCY)
+
+    async def read(path):
+        async with sem:
+            is_dir = None if dirs is None else path in dirs
+            return path, await asyncio.to_thread(read_metadata, path, is_dir=is_dir)
+
+    return dict(await asyncio.gather(*(read(path) for path in paths)))
+
+
 def write_metadata(path: Path, data: dict[str, Any]):
     if path.is_dir():
         path = path / 'index.meta.json'
@@ -66,3 +138,25 @@ def write_metadata(path: Path, data: dict[str, Any]):
     ret.update(data)
     with open(path, 'w') as f:
         json.dump(ret, f, ensure_ascii=False, indent=2)
+
+
+# sidecar updates are serialized per path, on a fixed set of locks
+_metadata_locks = [threading.Lock() for _ in range(64)]
+
+
+def update_metadata(path: Path, updates: dict[str, Any]) -> dict[str, Any]:
+    """
+    Set some keys in the `.meta.json` sidecar for a file or dir.
+
+    The sidecar is re-read and written under a lock, so concurrent
+    updates of different keys (an edit and a thumbnail job) do not
+    overwrite each other.  Blocks, so call it from a worker thread.
+
+    Returns:
+        the updated metadata
+    """
+    with _metadata_locks[hash(path) % len(_metadata_locks)]:
+        meta = read_metadata(path)
+        meta.update(updates)
+        write_metadata(path, meta)
+    return meta
@@ -0,0 +1,278 @@
+"""
+Content version tokens for `/_src` media urls.
+"""
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
+import logging
+import os
+from pathlib import Path
+
+from .caching import RedisInstance
+from .config import ENV
+from .util import get_type
+
+
+def get_hash_mode(path: Path) -> str:
+    """Get the configured version hash mode for a file's media type."""
+    type_ = get_type(path)
+    if type_ == 'image':
+        return ENV.VERSION_HASH_IMAGE_MODE
+    elif type_ == 'video':
+        return ENV.VERSION_HASH_VIDEO_MODE
+    else:
+        return ENV.VERSION_HASH_FILE_MODE
+
+
+def version_hasher():
+    """Get a new hasher for full content version tokens."""
+    return blake2b(digest_size=ENV.VERSION_HASH_DIGEST_SIZE, person=ENV.VERSION_HASH_PERSON)
+
+
+def _hash_full(path: Path) -> str:
+    hasher = version_hasher()
+    b = bytearray(128 * 1024)
+    mv = memoryview(b)
+    with path.open('rb') as f:
+        # Known issue with MyPy: https://github.com/python/typeshed/issues/2166
+        for n in iter(lambda: f.readinto(mv), 0):
+            hasher.update(mv[:n])
+    return hasher.hexdigest()
+
+
+def _hash_ranges(path: Path, ranges: list[tuple[int, int]]) -> str:
+    """Hash the size, mtime, and the given (offset, length) ranges of a file."""
+    hasher = version_hasher()
+    with path.open('rb') as f:
+        st = os.fstat(f.fileno())
+        hasher.update(f'{st.st_size}:{st.st_mtime_ns}'.encode())
+        for offset, length in ranges:
+            f.seek(offset)
+            hasher.update(f.read(length))
+    return hasher.hexdigest()
+
+
+def _hash_fast(path: Path, size: int) -> str:
+    edge = ENV.VERSION_HASH_EDGE_KIB * 1024
+    if size <= 2 * edge:
+        ranges = [(0, size)]
+    else:
+        ranges = [(0, edge), (size - edge, edge)]
+    return _hash_ranges(path, ranges)
+
+
+def _hash_sampled(path: Path, size: int) -> str:
+    chunk = ENV.VERSION_HASH_SAMPLE_KIB * 1024
+    samples = max(ENV.VERSION_HASH_SAMPLES, 2)
+    if size <= samples * chunk:
+        ranges = [(0, size)]
+    else:
+        # evenly spaced, always including the first and last chunk
+        step = (size - chunk) // (samples - 1)
+        ranges = [(i * step, chunk) for i in range(samples - 1)]
+        ranges.append((size - chunk, chunk))
+    return _hash_ranges(path, ranges)
+
+
+def hash_file(path: Path, mode: str = 'full') -> str:
+    """
+    Hash a file to get a content version token.
+
+    Modes:
+        full: hash the whole file
+        fast: hash size, mtime, and the first and last few KiB
+        sampled: hash size, mtime, and evenly spaced chunks
+
+    Args:
+        path: file path
+        mode: hash mode
+    """
+    if mode == 'full':
+        return _hash_full(path)
+    elif mode == 'fast':
+        return _hash_fast(path, path.stat().st_size)
+    elif mode == 'sampled':
+        return _hash_sampled(path, path.stat().st_size)
+    else:
+        raise ValueError(f'unknown version hash mode {mode!r}')
+
+
+class VersionCache:
+    """
+    Cache of content version tokens for source files.
+
+    Entries are keyed on (path, size, mtime, inode), so a file is only
+    rehashed when it actually changes.  Lookups go to an in-process LRU,
+    which is backed by Redis so tokens survive restarts and are shared
+    between workers.  Redis entries expire, so keys of changed files do
+    not pile up.  Hashing runs on a bounded thread pool; `readinto` and
+    blake2b both release the GIL, so large files hash in parallel.
+
+    Args:
+        maxsize: max number of entries in the in-process LRU
+    """
+    def __init__(self, maxsize: int = ENV.VERSION_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.lru: OrderedDict[str, str] = OrderedDict()
+        self.redis = RedisInstance()
+        self.stats = {'hits': 0, 'redis_hits': 0, 'misses': 0}
+        self._tasks: set[asyncio.Task] = set()
+        self.executor = ThreadPoolExecutor(max_workers=ENV.VERSION_HASH_WORKERS, thread_name_prefix='version-hash')
+
+    @staticmethod
+    def key(path: Path, st: os.stat_result) -> str:
+        return f'version:{get_hash_mode(path)}:{path}:{st.st_size}:{st.st_mtime_ns}:{st.st_ino}'
+
+    def _get_local(self, key: str) -> str | None:
+        try:
+            self.lru.move_to_end(key)
+        except KeyError:
+            return None
+        return self.lru[key]
+
+    def _set_local(self, key: str, val: str):
+        self.lru[key] = val
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.maxsize:
+            self.lru.popitem(last=False)
+
+    async def _set_remote(self, key: str, val: str):
+        try:
+            await self.redis.set(key, val, ttl=ENV.VERSION_CACHE_TTL)
+        except Exception:
+            logging.debug('cannot cache version %s', key, exc_info=True)
+
+    def lookup(self, path: Path) -> str:
+        """
+        Get the version token for a file, hashing it on a cache miss.
+
+        The hash mode is picked by media type, see `get_hash_mode`.
+        This blocks while hashing, so async code should use `get_many`.
+        """
+        key = self.key(path, path.stat())
+        if (ret := self._get_local(key)) is not None:
+            self.stats['hits'] += 1
+            return ret
+
+        self.stats['misses'] += 1
+        ret = hash_file(path, get_hash_mode(path))
+        self._set_local(key, ret)
+        try:
+            task = asyncio.get_running_loop().create_task(self._set_remote(key, ret))
+        except RuntimeError:
+            pass  # no event loop, so local only
+        else:
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return ret
+
+    def _keys(self, paths: list[Path]) -> dict[Path, str]:
+        ret = {}
+        for path in paths:
+            try:
+                ret[path] = self.key(path, path.stat())
+            except OSError:
+                logging.info('cannot stat %s', path)
+        return ret
+
+    async def _get_remote_many(self, keys: list[str]) -> dict[str, str]:
+        try:
+            return await self.redis.get_many(keys)
+        except Exception:
+            logging.debug('cannot get cached versions', exc_info=True)
+        return {}
+
+    async def _set_remote_many(self, mapping: dict[str, str]):
+        try:
+            await self.redis.set_many(mapping, ttl=ENV.VERSION_CACHE_TTL)
+        except Exception:
+            logging.debug('cannot cache versions', exc_info=True)
+
+    async def get_many(self, paths: list[Path]) -> dict[Path, str]:
+        """
+        Get version tokens for many files concurrently.
+
+        All filesystem access and hashing runs on a bounded thread pool,
+        so the event loop is never blocked.  Files that cannot be read
+        are left out of the result.
+
+        Args:
+            paths: file paths
+
+        Returns:
+            dict of path: version token
+        """
+        loop = asyncio.get_running_loop()
+        keys = await loop.run_in_executor(self.executor, self._keys, list(set(paths)))
+
+        ret = {}
+        missing = []
+        for path, key in keys.items():
+            if (val := self._get_local(key)) is not None:
+                self.stats['hits'] += 1
+                ret[path] = val
+            else:
+                missing.append(path)
+
+        # one round trip for all the misses
+        remote = await self._get_remote_many([keys[path] for path in missing])
+        to_hash = []
+        for path in missing:
+            if (val := remote.get(keys[path])) is not None:
+                self.stats['redis_hits'] += 1
+                self._set_local(keys[path], val)
+                ret[path] = val
+            else:
+                to_hash.append(path)
+
+        hashed: dict[str, str] = {}
+
+        async def do_hash(path):
+            try:
+                val = await loop.run_in_executor(self.executor, hash_file, path, get_hash_mode(path))
+            except Exception:
+                logging.info('cannot hash %s', path, exc_info=True)
+                return
+            self.stats['misses'] += 1
+            self._set_local(keys[path], val)
+            hashed[keys[path]] = val
+            ret[path] = val
+
+        await asyncio.gather(*(do_hash(path) for path in to_hash))
+        if hashed:
+            await self._set_remote_many(hashed)
+        return ret
+
+    async def prime(self, path: Path, token: str):
+        """
+        Record the version token of a file that was hashed elsewhere, such as while uploading.
+
+        Only full hashes are recorded, as the other modes also hash the mtime.
+
+        Args:
+            path: file path
+            token: full content hash from `version_hasher`
+        """
+        if get_hash_mode(path) != 'full':
+            return
+        key = self.key(path, await asyncio.to_thread(path.stat))
+        self._set_local(key, token)
+        await self._set_remote(key, token)
+
+    async def get_urls(self, urls: list[str]) -> dict[str, str]:
+        """
+        Get version tokens for `/_src` urls.
+
+        Args:
+            urls: urls, of which only `/_src` urls are versioned
+
+        Returns:
+            dict of url: version token
+        """
+        paths = {url: ENV.SOURCE / url[6:] for url in urls if url.startswith('/_src/')}
+        tokens = await self.get_many(list(paths.values()))
+        return {url: tokens[path] for url, path in paths.items() if path in tokens}
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,453 @@
+"""
+Watch the album source tree for changes.
+
+Cached album pages are invalidated as soon as media, sidecars, or
+thumbnails change on disk, then queued for a background re-render.
+Only one server process watches at a time, elected with a Redis lock.
+"""
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+from pathlib import Path
+import re
+import struct
+from urllib.parse import quote
+
+from tornado.httpclient import AsyncHTTPClient
+
+from .albums import HIDDEN_PREFIXES, album_key, album_stamp
+from .caching import PageCache, RedisInstance
+from .config import ENV
+from .dimensions import ImageSizeCache
+from .manifest import update_manifest
+from .versions import VersionCache
+
+
+logger = logging.getLogger('watcher')
+
+
+# inotify constants, from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+EVENT_HEADER = struct.Struct('iIII')
+
+# filesystems where changes made on other hosts raise no inotify events
+NETWORK_FILESYSTEMS = {'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'ceph', 'glusterfs', 'lustre', 'gpfs', '9p', 'fuse.sshfs'}
+
+LEADER_LOCK = 'watcher:leader'
+
+
+class Inotify:
+    """
+    Minimal inotify wrapper using ctypes.
+
+    Raises OSError if inotify is not available.
+    """
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise OSError('cannot find libc')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError('inotify not supported')
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path: Path, mask: int = WATCH_MASK) -> int:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), str(path))
+        return wd
+
+    def read_events(self) -> list[tuple[int, int, str]]:
+        """Read all pending events as (wd, mask, name) tuples."""
+        ret = []
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset + EVENT_HEADER.size <= len(buf):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(buf, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(buf[offset:offset+length].rstrip(b'\0'))
+                offset += length
+                ret.append((wd, mask, name))
+        return ret
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def fs_type(path: Path, mounts: Path = Path('/proc/self/mounts')) -> str | None:
+    """Get the type of the filesystem a path is on, or None if unknown."""
+    path_str = os.path.realpath(path)
+    try:
+        with open(mounts) as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+    ret = None
+    longest = -1
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        # spaces and such are octal escaped in mount points
+        mount = re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), fields[1])
+        prefix = mount.rstrip('/') + '/'
+        if (path_str == mount or path_str.startswith(prefix)) and len(mount) >= longest:
+            ret = fields[2]
+            longest = len(mount)
+    return ret
+
+
+def album_ancestry(album: Path) -> list[Path]:
+    """Get an album and all its ancestors within `ENV.SOURCE`."""
+    basedir = Path(ENV.SOURCE)
+    if album != basedir and basedir not in album.parents:
+        return []
+    ret = [album]
+    for p in album.parents:
+        if p != basedir and basedir not in p.parents:
+            break
+        ret.append(p)
+    return ret
+
+
+def affected_albums(path: Path) -> list[Path]:
+    """
+    Get the albums whose pages are affected by a change to a path.
+
+    Includes the album the path belongs to, plus all its ancestors
+    for the album listing and breadcrumbs.
+    """
+    album = path.parent
+    if album.name == 'thumbnails':
+        album = album.parent
+    return album_ancestry(album)
+
+
+def edited_children(path: Path) -> dict[Path, list[str]]:
+    """
+    Get the manifest entries affected by a change to a path, as {album: child names}.
+
+    Sidecars and thumbnails belong to their child, and an album's own
+    metadata and thumbnail also to its entry in the parent album.
+    """
+    basedir = Path(ENV.SOURCE)
+    album, name = path.parent, path.name
+    if album.name == 'thumbnails':
+        album = album.parent
+    if album != basedir and basedir not in album.parents:
+        return {}
+    ret = {album: [name.removesuffix('.meta.json')]}
+    if name in ('index.meta.json', 'thumb.jpg'):
+        ret[album] = []
+        if album != basedir:
+            ret[album.parent] = [album.name]
+    return ret
+
+
+class Watcher:
+    """
+    Watch `ENV.SOURCE` recursively, invalidating cached album pages.
+
+    Uses inotify when available, and falls back to polling every
+    `ENV.WATCH_POLL_INTERVAL` seconds.  Polls take the `album_stamp` of
+    every album, a few stats each, and only list dirs whose mtime has
+    changed to find new sub-albums.  With inotify,
+    the manifests of changed albums are also updated, as they are only
+    checked against the album dir, not children edited in place.  In `auto`
+    mode, network filesystems are always polled, as changes made on
+    other hosts raise no inotify events.  Invalidated pages are queued
+    for a background re-render, so users rarely hit a cold album build.
+
+    Every server process runs a watcher, but only the one holding the
+    leader lock watches, so each change is re-rendered once.  The others
+    take over if the leader stops renewing the lock.
+
+    Args:
+        page_cache: page cache to invalidate
+        rewarm_url: base url of the server to re-render pages with, or None to disable
+        version_cache: version cache for manifest updates, or None to leave version tokens out
+        image_sizes: image size cache for manifest updates, if any
+    """
+    def __init__(self, page_cache: PageCache, rewarm_url: str | None = None, version_cache: VersionCache | None = None,
+                 image_sizes: ImageSizeCache | None = None):
+        self.root = Path(ENV.SOURCE)
+        self.page_cache = page_cache
+        self.rewarm_url = rewarm_url
+        self.version_cache = version_cache
+        self.image_sizes = image_sizes
+        self.inotify: Inotify | None = None
+        self.watches: dict[int, Path] = {}
+        self.pending: set[Path] = set()
+        self.edited: dict[Path, set[str]] = {}
+        self.rewarm_queue: asyncio.Queue[Path] = asyncio.Queue()
+        self._queued: set[Path] = set()
+        self._tasks: set[asyncio.Task] = set()
+        self._flush_handle: asyncio.TimerHandle | None = None
+        # album path: (album stamp, sub-album names), as of the last poll
+        self._albums: dict[Path, tuple[list[int], list[str]]] = {}
+        self.redis = RedisInstance()
+        self.lock_token: str | None = None
+        self._election: asyncio.Task | None = None
+
+    async def start(self):
+        """Start watching if elected leader, and keep trying to be elected otherwise."""
+        await self._elect()
+        self._election = asyncio.create_task(self._keep_elected())
+
+    async def stop(self):
+        if self._election:
+            self._election.cancel()
+            await asyncio.gather(self._election, return_exceptions=True)
+            self._election = None
+        await self._resign()
+
+    async def _resign(self):
+        await self._stop_watching()
+        if self.lock_token:
+            try:
+                await self.redis.release_lock(LEADER_LOCK, self.lock_token)
+            except Exception:
+                logger.info('cannot release the watcher leader lock', exc_info=True)
+            self.lock_token = None
+
+    async def _elect(self):
+        """Take or renew the leader lock, starting or stopping watching to match."""
+        try:
+            if self.lock_token:
+                if await self.redis.extend_lock(LEADER_LOCK, self.lock_token, ENV.WATCH_LEADER_TTL):
+                    return
+                logger.warning('lost the watcher leader lock')
+                self.lock_token = None
+                await self._stop_watching()
+                return
+            self.lock_token = await self.redis.acquire_lock(LEADER_LOCK, ENV.WATCH_LEADER_TTL)
+        except Exception:
+            logger.info('cannot take the watcher leader lock', exc_info=True)
+            return
+        if self.lock_token:
+            try:
+                await self._start_watching()
+            except BaseException:
+                await self._resign()
+                raise
+
+    async def _keep_elected(self):
+        while True:
+            await asyncio.sleep(ENV.WATCH_LEADER_TTL / 3)
+            try:
+                await self._elect()
+            except Exception:
+                logger.warning('error starting the watcher', exc_info=True)
+
+    async def _start_watching(self):
+        loop = asyncio.get_running_loop()
+        mode = ENV.WATCH_MODE
+        if mode == 'auto' and (fs := await asyncio.to_thread(fs_type, self.root)) in NETWORK_FILESYSTEMS:
+            logger.info('%s is on %s, so polling for changes', self.root, fs)
+            mode = 'poll'
+        if mode in ('auto', 'inotify'):
+            try:
+                self.inotify = Inotify()
+                self.watches.update(await asyncio.to_thread(self._add_watches, self.root))
+            except OSError:
+                if mode == 'inotify':
+                    raise
+                logger.warning('inotify not available, falling back to polling', exc_info=True)
+                if self.inotify:
+                    self.inotify.close()
+                    self.inotify = None
+                    self.watches.clear()
+                mode = 'poll'
+            else:
+                loop.add_reader(self.inotify.fd, self._handle_events)
+                logger.info('watching %s with inotify, %d dirs', self.root, len(self.watches))
+        if mode == 'poll':
+            self._albums = await asyncio.to_thread(self._scan)
+            self._create_task(self._poll())
+            logger.info('watching %s by polling, %d dirs', self.root, len(self._albums))
+        if self.rewarm_url:
+            self._create_task(self._rewarm())
+
+    def _create_task(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _stop_watching(self):
+        if self.inotify:
+            asyncio.get_running_loop().remove_reader(self.inotify.fd)
+            self.inotify.close()
+            self.inotify = None
+        self.watches.clear()
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self.pending.clear()
+        self.edited.clear()
+        self._albums.clear()
+
+    def _add_watches(self, path: Path) -> dict[int, Path]:
+        """Watch a dir tree, returning the new watches.  Walks the tree, so run it in a thread."""
+        assert self.inotify
+        ret = {}
+        for root, dirs, _ in os.walk(path):
+            dirs[:] = [d for d in dirs if not d.startswith(HIDDEN_PREFIXES)]
+            wd = self.inotify.add_watch(Path(root))
+            ret[wd] = Path(root)
+        return ret
+
+    async def _watch_new(self, path: Path):
+        try:
+            watches = await asyncio.to_thread(self._add_watches, path)
+        except OSError:
+            logger.warning('cannot watch %s', path, exc_info=True)
+            return
+        if self.inotify:
+            self.watches.update(watches)
+
+    def _handle_events(self):
+        assert self.inotify
+        for wd, mask, name in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                logger.warning('inotify queue overflow, some page invalidations may be missed')
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if not (dirpath := self.watches.get(wd)):
+                continue
+            if name.startswith(HIDDEN_PREFIXES):
+                # manifests and in-progress uploads are not album contents, so don't invalidate on them
+                continue
+            if mask & IN_DELETE_SELF:
+                path = dirpath
+            else:
+                path = dirpath / name
+            if mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                # the watches follow the moved dir, so forget the old paths
+                for old_wd, old_path in list(self.watches.items()):
+                    if old_path == path or path in old_path.parents:
+                        del self.watches[old_wd]
+            elif mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._create_task(self._watch_new(path))
+            logger.debug('inotify event %x for %s', mask, path)
+            self.changed(path)
+
+    def changed(self, path: Path):
+        """Mark a path as changed, updating manifests and invalidating after a short debounce."""
+        for album, names in edited_children(path).items():
+            self.edited.setdefault(album, set()).update(names)
+        self._invalidate(affected_albums(path))
+
+    def _invalidate(self, albums: list[Path]):
+        self.pending.update(albums)
+        if self.pending and not self._flush_handle:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(ENV.WATCH_DEBOUNCE, self._schedule_flush)
+
+    def _schedule_flush(self):
+        self._flush_handle = None
+        self._create_task(self.flush())
+
+    async def flush(self):
+        """Invalidate all pending albums, and queue them for re-rendering."""
+        albums, self.pending = self.pending, set()
+        edited, self.edited = self.edited, {}
+        if not albums:
+            return
+        # before the pages, so they are re-rendered from the updated manifests
+        for album, names in edited.items():
+            try:
+                await update_manifest(album, sorted(names), version_cache=self.version_cache, image_sizes=self.image_sizes)
+            except Exception:
+                logger.info('error updating manifest for %s', album, exc_info=True)
+        keys = [album_key(album) for album in albums]
+        logger.info('invalidating page cache for %r', keys)
+        try:
+            await self.page_cache.delete_many(keys)
+        except Exception:
+            logger.info('error removing %s from cache', keys, exc_info=True)
+        for album in albums:
+            if self.rewarm_url and album not in self._queued:
+                self._queued.add(album)
+                self.rewarm_queue.put_nowait(album)
+
+    def _scan(self) -> dict[Path, tuple[list[int], list[str]]]:
+        """Stamp every album, reusing the sub-albums of dirs unchanged since the last scan."""
+        ret = {}
+        stack = [self.root]
+        while stack:
+            path = stack.pop()
+            try:
+                stamp = album_stamp(path)
+                if (old := self._albums.get(path)) and old[0][0] == stamp[0]:
+                    subdirs = old[1]
+                else:
+                    with os.scandir(path) as it:
+                        subdirs = [e.name for e in it if e.name != 'thumbnails' and not e.name.startswith(HIDDEN_PREFIXES)
+                                   and e.is_dir(follow_symlinks=False)]
+            except OSError:
+                continue
+            ret[path] = (stamp, subdirs)
+            stack.extend(path / name for name in subdirs)
+        return ret
+
+    async def check(self):
+        """Rescan the album stamps, invalidating any changed albums."""
+        albums = await asyncio.to_thread(self._scan)
+        for path in albums.keys() | self._albums.keys():
+            old, new = self._albums.get(path), albums.get(path)
+            if not old or not new or old[0] != new[0]:
+                self._invalidate(album_ancestry(path))
+        self._albums = albums
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(ENV.WATCH_POLL_INTERVAL)
+            try:
+                await self.check()
+            except Exception:
+                logger.warning('error polling %s', self.root, exc_info=True)
+
+    async def _rewarm(self):
+        client = AsyncHTTPClient()
+        while True:
+            album = await self.rewarm_queue.get()
+            self._queued.discard(album)
+            if not album.is_dir():
+                continue
+            url = f'{self.rewarm_url}/{quote(album_key(album))}'
+            logger.info('re-rendering %s', url)
+            try:
+                await client.fetch(url, request_timeout=300)
+            except Exception:
+                logger.info('error re-rendering %s', url, exc_info=True)
@@ -0,0 +1,89 @@
+import dataclasses
+import sys
+from unittest.mock import MagicMock, AsyncMock
+import pytest
+
+import gallery.config
+from gallery import caching
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    _cache = {}
+    mock = MagicMock()
+    mock.exists = AsyncMock(side_effect=_cache.__contains__)
+    mock.get = AsyncMock(side_effect=_cache.get)
+    mock.mget = AsyncMock(side_effect=lambda keys: [_cache.get(k) for k in keys])
+    # redis only stores byte strings, even if it accepts both
+    def cacheset(key, val, ex=None, px=None, nx=False):
+        if nx and key in _cache:
+            return None
+        if isinstance(val, str):
+            val = val.encode('utf-8')
+        _cache[key] = val
+        return True
+    mock.set = AsyncMock(side_effect=cacheset)
+    def cachedelete(*keys):
+        return sum(_cache.pop(k, None) is not None for k in keys)
+    mock.delete = AsyncMock(side_effect=cachedelete)
+    def cachehmget(name, keys):
+        return [_cache.get(name, {}).get(str(k)) for k in keys]
+    mock.hmget = AsyncMock(side_effect=cachehmget)
+    def cachehset(name, mapping):
+        _cache.setdefault(name, {}).update({str(k): v.encode('utf-8') if isinstance(v, str) else v for k,v in mapping.items()})
+    mock.hset = AsyncMock(side_effect=cachehset)
+    mock.expire = AsyncMock()
+    def cachecopy(src, dst, replace=False):
+        if src not in _cache or (dst in _cache and not replace):
+            return 0
+        _cache[dst] = _cache[src]
+        return 1
+    mock.copy = AsyncMock(side_effect=cachecopy)
+    def cacheeval(script, numkeys, key, token, *args):
+        # only the lock release and extend scripts are supported
+        if _cache.get(key) != token.encode('utf-8'):
+            return 0
+        if script == caching.RedisInstance.EXTEND_SCRIPT:
+            return 1
+        return cachedelete(key)
+    mock.eval = AsyncMock(side_effect=cacheeval)
+    mock.publish = AsyncMock()
+    mock.dbsize = AsyncMock(side_effect=_cache.__len__)
+    mock.cache = _cache
+
+    class Pipeline:
+        """Queues calls to the mock, run by `execute`."""
+        def __init__(self, transaction=True):
+            self.calls = []
+
+        def __getattr__(self, name):
+            def call(*args, **kwargs):
+                self.calls.append((getattr(mock, name), args, kwargs))
+                return self
+            return call
+
+        async def execute(self):
+            calls, self.calls = self.calls, []
+            return [await fn(*args, **kwargs) for fn, args, kwargs in calls]
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            pass
+
+    mock.pipeline = MagicMock(side_effect=Pipeline)
+    monkeypatch.setattr(caching.RedisInstance, 'redis', mock)
+    caching.PageCache.clear_local()
+    yield mock
+
+
+@pytest.fixture
+def source(monkeypatch, tmp_path):
+    """Point ENV.SOURCE at a temp dir, in every gallery module."""
+    orig_env = gallery.config.ENV
+    env = dataclasses.replace(orig_env, SOURCE=tmp_path)
+    for name, module in list(sys.modules.items()):
+        if name.startswith('gallery') and getattr(module, 'ENV', None) is orig_env:
+            monkeypatch.setattr(module, 'ENV', env)
+    yield tmp_path
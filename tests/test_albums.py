@@ -0,0 +1,181 @@
+import os
+from pathlib import Path
+import threading
+import time
+
+from PIL import Image
+
+from gallery import albums, dimensions, util
+
+
+def test_album_fingerprint(tmp_path):
+    (tmp_path / 'a.jpg').write_bytes(b'foo')
+    (tmp_path / 'sub').mkdir()
+    ret = albums.album_fingerprint(tmp_path)
+    assert ret == albums.album_fingerprint(tmp_path)
+
+    # new sidecar
+    (tmp_path / 'a.meta.json').write_text('{}')
+    ret2 = albums.album_fingerprint(tmp_path)
+    assert ret2 != ret
+
+    # album metadata written in place
+    (tmp_path / 'index.meta.json').write_text('{}')
+    ret3 = albums.album_fingerprint(tmp_path)
+    t = time.time() + 10
+    os.utime(tmp_path / 'index.meta.json', (t, t))
+    assert albums.album_fingerprint(tmp_path) != ret3
+    ret3 = albums.album_fingerprint(tmp_path)
+
+    # new thumbnail
+    (tmp_path / 'thumbnails').mkdir()
+    ret4 = albums.album_fingerprint(tmp_path)
+    assert ret4 != ret3
+    (tmp_path / 'thumbnails' / 'a.jpg').write_bytes(b'foo')
+    assert albums.album_fingerprint(tmp_path) != ret4
+
+
+def test_album_key(source):
+    assert albums.album_key(source) == ''
+    assert albums.album_key(source / 'a' / 'b') == 'a/b'
+
+
+async def test_album(source, redis):
+    path = source / 'album'
+    path.mkdir()
+    Image.new('RGB', (20, 10)).save(path / 'a.jpg')
+    Image.new('RGB', (20, 10)).save(path / 'b.jpg')
+    (path / 'c.mp4').write_bytes(b'foo')
+    (path / 'd.txt').write_bytes(b'foo')
+    (path / 'sub').mkdir()
+    (path / 'thumbnails').mkdir()
+    (path / 'thumbnails' / 'a.jpg').write_bytes(b'foo')
+    (path / 'thumbnails' / 'c.jpg').write_bytes(b'foo')
+    (path / 'thumbnails' / 'thumb.jpg').write_bytes(b'foo')
+    util.write_metadata(path / 'b.jpg', {'title': 'bar'})
+    util.write_metadata(path, {'title': 'album', 'sort': 'filename'})
+
+    album = albums.Album(path)
+    assert album.url == '/album'
+    assert album.meta['title'] == 'album'
+    assert album.thumbnail == '/_src/album/thumbnails/thumb.jpg'
+    assert [a.name for a in album.albums] == ['sub']
+    assert album.albums[0].thumbnail == '/static/echo/blank.gif'
+    assert [i.name for i in album.images] == ['a.jpg', 'b.jpg']
+    assert album.images[0].meta['title'] == 'a.jpg'
+    assert album.images[0].thumbnail == '/_src/album/thumbnails/a.jpg'
+    assert (album.images[0].width, album.images[0].height) == (20, 10)
+    assert album.images[1].meta['title'] == 'bar'
+    assert album.images[1].thumbnail == '/_src/album/b.jpg'
+    assert [v.thumbnail for v in album.videos] == ['/_src/album/thumbnails/c.jpg']
+    assert [f.url for f in album.files] == ['/_src/album/d.txt']
+
+    # the same results without a listing
+    media = albums.Media(path / 'a.jpg')
+    assert media.thumbnail == album.images[0].thumbnail
+    assert media.meta == album.images[0].meta
+    media = albums.Media(path / 'c.mp4', prefix=Path('/edit'))
+    assert media.url == '/edit/album/c.mp4'
+    assert media.thumbnail == album.videos[0].thumbnail
+
+    # the same results when loading concurrently
+    album2 = await albums.load_album(path)
+    assert album2.meta == album.meta
+    assert album2.thumbnail == album.thumbnail
+    for a, b in zip(album.src_urls(), album2.src_urls()):
+        assert a == b
+    assert [i.meta for i in album2.images] == [i.meta for i in album.images]
+
+
+async def test_album_window(source, redis):
+    path = source / 'album'
+    path.mkdir()
+    for i in range(5):
+        Image.new('RGB', (20, 10)).save(path / f'{i}.jpg')
+    (path / 'a.mp4').write_bytes(b'foo')
+    (path / 'sub').mkdir()
+
+    album = await albums.load_album(path)
+    assert album.total == 7
+    assert not album.paged
+
+    album = await albums.load_album(path, offset=0, limit=3)
+    assert album.total == 7
+    assert album.paged
+    assert [a.name for a in album.albums] == ['sub']
+    assert [i.name for i in album.images] == ['0.jpg', '1.jpg']
+    assert not album.videos
+
+    album = await albums.load_album(path, offset=3, limit=3)
+    assert album.paged
+    assert not album.albums
+    assert [i.name for i in album.images] == ['2.jpg', '3.jpg', '4.jpg']
+
+    album = await albums.load_album(path, offset=6, limit=3)
+    assert not album.images
+    assert [v.name for v in album.videos] == ['a.mp4']
+
+
+async def test_album_versions_not_shared(source, redis):
+    for name in ('a', 'b'):
+        (source / name).mkdir()
+        (source / name / 'x.txt').write_bytes(b'foo')
+    album_a = await albums.load_album(source / 'a', manifest=False)
+    album_b = await albums.load_album(source / 'b', manifest=False)
+    album_a.versions['/_src/a/x.txt'] = 'token'
+    assert album_b.versions == {}
+    assert albums.DirListing(source / 'b').versions == {}
+
+
+async def test_album_sizes_off_loop(source, redis):
+    path = source / 'album'
+    path.mkdir()
+    Image.new('RGB', (20, 10)).save(path / 'a.jpg')
+
+    image_sizes = dimensions.ImageSizeCache()
+    threads = []
+    get = image_sizes.get
+
+    def record(*args, **kwargs):
+        threads.append(threading.current_thread())
+        return get(*args, **kwargs)
+    image_sizes.get = record
+
+    album = await albums.load_album(path, image_sizes=image_sizes)
+    assert [(i.width, i.height) for i in album.images] == [(20, 10)]
+    assert threads and threading.main_thread() not in threads
+
+
+async def test_media_derivatives(source, redis):
+    path = source / 'album'
+    path.mkdir()
+    Image.new('RGB', (1500, 1000)).save(path / 'a.jpg')
+    Image.new('RGB', (100, 50)).save(path / 'b.jpg')
+    Image.new('RGB', (1500, 1000)).save(path / 'c.gif')
+
+    album = await albums.load_album(path)
+    derivatives = {i.name: i.derivatives for i in album.images}
+    assert derivatives['a.jpg'] == [(320, '/_derivative/320/album/a.jpg.webp'), (1024, '/_derivative/1024/album/a.jpg.webp')]
+    assert derivatives['b.jpg'] == []
+    assert derivatives['c.gif'] == []
+
+
+def test_search_result():
+    ret = albums.SearchResult({
+        'path': 'album/a.jpg', 'type': 'Image', 'title': 'foo', 'date': 'Monday',
+        'thumbnail': '/_src/album/thumbnails/a.jpg', 'mime': 'image/jpeg',
+        'width': 20, 'height': 10, 'src_version': 'v1', 'thumbnail_version': 'v2',
+    })
+    assert ret.type == 'image'
+    assert ret.url == ret.src == '/_src/album/a.jpg'
+    assert ret.album_url == '/album#a.jpg'
+    assert (ret.width, ret.height) == (20, 10)
+    assert ret.meta['title'] == 'foo' and ret.meta['date'] == 'Monday'
+    assert ret.versions == {'/_src/album/a.jpg': 'v1', '/_src/album/thumbnails/a.jpg': 'v2'}
+
+    ret = albums.SearchResult({'path': 'album/sub', 'type': 'Album', 'thumbnail': '/static/echo/blank.gif'})
+    assert ret.type == 'album'
+    assert ret.url == '/album/sub'
+    assert ret.meta['title'] == 'sub'
+    assert ret.src_urls() == ['/_src/album/sub']
+    assert not albums.SearchResult.indexed({'path': 'album/sub', 'type': 'Album'})
@@ -1,27 +1,12 @@
-from unittest.mock import MagicMock, AsyncMock
+import asyncio
+import dataclasses
+import gzip
+from unittest.mock import MagicMock
 import pytest
 
 from gallery import caching
 
 
-@pytest.fixture
-def redis(monkeypatch):
-    _cache = {}
-    mock = MagicMock()
-    mock.exists = AsyncMock(side_effect=_cache.__contains__)
-    mock.get = AsyncMock(side_effect=_cache.__getitem__)
-    # redis only stores byte strings, even if it accepts both
-    def cacheset(key, val):
-        if isinstance(val, str):
-            val = val.encode('utf-8')
-        _cache[key] = val
-    mock.set = AsyncMock(side_effect=cacheset)
-    mock.delete = AsyncMock(side_effect=_cache.__delitem__)
-    mock.dbsize = AsyncMock(side_effect=_cache.__len__)
-    monkeypatch.setattr(caching.RedisInstance, 'redis', mock)
-    yield mock
-
-
 async def test_cache(redis):
     mocker = MagicMock()
 
@@ -42,3 +27,204 @@ async def test_cache(redis):
     assert not (await cache.contains('bar'))
     with pytest.raises(KeyError):
         await cache.get('bar')
+
+
+async def test_cache_many(redis):
+    cache = caching.RedisInstance()
+    await cache.set_many({'a': 1, 'b': {'c': [2]}}, ttl=10)
+    redis.pipeline.assert_called_once()
+    assert await cache.get_many(['a', 'b', 'missing']) == {'a': 1, 'b': {'c': [2]}}
+    assert await cache.delete_many(['a', 'b', 'missing']) == 2
+    assert await cache.get_many(['a', 'b']) == {}
+    assert await cache.get_many([]) == {}
+
+
+async def test_cache_serializers(redis):
+    cache = caching.RedisInstance(serializer='raw')
+    await cache.set('a', b'\x00\xff<html>')
+    assert redis.cache['a'] == b'\x00\xff<html>'
+    assert await cache.get('a') == b'\x00\xff<html>'
+    with pytest.raises(TypeError):
+        await cache.set('a', {'b': 1})
+
+    await cache.hset('h', {'body': b'\x00\x01'}, ttl=10)
+    assert await cache.hmget('h', ['body', 'missing']) == [b'\x00\x01', None]
+
+    with pytest.raises(ValueError):
+        caching.RedisInstance(serializer='pickle')
+    if caching.msgpack is None:
+        with pytest.raises(RuntimeError):
+            caching.RedisInstance(serializer='msgpack')
+    else:
+        cache = caching.RedisInstance(serializer='msgpack')
+        await cache.set('m', {'a': b'\x00', 'b': [1, 2]})
+        assert await cache.get('m') == {'a': b'\x00', 'b': [1, 2]}
+
+
+async def test_page_cache(redis):
+    cache = caching.PageCache()
+
+    await cache.set('/foo/bar/', '<html></html>', 'abc')
+    assert (await cache.get('foo/bar', 'abc')) == '<html></html>'
+
+    # fingerprint changed
+    with pytest.raises(KeyError):
+        await cache.get('foo/bar', 'def')
+    assert not (await cache.cache.contains(cache.key('foo/bar')))
+
+    # pages are deleted together
+    await cache.set('foo/bar', '<html>1</html>', 'abc')
+    await cache.set('foo/bar', '<html>2</html>', 'abc', page=2)
+    assert (await cache.get('foo/bar', 'abc', page=2)) == '<html>2</html>'
+    await cache.delete('foo/bar')
+    with pytest.raises(KeyError):
+        await cache.get('foo/bar', 'abc', page=2)
+
+    await cache.set('foo/bar', '<html></html>', 'abc')
+    await cache.delete('/foo/bar')
+    with pytest.raises(KeyError):
+        await cache.get('foo/bar', 'abc')
+
+    await cache.set('foo', '<html>1</html>', 'abc')
+    await cache.set('foo/bar', '<html>2</html>', 'abc')
+    await cache.delete_many(['foo', 'foo/bar'])
+    assert not redis.cache
+
+
+async def test_page_cache_tiers(redis, monkeypatch):
+    cache = caching.PageCache()
+    body = '<html>' + 'foo' * 1000 + '</html>'
+    compressed = await cache.set('foo', body, 'abc')
+    assert len(compressed) < len(body) / 10
+    assert gzip.decompress(compressed).decode('utf-8') == body
+    assert redis.cache['page:foo']['1.body'] == compressed
+
+    # served from the local tier without Redis, then from Redis once evicted
+    redis.hmget.reset_mock()
+    assert await cache.get_compressed('foo', 'abc') == compressed
+    redis.hmget.assert_not_awaited()
+    caching.PageCache.clear_local()
+    assert await cache.get('foo', 'abc') == body
+    assert ('page:foo', 1) in caching.PageCache.local
+
+    # deletes are published to the other processes
+    await cache.delete('foo')
+    assert not caching.PageCache.local
+    redis.publish.assert_awaited_with(caching.PageCache.CHANNEL, 'page:foo')
+    assert not redis.cache
+
+    # the local tier is bounded by size
+    monkeypatch.setattr(caching, 'ENV', dataclasses.replace(caching.ENV, PAGE_CACHE_MEMORY=2 * len(compressed)))
+    for i in range(3):
+        await cache.set('foo', body, 'abc', page=i)
+    assert list(caching.PageCache.local) == [('page:foo', 1), ('page:foo', 2)]
+    assert caching.PageCache.local_size == 2 * len(compressed)
+    caching.PageCache.clear_local()
+
+
+async def test_search_cache(redis):
+    cache = caching.SearchCache()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {'total': len(calls)}
+
+    # concurrent misses share one search, and queries are normalized
+    ret = await asyncio.gather(*(cache.get(q, fetch, limit=10) for q in ('Foo  bar', 'foo bar', ' FOO bar')))
+    assert ret == [{'total': 1}] * 3
+    assert await cache.get('foo bar', fetch, limit=10) == {'total': 1}
+    assert await cache.get('foo bar', fetch, limit=20) == {'total': 2}
+
+    # a new generation invalidates everything, keeping the index name
+    generation = await cache.bump('gallery-1')
+    assert generation.startswith('gallery-1:')
+    assert await cache.get('foo bar', fetch, limit=10) == {'total': 3}
+    assert (await cache.bump()).startswith('gallery-1:')
+    assert await cache.get('foo bar', fetch, limit=10) == {'total': 4}
+
+
+async def test_page_render_once(redis):
+    cache = caching.PageCache()
+    calls = []
+
+    async def render():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return b'<html>foo</html>'
+
+    # concurrent renders in a process share one
+    ret = await asyncio.gather(*(cache.render_once('foo', 'abc', render) for _ in range(5)))
+    assert len(calls) == 1
+    assert all(gzip.decompress(r['body']) == b'<html>foo</html>' for r in ret)
+    assert ret[0]['etag'] == caching.PageCache.etag(b'<html>foo</html>')
+    assert await cache.get('foo', 'abc') == '<html>foo</html>'
+    assert not [k for k in redis.cache if k.startswith('lock:')]
+
+    # but not with a render of an older fingerprint
+    async def render_new():
+        return b'<html>new</html>'
+    old, new = await asyncio.gather(cache.render_once('foo', 'old', render), cache.render_once('foo', 'new', render_new))
+    assert (old['fingerprint'], new['fingerprint']) == ('old', 'new')
+    assert gzip.decompress(new['body']) == b'<html>new</html>'
+    calls.pop()
+
+    # another process holds the lock, so wait for its result
+    await cache.delete('foo')
+    lock = 'lock:page:foo:1'
+    token = await cache.cache.acquire_lock(lock, 10)
+
+    async def other_process():
+        await asyncio.sleep(0.1)
+        await cache.set('foo', '<html>other</html>', 'abc')
+        caching.PageCache.clear_local()
+        await cache.cache.release_lock(lock, token)
+    task = asyncio.create_task(other_process())
+    assert gzip.decompress((await cache.render_once('foo', 'abc', render))['body']) == b'<html>other</html>'
+    await task
+    assert len(calls) == 1
+
+
+async def test_page_cache_stale(redis, monkeypatch):
+    cache = caching.PageCache()
+    await cache.set('foo', '<html>old</html>', 'abc')
+    await cache.delete('foo')
+    assert await cache.get_stale('foo') is None
+
+    monkeypatch.setattr(caching, 'ENV', dataclasses.replace(caching.ENV, PAGE_STALE_TTL=60))
+    await cache.set('foo', '<html>old</html>', 'abc')
+    await cache.delete('foo')
+    with pytest.raises(KeyError):
+        await cache.get('foo', 'abc')
+    assert gzip.decompress(await cache.get_stale('foo')) == b'<html>old</html>'
+
+    # also kept when the fingerprint changes
+    await cache.set('bar', '<html>old</html>', 'abc')
+    caching.PageCache.clear_local()
+    with pytest.raises(KeyError):
+        await cache.get('bar', 'def')
+    assert gzip.decompress(await cache.get_stale('bar')) == b'<html>old</html>'
+
+
+async def test_page_cache_meta(redis):
+    cache = caching.PageCache()
+    entry = await cache.set_entry('foo', '<html>foo</html>', 'abc')
+    assert entry['etag'] == caching.PageCache.etag(b'<html>foo</html>')
+    assert entry['modified'] > 0
+
+    # read without the body, from the local tier or Redis
+    meta = await cache.get_meta('foo', 'abc')
+    assert meta == {k: v for k, v in entry.items() if k != 'body'}
+    caching.PageCache.clear_local()
+    redis.hmget.reset_mock()
+    assert await cache.get_meta('foo', 'abc') == meta
+    redis.hmget.assert_awaited_once_with('page:foo', ['1.meta'])
+    with pytest.raises(KeyError):
+        await cache.get_meta('foo', 'def')
+    with pytest.raises(KeyError):
+        await cache.get_meta('bar', 'abc')
+
+    # same content, same etag
+    assert (await cache.set_entry('foo', '<html>foo</html>', 'def'))['etag'] == entry['etag']
+    assert (await cache.set_entry('foo', '<html>bar</html>', 'def'))['etag'] != entry['etag']
@@ -0,0 +1,78 @@
+from PIL import Image
+import pytest
+
+from gallery import dimensions, util
+
+
+@pytest.fixture
+def cache(redis, source):
+    yield dimensions.ImageSizeCache()
+
+
+def test_image_size_meta(source):
+    path = source / 'a.jpg'
+    Image.new('RGB', (20, 10)).save(path)
+    ret = dimensions.image_size_meta(path)
+    assert ret['width'] == 20
+    assert ret['height'] == 10
+    assert ret['size'] == path.stat().st_size
+
+
+async def test_image_size_cache(cache, redis, source):
+    path = source / 'a.jpg'
+    Image.new('RGB', (20, 10)).save(path)
+
+    assert cache.get(path) == (20, 10)
+    assert cache.stats['misses'] == 1
+    assert cache.get(path) == (20, 10)
+    assert cache.stats['hits'] == 1
+
+    await cache.flush()
+    assert cache.key('a.jpg') in redis.cache
+    assert redis.set.call_args.kwargs['ex'] == dimensions.ENV.IMAGE_SIZE_CACHE_TTL
+
+    # a fresh process gets it from redis
+    cache.lru.clear()
+    await cache.preload(source)
+    assert cache.stats['redis_hits'] == 1
+    assert cache.get(path) == (20, 10)
+    assert cache.stats['misses'] == 1
+
+    # changed file
+    Image.new('RGB', (30, 10)).save(path)
+    assert cache.get(path) == (30, 10)
+    assert cache.stats['misses'] == 2
+
+
+def test_image_size_cache_sidecar(cache, source):
+    path = source / 'a.jpg'
+    Image.new('RGB', (20, 10)).save(path)
+    meta = {dimensions.IMAGE_SIZE_KEY: dimensions.image_size_meta(path)}
+
+    assert cache.get(path, meta=meta) == (20, 10)
+    assert cache.stats['hits'] == 1
+    assert not cache.pending
+
+
+async def test_backfill(cache, redis, source):
+    (source / 'sub').mkdir()
+    path = source / 'sub' / 'a.jpg'
+    Image.new('RGB', (20, 10)).save(path)
+    (source / 'sub' / 'b.txt').write_text('foo')
+    for name in ('thumbnails', '.upload-staging'):
+        (source / 'sub' / name).mkdir()
+        Image.new('RGB', (20, 10)).save(source / 'sub' / name / 'c.jpg')
+
+    await dimensions.backfill(source, sidecar=True)
+    assert list(redis.cache) == [dimensions.ImageSizeCache.key('sub/a.jpg')]
+    meta = util.read_metadata(path)
+    assert meta[dimensions.IMAGE_SIZE_KEY]['width'] == 20
+
+
+async def test_backfill_outside_source(redis, source, tmp_path_factory):
+    root = tmp_path_factory.mktemp('other')
+    path = root / 'a.jpg'
+    Image.new('RGB', (20, 10)).save(path)
+
+    await dimensions.backfill(root)
+    assert list(redis.cache) == [dimensions.ImageSizeCache.key(str(path))]
@@ -0,0 +1,286 @@
+import json
+import os
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+from elasticsearch import AsyncElasticsearch
+from PIL import Image
+import pytest
+
+from gallery import caching, dimensions, index, util, versions
+
+
+@pytest.fixture
+def es(monkeypatch):
+    """ElasticSearch client recording bulk actions, failing any doc ids in `es.fail`."""
+    client = AsyncElasticsearch('http://localhost:9200')
+    client.requests = []
+    client.fail = set()
+
+    async def bulk(self, operations, **kwargs):
+        lines = [json.loads(line) for line in operations]
+        items = []
+        actions = []
+        while lines:
+            header = lines.pop(0)
+            op, meta = header.popitem()
+            doc = lines.pop(0) if op == 'index' else None
+            actions.append((op, meta['_id'], doc))
+            status = 500 if meta['_id'] in client.fail else 200
+            items.append({op: {'_id': meta['_id'], 'status': status}})
+        client.requests.append(actions)
+        return SimpleNamespace(body={'errors': bool(client.fail), 'items': items})
+
+    monkeypatch.setattr(AsyncElasticsearch, 'bulk', bulk)
+    yield client
+
+
+def make_tree(source):
+    for album in ('a', 'b', 'c'):
+        (source / album / 'sub').mkdir(parents=True)
+        util.write_metadata(source / album, {'title': album})
+        for i in range(5):
+            (source / album / f'{i}.jpg').write_bytes(b'foo')
+            (source / album / 'sub' / f'{i}.mp4').write_bytes(b'foo')
+    (source / 'a' / 'thumbnails').mkdir()
+    (source / 'a' / 'thumbnails' / '0.jpg').write_bytes(b'foo')
+    (source / '.upload-staging').mkdir()
+    (source / 'top.txt').write_bytes(b'foo')
+
+
+def sent(es):
+    ret = {(op, doc['path'] if doc else id_) for actions in es.requests for op, id_, doc in actions}
+    es.requests.clear()
+    return ret
+
+
+async def test_stream(source, es):
+    make_tree(source)
+    indexer = index.Indexer(es, 'gallery')
+    state = {}
+    await indexer.stream(source, chunk_size=4, state=state)
+    docs = sent(es)
+    assert len(docs) == 1 + 3 * 12
+    assert ('index', 'top.txt') in docs
+    assert ('index', 'a/sub/4.mp4') in docs
+    assert len(state) == len(docs)
+
+    es.fail.add(index.doc_id('top.txt'))
+    with pytest.raises(RuntimeError):
+        await indexer.stream(source, chunk_size=4)
+
+
+async def test_update(source, es, tmp_path_factory):
+    make_tree(source)
+    state_path = tmp_path_factory.mktemp('state') / 'state.json'
+    indexer = index.Indexer(es, 'gallery')
+
+    counts = await indexer.update(source, state_path, chunk_size=4)
+    assert counts == {'index': 37, 'delete': 0, 'failed': 0}
+    assert len(sent(es)) == 37
+
+    # nothing changed
+    counts = await indexer.update(source, state_path, chunk_size=4)
+    assert counts == {'index': 0, 'delete': 0, 'failed': 0}
+    assert not sent(es)
+
+    # sidecar edit, new file, modified file, and deleted file
+    util.write_metadata(source / 'a' / '0.jpg', {'title': 'foo'})
+    (source / 'b' / 'new.txt').write_bytes(b'foo')
+    os.utime(source / 'c' / 'sub' / '0.mp4', ns=(0, 1))
+    (source / 'a' / 'sub' / '1.mp4').unlink()
+    es.fail.add(index.doc_id('b/new.txt'))
+    counts = await indexer.update(source, state_path, chunk_size=4)
+    assert counts == {'index': 2, 'delete': 1, 'failed': 1}
+    assert sent(es) == {('index', 'a/0.jpg'), ('index', 'b/new.txt'), ('index', 'c/sub/0.mp4'),
+                        ('delete', index.doc_id('a/sub/1.mp4'))}
+
+    # failed docs are retried
+    es.fail.clear()
+    counts = await indexer.update(source, state_path, chunk_size=4)
+    assert counts == {'index': 1, 'delete': 0, 'failed': 0}
+    assert sent(es) == {('index', 'b/new.txt')}
+
+    # album thumbnail made outside the server
+    (source / 'b' / 'thumbnails').mkdir()
+    (source / 'b' / 'thumbnails' / 'thumb.jpg').write_bytes(b'foo')
+    counts = await indexer.update(source, state_path, chunk_size=4)
+    assert counts == {'index': 1, 'delete': 0, 'failed': 0}
+    assert sent(es) == {('index', 'b')}
+
+
+async def test_add_one(source, es, redis):
+    (source / 'album' / 'thumbnails').mkdir(parents=True)
+    Image.new('RGB', (20, 10)).save(source / 'album' / 'a.jpg')
+    (source / 'album' / 'thumbnails' / 'a.jpg').write_bytes(b'thumb')
+    util.write_metadata(source / 'album' / 'a.jpg', {'title': 'foo', 'thumbnail': 'thumbnails/a.jpg'})
+    (source / 'album' / 'b.mp4').write_bytes(b'foo')
+    version_cache = versions.VersionCache()
+    indexer = index.Indexer(es, 'gallery', version_cache=version_cache)
+    try:
+        await indexer.add_one(source / 'album' / 'a.jpg')
+        await indexer.add_one(source / 'album' / 'b.mp4')
+        await indexer.add_one(source / 'album')
+    finally:
+        version_cache.close()
+    image, video, album = [actions[0][2] for actions in es.requests]
+
+    assert image['type'] == 'Image'
+    assert image['thumbnail'] == '/_src/album/thumbnails/a.jpg'
+    assert image['mime'] == 'image/jpeg'
+    assert (image['width'], image['height']) == (20, 10)
+    assert image['src_version'] == versions.hash_file(source / 'album' / 'a.jpg', 'full')
+    assert image['thumbnail_version'] == versions.hash_file(source / 'album' / 'thumbnails' / 'a.jpg', 'full')
+
+    assert video['mime'] == 'video/mp4'
+    assert 'width' not in video and 'src_version' in video
+    assert album['type'] == 'Album'
+    assert 'mime' not in album and 'src_version' not in album
+
+
+async def test_image_sizes(source, es, redis, monkeypatch):
+    (source / 'album').mkdir()
+    Image.new('RGB', (20, 10)).save(source / 'album' / 'a.jpg')
+    indexer = index.Indexer(es, 'gallery', image_sizes=dimensions.ImageSizeCache())
+    await indexer.stream(source)
+    assert dimensions.ImageSizeCache.key('album/a.jpg') in redis.cache
+    es.requests.clear()
+
+    # a fresh process gets sizes from redis instead of opening images
+    def read_image_size(path):
+        raise AssertionError('image opened')
+    monkeypatch.setattr(index, 'read_image_size', read_image_size)
+    indexer = index.Indexer(es, 'gallery', image_sizes=dimensions.ImageSizeCache())
+    await indexer.add_one(source / 'album' / 'a.jpg')
+    doc = es.requests[0][0][2]
+    assert (doc['width'], doc['height']) == (20, 10)
+
+
+def test_state(tmp_path):
+    path = tmp_path / 'state.json'
+    assert index.load_state(path, 'gallery') == {}
+    index.save_state(path, 'gallery', {'a': [1, 2, 3]})
+    assert index.load_state(path, 'gallery') == {'a': [1, 2, 3]}
+    assert index.load_state(path, 'other') == {}
+    assert os.listdir(tmp_path) == ['state.json']
+
+
+@pytest.fixture
+def indices(monkeypatch):
+    calls = []
+
+    class Indices:
+        def __init__(self, client):
+            pass
+
+        def __getattr__(self, name):
+            async def call(**kwargs):
+                calls.append((name, kwargs))
+                return {'gallery-old': {}} if name == 'get' else True
+            return call
+
+    monkeypatch.setattr(index, 'IndicesClient', Indices)
+    yield calls
+
+
+async def test_swap_index(indices):
+    es = MagicMock()
+    es.count = AsyncMock(return_value={'count': 5})
+    indexer = index.Indexer(es, 'gallery')
+
+    async with indexer.swap_index(force_merge=True) as stats:
+        assert indexer.index_name.startswith('gallery-')
+    assert indexer.index_name == 'gallery'
+    assert stats['count'] == 5
+    assert 'load_seconds' in stats and 'swap_seconds' in stats
+
+    names = [name for name, _ in indices]
+    assert names[0] == 'create'
+    assert indices[0][1]['body']['settings']['index']['refresh_interval'] == '-1'
+    assert names.index('put_settings') < names.index('refresh') < names.index('forcemerge') < names.index('put_alias')
+    settings = dict(indices)['put_settings']['settings']['index']
+    assert settings['number_of_replicas'] == index.ENV.ES_REPLICAS
+    assert ('delete', {'index': 'gallery-old'}) in indices
+
+
+async def test_swap_index_failed(indices):
+    indexer = index.Indexer(MagicMock(), 'gallery')
+    with pytest.raises(RuntimeError):
+        async with indexer.swap_index():
+            raise RuntimeError()
+    names = [name for name, _ in indices]
+    assert names == ['create', 'delete']
+    assert indexer.index_name == 'gallery'
+
+
+def test_cursor():
+    cursor = index.encode_cursor('pit==', [1.5, 'a/b.jpg'], 100)
+    assert index.decode_cursor(cursor) == ('pit==', [1.5, 'a/b.jpg'], 100)
+    for bad in ('', 'x', index.encode_cursor('pit', [], 0)[:-3]):
+        with pytest.raises(ValueError):
+            index.decode_cursor(bad)
+
+
+async def test_search_page():
+    hits = [{'_id': str(i), '_score': 1., 'sort': [1., str(i)], '_source': {}} for i in range(5)]
+
+    async def search(body, index=None):
+        start = int(body['search_after'][1]) + 1 if 'search_after' in body else 0
+        page = hits[start:start + body['size']]
+        ret = {'hits': {'total': {'value': 5, 'relation': 'eq'}, 'hits': page}}
+        if 'pit' in body:
+            ret['pit_id'] = body['pit']['id'] + '+'
+        return ret
+
+    es = MagicMock()
+    es.search = AsyncMock(side_effect=search)
+    es.open_point_in_time = AsyncMock(return_value={'id': 'pit'})
+    es.close_point_in_time = AsyncMock()
+    indexer = index.Indexer(es, 'gallery')
+
+    # the first page does not open a pit
+    ret, offset, cursor = await indexer.search_page('foo', limit=2)
+    assert es.search.await_args.kwargs['index'] == 'gallery'
+    assert 'pit' not in es.search.await_args.kwargs['body']
+    es.open_point_in_time.assert_not_awaited()
+
+    ids = [hit['_id'] for hit in ret['hits']['hits']]
+    offsets = [offset]
+    while cursor:
+        ret, offset, cursor = await indexer.search_page('foo', limit=2, cursor=cursor)
+        ids += [hit['_id'] for hit in ret['hits']['hits']]
+        offsets.append(offset)
+    assert ids == ['0', '1', '2', '3', '4']
+    assert offsets == [0, 2, 4]
+    es.open_point_in_time.assert_awaited_once()
+    # the latest pit id is passed on, and closed after the last page
+    assert es.search.await_args.kwargs['body']['pit']['id'] == 'pit+'
+    es.close_point_in_time.assert_awaited_once_with(id='pit++')
+
+    # a single page needs no pit
+    es.open_point_in_time.reset_mock()
+    es.close_point_in_time.reset_mock()
+    ret, _, cursor = await indexer.search_page('foo', limit=10)
+    assert len(ret['hits']['hits']) == 5 and not cursor
+    es.open_point_in_time.assert_not_awaited()
+    es.close_point_in_time.assert_not_awaited()
+
+
+async def test_add_one_invalidates(source, es, redis, monkeypatch):
+    refresh = AsyncMock()
+    monkeypatch.setattr(type(es.indices), 'refresh', refresh)
+    (source / 'a.txt').write_bytes(b'foo')
+    (source / 'b.txt').write_bytes(b'foo')
+    search_cache = caching.SearchCache()
+    generation = await search_cache.generation()
+    indexer = index.Indexer(es, 'gallery', search_cache=search_cache)
+    await indexer.add_one(source / 'a.txt')
+    assert es.requests[0][0][0] == 'index'
+    generation2 = await search_cache.generation()
+    assert generation2 != generation
+
+    # the refresh runs in the background, and writes during it are refreshed again
+    await indexer.add_one(source / 'b.txt')
+    await indexer._refresh_task
+    assert refresh.await_count == 2
+    assert await search_cache.generation() != generation2
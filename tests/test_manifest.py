@@ -0,0 +1,115 @@
+import os
+
+from PIL import Image
+
+from gallery import albums, manifest, util
+from gallery.versions import VersionCache
+
+
+def make_album(path):
+    path.mkdir()
+    Image.new('RGB', (20, 10)).save(path / 'a.jpg')
+    Image.new('RGB', (20, 10)).save(path / 'b.jpg')
+    (path / 'c.mp4').write_bytes(b'foo')
+    (path / 'sub').mkdir()
+    (path / 'thumbnails').mkdir()
+    (path / 'thumbnails' / 'a.jpg').write_bytes(b'foo')
+    util.write_metadata(path / 'b.jpg', {'title': 'bar'})
+    util.write_metadata(path, {'title': 'album', 'sort': 'filename'})
+
+
+async def test_manifest(source, redis):
+    path = source / 'album'
+    make_album(path)
+    assert albums.read_manifest(path) is None
+
+    version_cache = VersionCache()
+    stamp = albums.album_stamp(path)
+    assert await manifest.build_manifest(path, version_cache)
+    assert albums.read_manifest(path) is not None
+    # writing the manifest does not change the album stamp, so pages cached against it stay valid
+    assert albums.album_stamp(path) == stamp
+    assert albums.read_manifest(path, stamp) is not None
+
+    scanned = await albums.load_album(path, manifest=False)
+    album = await albums.load_album(path)
+    assert album.from_manifest
+    assert not scanned.from_manifest
+    assert album.meta == scanned.meta
+    assert album.thumbnail == scanned.thumbnail
+    assert album.src_urls() == scanned.src_urls()
+    assert [i.meta for i in album.images] == [i.meta for i in scanned.images]
+    assert [(i.width, i.height) for i in album.images] == [(20, 10), (20, 10)]
+    assert [v.mime for v in album.videos] == ['video/mp4']
+    assert set(album.versions) == set(album.src_urls()) - {'/_src/album/sub'}
+
+    # the manifest is not a child
+    assert albums.MANIFEST_NAME not in albums.DirListing(path).children
+
+    # adding a file makes the manifest stale
+    (path / 'd.txt').write_bytes(b'foo')
+    assert albums.read_manifest(path) is None
+    assert not (await albums.load_album(path)).from_manifest
+
+
+async def test_manifest_in_place_edits(source, redis):
+    path = source / 'album'
+    make_album(path)
+    assert await manifest.build_manifest(path)
+    assert (await albums.load_album(path)).from_manifest
+
+    # album metadata edited in place
+    util.write_metadata(path, {'title': 'other', 'sort': 'filename'})
+    album = await albums.load_album(path)
+    assert not album.from_manifest
+    assert album.meta['title'] == 'other'
+
+    # updating another child does not bless an image overwritten in place
+    assert await manifest.build_manifest(path)
+    Image.new('RGB', (40, 30)).save(path / 'a.jpg')
+    assert await manifest.update_manifest(path, ['c.mp4'])
+    album = await albums.load_album(path)
+    assert album.from_manifest
+    assert (album.images[0].width, album.images[0].height) == (40, 30)
+
+    # nor a sidecar written in place
+    util.write_metadata(path / 'b.jpg', {'title': 'baz'})
+    assert await manifest.update_manifest(path, ['c.mp4'])
+    album = await albums.load_album(path)
+    assert album.from_manifest
+    assert album.images[1].meta['title'] == 'baz'
+
+    # a manifest changed under the album is stale
+    os.utime(path / albums.MANIFEST_NAME, ns=(0, 0))
+    assert albums.read_manifest(path) is None
+
+
+async def test_update_manifest(source, redis):
+    path = source / 'album'
+    make_album(path)
+    assert not await manifest.update_manifest(path, ['a.jpg'])
+
+    assert await manifest.build_manifest(path)
+    meta = util.read_metadata(path / 'a.jpg')
+    meta['title'] = 'foo'
+    util.write_metadata(path / 'a.jpg', meta)
+    (path / 'd.txt').write_bytes(b'foo')
+    assert await manifest.update_manifest(path, ['a.jpg', 'd.txt'])
+
+    album = await albums.load_album(path)
+    assert album.from_manifest
+    assert album.images[0].meta['title'] == 'foo'
+    assert [f.name for f in album.files] == ['d.txt']
+
+    (path / 'd.txt').unlink()
+    assert await manifest.update_manifest(path, ['d.txt'])
+    album = await albums.load_album(path)
+    assert album.from_manifest
+    assert not album.files
+
+    # an unexpected change rebuilds the manifest
+    (path / 'e.txt').write_bytes(b'foo')
+    assert await manifest.update_manifest(path, ['a.jpg'])
+    album = await albums.load_album(path)
+    assert album.from_manifest
+    assert [f.name for f in album.files] == ['e.txt']
@@ -0,0 +1,281 @@
+import asyncio
+import dataclasses
+import gzip
+import hashlib
+import json
+import os
+from pathlib import Path
+from unittest.mock import AsyncMock, MagicMock
+
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+import tornado.web
+import pytest
+
+from gallery import albums, caching, config, dimensions, manifest, server, uploads, util, versions
+
+
+@pytest.fixture
+async def app(source, redis):
+    """Serve the gallery handlers on a local port, yielding a `fetch(path, **kwargs)` for it."""
+    version_cache = versions.VersionCache()
+    args = {
+        'debug': True,
+        'indexer': AsyncMock(),
+        'auth': None,
+        'version_cache': version_cache,
+        'thumbnails': MagicMock(),
+        'image_sizes': dimensions.ImageSizeCache(),
+    }
+    application = tornado.web.Application([
+        ('/edit/_upload', server.UploadHandler, args),
+        ('/edit/_upload/session', server.UploadSessionsHandler, args),
+        (r'/edit/_upload/session/(?P<session_id>[0-9a-f]{32})(?:/(?P<chunk>[0-9]+))?', server.UploadSessionHandler, args),
+        (r'/(?P<path>.*)', server.AlbumHandler, args),
+    ], template_path=str(Path(__file__).parent.parent / config.ENV.THEME / 'templates'))
+    sock, port = bind_unused_port()
+    http_server = HTTPServer(application)
+    http_server.add_sockets([sock])
+    client = AsyncHTTPClient()
+
+    async def fetch(path, **kwargs):
+        kwargs.setdefault('raise_error', False)
+        kwargs.setdefault('follow_redirects', False)
+        return await client.fetch(f'http://127.0.0.1:{port}{path}', **kwargs)
+    fetch.args = args
+
+    try:
+        yield fetch
+    finally:
+        http_server.stop()
+        await http_server.close_all_connections()
+        await asyncio.gather(*manifest._building.values(), return_exceptions=True)
+        version_cache.close()
+
+
+def make_album(source):
+    (source / 'a').mkdir()
+    util.write_metadata(source / 'a', {'title': 'a'})
+    (source / 'a' / 'x.txt').write_bytes(b'foo')
+
+
+def gate_renders(monkeypatch):
+    """Make album renders wait for the returned event, counting them in `event.renders`."""
+    event = asyncio.Event()
+    event.renders = 0
+    render = server.AlbumHandler._render
+
+    async def gated(self, *args, **kwargs):
+        event.renders += 1
+        await event.wait()
+        return await render(self, *args, **kwargs)
+    monkeypatch.setattr(server.AlbumHandler, '_render', gated)
+    return event
+
+
+def touch(path):
+    """Change the mtime of a dir, as on a slow filesystem it may not change on its own."""
+    st = path.stat()
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+
+async def test_album_not_modified(source, app):
+    make_album(source)
+    ret = await app('/a')
+    assert ret.code == 200
+    etag = ret.headers['Etag']
+    modified = ret.headers['Last-Modified']
+    assert b'id="x.txt"' in ret.body
+
+    # answered from the cached validators
+    ret = await app('/a', headers={'If-None-Match': etag})
+    assert ret.code == 304
+    assert not ret.body
+    ret = await app('/a', headers={'If-Modified-Since': modified})
+    assert ret.code == 304
+    ret = await app('/a', headers={'If-None-Match': '"other"'})
+    assert ret.code == 200
+    assert ret.body
+
+    # a changed album is rendered again
+    (source / 'a' / 'y.txt').write_bytes(b'bar')
+    touch(source / 'a')
+    ret = await app('/a', headers={'If-None-Match': etag})
+    assert ret.code == 200
+    assert b'id="y.txt"' in ret.body
+    assert ret.headers['Etag'] != etag
+
+
+async def test_album_gzip(source, app):
+    make_album(source)
+    plain = await app('/a', headers={'Accept-Encoding': 'identity'}, decompress_response=False)
+    assert plain.code == 200
+    assert 'Content-Encoding' not in plain.headers
+    assert plain.headers['Vary'] == 'Accept-Encoding'
+
+    ret = await app('/a', headers={'Accept-Encoding': 'deflate, gzip;q=0.5'}, decompress_response=False)
+    assert ret.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(ret.body) == plain.body
+    # the encodings have their own etags
+    assert ret.headers['Etag'] != plain.headers['Etag']
+    ret2 = await app('/a', headers={'Accept-Encoding': 'gzip', 'If-None-Match': ret.headers['Etag']}, decompress_response=False)
+    assert ret2.code == 304
+    ret2 = await app('/a', headers={'Accept-Encoding': 'gzip;q=0', 'If-None-Match': ret.headers['Etag']}, decompress_response=False)
+    assert ret2.code == 200
+
+    # refused with q=0
+    ret = await app('/a', headers={'Accept-Encoding': 'gzip;q=0, identity'}, decompress_response=False)
+    assert 'Content-Encoding' not in ret.headers
+    assert ret.body == plain.body
+
+
+async def test_album_shared_render(source, app, monkeypatch):
+    make_album(source)
+    event = gate_renders(monkeypatch)
+    requests = [asyncio.create_task(app('/a')) for _ in range(3)]
+    await asyncio.sleep(0.2)
+    event.set()
+    ret = await asyncio.gather(*requests)
+    assert [r.code for r in ret] == [200] * 3
+    assert len({r.body for r in ret}) == 1
+    assert event.renders == 1
+
+
+async def test_album_stale(source, app, monkeypatch):
+    monkeypatch.setattr(caching, 'ENV', dataclasses.replace(caching.ENV, PAGE_STALE_TTL=60))
+    make_album(source)
+    ret = await app('/a')
+    assert ret.code == 200
+    (source / 'a' / 'y.txt').write_bytes(b'bar')
+    touch(source / 'a')
+    await caching.PageCache().delete(albums.album_key(source / 'a'))
+
+    # the old page is sent while the new one is still rendering
+    event = gate_renders(monkeypatch)
+    ret = await asyncio.wait_for(app('/a'), 5)
+    assert ret.code == 200
+    assert b'id="x.txt"' in ret.body and b'id="y.txt"' not in ret.body
+    assert event.renders == 1
+
+    # then the page is revalidated
+    event.set()
+    await asyncio.gather(*caching.PageCache._renders.values())
+    ret = await app('/a')
+    assert ret.code == 200
+    assert b'id="y.txt"' in ret.body
+    assert event.renders == 1
+
+
+async def test_album_page_not_found(source, redis, app, monkeypatch):
+    monkeypatch.setattr(server, 'ENV', dataclasses.replace(server.ENV, ALBUM_PAGE_SIZE=2))
+    make_album(source)
+    for i in range(3):
+        (source / 'a' / f'{i}.txt').write_bytes(b'foo')
+
+    ret = await app('/a?page=2')
+    assert ret.code == 200
+    assert b'id="2.txt"' in ret.body
+    ret = await app('/a?page=3')
+    assert ret.code == 404
+    # bad page numbers are not cached
+    fields = redis.cache[caching.PageCache.key('a')]
+    assert any(f.startswith('2.') for f in fields)
+    assert not any(f.startswith('3.') for f in fields)
+
+
+BOUNDARY = b'xyzzy'
+
+
+def make_multipart(parts):
+    body = b''
+    for headers, data in parts:
+        body += b'--' + BOUNDARY + b'\r\n' + headers + b'\r\n\r\n' + data + b'\r\n'
+    return body + b'--' + BOUNDARY + b'--\r\n'
+
+
+async def test_upload(source, app):
+    make_album(source)
+    ret = await app('/a')
+    assert b'id="a-b.mp4"' not in ret.body
+
+    data = os.urandom(300000)
+    body = make_multipart([
+        (b'Content-Disposition: form-data; name="album"', b'/edit/a'),
+        (b'Content-Disposition: form-data; name="files"; filename="a b.mp4"\r\nContent-Type: video/mp4', data),
+    ])
+    headers = {'Content-Type': 'multipart/form-data; boundary=' + BOUNDARY.decode()}
+    ret = await app('/edit/_upload', method='POST', headers=headers, body=body)
+    assert ret.code == 302
+    assert ret.headers['Location'] == '/edit/a'
+    assert (source / 'a' / 'a-b.mp4').read_bytes() == data
+    assert util.read_metadata(source / 'a' / 'a-b.mp4')['title'] == 'a b.mp4'
+    assert not [name for name in os.listdir(source / 'a') if name.startswith('.upload-')]
+    app.args['indexer'].add_one.assert_awaited()
+    assert app.args['thumbnails'].put.call_args.args[0].path == source / 'a' / 'a-b.mp4'
+
+    # the album page is rendered again
+    ret = await app('/a')
+    assert b'id="a-b.mp4"' in ret.body
+
+    # a truncated body is rejected, and the partial upload removed
+    ret = await app('/edit/_upload', method='POST', headers=headers, body=body[:-200])
+    assert ret.code == 400
+    assert not [name for name in os.listdir(source / 'a') if name.startswith('.upload-')]
+    assert (source / 'a' / 'a-b.mp4').read_bytes() == data
+
+
+async def test_upload_session(source, app):
+    make_album(source)
+    data = os.urandom(2500)
+    args = {'album': '/edit/a', 'filename': 'v.mp4', 'size': len(data), 'chunk_size': 1024}
+    ret = await app('/edit/_upload/session', method='POST', body=json.dumps(args))
+    assert ret.code == 201
+    status = json.loads(ret.body)
+    assert (status['chunks'], status['missing']) == (3, [0, 1, 2])
+    url = '/edit/_upload/session/' + status['id']
+
+    for i in (2, 0, 1):
+        chunk = data[i*1024:(i+1)*1024]
+        ret = await app(f'{url}/{i}', method='PUT', body=chunk, headers={'X-Chunk-SHA256': hashlib.sha256(chunk).hexdigest()})
+        assert ret.code == 200
+        assert json.loads(ret.body)['chunk'] == i
+        if i == 2:
+            ret = await app(url)
+            assert json.loads(ret.body)['received'] == [[2048, 2500]]
+    ret = await app(f'{url}/1', method='PUT', body=b'x' * 1024, headers={'X-Chunk-SHA256': '00'})
+    assert ret.code == 400
+
+    ret = await app(url, method='POST', body=b'')
+    assert ret.code == 200
+    assert json.loads(ret.body) == {'name': 'v.mp4', 'url': '/a/v.mp4'}
+    assert (source / 'a' / 'v.mp4').read_bytes() == data
+    assert not os.listdir(uploads.staging_dir())
+    # finalizing again does not add the file twice
+    ret = await app(url, method='POST', body=b'')
+    assert ret.code == 404
+
+
+async def test_upload_session_limits(source, app, monkeypatch):
+    monkeypatch.setattr(uploads, 'ENV', dataclasses.replace(uploads.ENV, UPLOAD_MAX_SIZE=4096))
+    make_album(source)
+    args = {'album': '/edit/a', 'filename': 'v.mp4', 'size': 4097}
+    ret = await app('/edit/_upload/session', method='POST', body=json.dumps(args))
+    assert ret.code == 413
+    args['album'] = '/edit/missing'
+    ret = await app('/edit/_upload/session', method='POST', body=json.dumps(args))
+    assert ret.code == 400
+
+    # aborted sessions are removed
+    args = {'album': '/edit/a', 'filename': 'v.mp4', 'size': 10}
+    ret = await app('/edit/_upload/session', method='POST', body=json.dumps(args))
+    url = '/edit/_upload/session/' + json.loads(ret.body)['id']
+    ret = await app(f'{url}/0', method='PUT', body=b'0123')
+    assert ret.code == 400
+    ret = await app(url, method='POST', body=b'')
+    assert ret.code == 409
+    ret = await app(url, method='DELETE')
+    assert ret.code == 204
+    assert not os.listdir(uploads.staging_dir())
+    ret = await app(url)
+    assert ret.code == 404
@@ -0,0 +1,139 @@
+import dataclasses
+import os
+import shutil
+
+from PIL import ExifTags, Image
+
+from gallery import albums, manifest, thumbnails, util
+
+
+async def fake_convert(*args):
+    if args[0] != args[-1]:
+        shutil.copyfile(args[0], args[-1])
+
+
+async def test_thumbnail_queue(source, redis, monkeypatch):
+    monkeypatch.setattr(thumbnails, 'run_convert', fake_convert)
+    path = source / 'album'
+    path.mkdir()
+    Image.new('RGB', (20, 10)).save(path / 'a.jpg')
+    util.write_metadata(path / 'a.jpg', {'title': 'foo'})
+    assert await manifest.build_manifest(path)
+    redis.cache['page:album'] = {'1': b'"cached"'}
+
+    queue = thumbnails.ThumbnailQueue(workers=2)
+    queue.start()
+    try:
+        queue.put(thumbnails.ThumbnailJob(path / 'a.jpg', orient=True))
+        queue.put(thumbnails.ThumbnailJob(path))
+        await queue.join()
+    finally:
+        await queue.stop()
+
+    assert (path / 'thumbnails' / 'a.jpg').exists()
+    meta = util.read_metadata(path / 'a.jpg')
+    assert meta['title'] == 'foo'
+    assert meta['thumbnail'] == 'thumbnails/a.jpg'
+    assert meta['image_size']['width'] == 20
+    assert util.read_metadata(path)['thumbnail'] == 'thumbnails/thumb.jpg'
+
+    # page cache invalidated, and manifest still valid
+    assert 'page:album' not in redis.cache
+    listing = manifest.read_manifest(path)
+    assert listing
+    assert listing.entry('a.jpg')['thumbnail'] == '/_src/album/thumbnails/a.jpg'
+
+
+async def test_thumbnail_upload(source, redis, monkeypatch):
+    monkeypatch.setattr(thumbnails, 'run_convert', fake_convert)
+    path = source / 'album'
+    path.mkdir()
+    (path / 'a.mp4').write_bytes(b'foo')
+    (path / 'thumbnails').mkdir()
+    (path / 'thumbnails' / 'old.jpg').write_bytes(b'old')
+
+    queue = thumbnails.ThumbnailQueue()
+    ret = await queue.run(thumbnails.ThumbnailJob(path / 'a.mp4', upload=b'bar', upload_suffix='.png', prev_thumb='thumbnails/old.jpg'))
+    assert ret == 'thumbnails/a.png'
+    assert (path / 'thumbnails' / 'a.png').read_bytes() == b'bar'
+    assert not (path / 'thumbnails' / 'old.jpg').exists()
+    assert util.read_metadata(path / 'a.mp4')['thumbnail'] == 'thumbnails/a.png'
+
+
+def test_make_thumbnail(tmp_path):
+    Image.new('RGB', (600, 300)).save(tmp_path / 'a.jpg')
+    thumbnails.make_thumbnail(tmp_path / 'a.jpg', tmp_path / 'b.jpg')
+    with Image.open(tmp_path / 'b.jpg') as img:
+        assert img.size == (150, 75)
+
+    Image.new('RGBA', (300, 600)).save(tmp_path / 'a.png')
+    thumbnails.make_thumbnail(tmp_path / 'a.png', tmp_path / 'c.jpg')
+    with Image.open(tmp_path / 'c.jpg') as img:
+        assert img.size == (75, 150)
+        assert img.mode == 'RGB'
+
+
+def test_orient_image(tmp_path):
+    path = tmp_path / 'a.jpg'
+    Image.new('RGB', (60, 30)).save(path)
+    assert not thumbnails.orient_image(path)
+
+    exif = Image.Exif()
+    exif[ExifTags.Base.Orientation] = 6
+    Image.new('RGB', (60, 30)).save(path, exif=exif)
+    assert thumbnails.orient_image(path)
+    with Image.open(path) as img:
+        assert img.size == (30, 60)
+        assert img.getexif().get(ExifTags.Base.Orientation, 1) == 1
+    assert not thumbnails.orient_image(path)
+
+
+def test_save_hidden_temp_file(tmp_path, monkeypatch):
+    replaced = []
+    replace = os.replace
+    monkeypatch.setattr(os, 'replace', lambda src, dest: (replaced.append(os.path.basename(src)), replace(src, dest)))
+    thumbnails._save(Image.new('RGB', (10, 10)), tmp_path / 'a.jpg')
+    assert replaced[0].startswith(albums.HIDDEN_PREFIXES)
+    assert os.listdir(tmp_path) == ['a.jpg']
+
+
+def test_make_derivative(tmp_path):
+    Image.new('RGB', (600, 300)).save(tmp_path / 'a.jpg')
+    dest = tmp_path / 'd' / 'a.jpg.webp'
+    thumbnails.make_derivative(tmp_path / 'a.jpg', dest, 320)
+    with Image.open(dest) as img:
+        assert img.size == (320, 160)
+        assert img.format == 'WEBP'
+    assert dest.stat().st_mtime_ns == (tmp_path / 'a.jpg').stat().st_mtime_ns
+
+    exif = Image.Exif()
+    exif[ExifTags.Base.Orientation] = 6
+    Image.new('RGB', (600, 300)).save(tmp_path / 'b.jpg', exif=exif)
+    thumbnails.make_derivative(tmp_path / 'b.jpg', dest, 150)
+    with Image.open(dest) as img:
+        assert img.size == (150, 300)
+
+
+async def test_derivative(source, redis, monkeypatch):
+    env = dataclasses.replace(thumbnails.ENV, DERIVATIVES=source.parent / 'derivatives')
+    monkeypatch.setattr(thumbnails, 'ENV', env)
+    path = source / 'album' / 'a.jpg'
+    path.parent.mkdir()
+    Image.new('RGB', (600, 300)).save(path)
+
+    queue = thumbnails.ThumbnailQueue(workers=1)
+    try:
+        dest = await queue.derivative(path, 320)
+        assert dest == env.DERIVATIVES / '320' / 'album' / 'a.jpg.webp'
+        with Image.open(dest) as img:
+            assert img.size == (320, 160)
+
+        # a fresh derivative is reused, and a changed image remade
+        assert await queue.derivative(path, 320) == dest
+        Image.new('RGB', (400, 800)).save(path)
+        os.utime(path, ns=(0, 1))
+        await queue.derivative(path, 320)
+        with Image.open(dest) as img:
+            assert img.size == (320, 640)
+    finally:
+        await queue.stop()
@@ -0,0 +1,157 @@
+import dataclasses
+import hashlib
+import os
+
+import pytest
+
+from gallery import uploads, versions
+
+
+BOUNDARY = b'xyzzy'
+
+
+def make_body(parts):
+    body = b'preamble\r\n'
+    for headers, data in parts:
+        body += b'--' + BOUNDARY + b'\r\n' + headers + b'\r\n\r\n' + data + b'\r\n'
+    return body + b'--' + BOUNDARY + b'--\r\nepilogue'
+
+
+def parse(body, chunk_size):
+    parser = uploads.MultipartParser(BOUNDARY)
+    parts = []
+    for i in range(0, len(body), chunk_size):
+        for event, value in parser.feed(body[i:i+chunk_size]):
+            if event == 'part':
+                parts.append([uploads.parse_disposition(value['Content-Disposition']), b''])
+            elif event == 'data':
+                parts[-1][1] += value
+    parser.close()
+    return parts
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 7, 64, 1 << 20])
+def test_multipart_parser(chunk_size):
+    data = os.urandom(1000) + b'\r\n--xyzz' + b'\r\n-' + os.urandom(100)
+    body = make_body([
+        (b'Content-Disposition: form-data; name="album"', b'/edit/foo'),
+        (b'Content-Disposition: form-data; name="file"; filename="a b.jpg"\r\nContent-Type: image/jpeg', data),
+        (b'Content-Disposition: form-data; name="empty"', b''),
+    ])
+    assert parse(body, chunk_size) == [
+        [('album', None), b'/edit/foo'],
+        [('file', 'a b.jpg'), data],
+        [('empty', None), b''],
+    ]
+
+
+def test_multipart_parser_truncated():
+    body = make_body([(b'Content-Disposition: form-data; name="file"; filename="a.jpg"', b'foo')])
+    parser = uploads.MultipartParser(BOUNDARY)
+    parser.feed(body[:-20])
+    with pytest.raises(uploads.MultipartError):
+        parser.close()
+
+    with pytest.raises(uploads.MultipartError):
+        uploads.MultipartParser(BOUNDARY).feed(b'--xyzzy junk\r\n')
+
+
+def test_get_boundary():
+    assert uploads.get_boundary('multipart/form-data; boundary=foo') == b'foo'
+    assert uploads.get_boundary('multipart/form-data; charset=utf-8; boundary="foo bar"') == b'foo bar'
+    with pytest.raises(uploads.MultipartError):
+        uploads.get_boundary('multipart/form-data')
+
+
+def test_upload_file(tmp_path):
+    upload = uploads.UploadFile(tmp_path, 'a.jpg')
+    assert upload.tmp_path.name.startswith('.upload-')
+    upload.write(b'foo')
+    upload.write(b'bar')
+    upload.close()
+    assert upload.size == 6
+
+    upload.commit(tmp_path / 'a.jpg')
+    assert (tmp_path / 'a.jpg').read_bytes() == b'foobar'
+    assert upload.token == versions.hash_file(tmp_path / 'a.jpg', 'full')
+    upload.discard()
+    assert (tmp_path / 'a.jpg').exists()
+
+    upload = uploads.UploadFile(tmp_path, 'b.jpg')
+    upload.write(b'foo')
+    upload.discard()
+    assert os.listdir(tmp_path) == ['a.jpg']
+
+
+def test_upload_session(source):
+    (source / 'album').mkdir()
+    session = uploads.UploadSession.create('/edit/album', 'a b.mp4', 2500, chunk_size=1024)
+    assert session.path.parent == source / uploads.STAGING_NAME
+    assert session.num_chunks == 3
+    assert session.missing() == [0, 1, 2]
+
+    data = os.urandom(2500)
+    session.write_chunk(2, data[2048:])
+    with pytest.raises(ValueError):
+        session.write_chunk(0, data[:1000])
+    with pytest.raises(ValueError):
+        session.write_chunk(0, data[:1024], checksum='00')
+    with pytest.raises(ValueError):
+        session.write_chunk(3, b'')
+    session.write_chunk(0, data[:1024])
+    with pytest.raises(ValueError):
+        session.assemble(source / 'album')
+
+    session = uploads.UploadSession(session.id)
+    assert session.received() == [[0, 1024], [2048, 2500]]
+    assert session.missing() == [1]
+    # a chunk can be sent again
+    session.write_chunk(1, b'x' * 1024)
+    session.write_chunk(1, data[1024:2048], checksum=hashlib.sha256(data[1024:2048]).hexdigest())
+    assert len(session.chunks()) == 3
+    assert session.received() == [[0, 2500]]
+
+    upload = session.assemble(source / 'album')
+    assert upload.filename == 'a b.mp4'
+    upload.commit(source / 'album' / 'a.mp4')
+    assert (source / 'album' / 'a.mp4').read_bytes() == data
+    assert upload.token == versions.hash_file(source / 'album' / 'a.mp4', 'full')
+
+    session.remove()
+    with pytest.raises(FileNotFoundError):
+        uploads.UploadSession(session.id)
+
+
+def test_upload_session_corrupt_chunk(source):
+    session = uploads.UploadSession.create('/edit', 'a.mp4', 10, chunk_size=1024)
+    session.write_chunk(0, b'0123456789')
+    path, _ = session.chunks()[0]
+    path.write_bytes(b'9876543210')
+    with pytest.raises(ValueError):
+        session.assemble(source)
+    assert session.missing() == [0]
+    assert not [p for p in os.listdir(source) if p.startswith('.upload-') and p != uploads.STAGING_NAME]
+
+
+def test_upload_session_size(source, monkeypatch):
+    monkeypatch.setattr(uploads, 'ENV', dataclasses.replace(uploads.ENV, UPLOAD_MAX_SIZE=4096))
+    with pytest.raises(uploads.UploadTooLarge):
+        uploads.UploadSession.create('/edit', 'a.mp4', 4097, chunk_size=1024)
+
+    # chunks that pass their checksum still have to add up to the declared size
+    session = uploads.UploadSession.create('/edit', 'a.mp4', 10, chunk_size=1024)
+    session.write_chunk(0, b'0123456789')
+    path, _ = session.chunks()[0]
+    path.rename(path.with_name(f'0.{hashlib.sha256(b"0123").hexdigest()}.chunk')).write_bytes(b'0123')
+    with pytest.raises(ValueError):
+        session.assemble(source)
+    assert not [p for p in os.listdir(source) if p.startswith('.upload-') and p != uploads.STAGING_NAME]
+
+
+def test_cleanup_sessions(source):
+    session = uploads.UploadSession.create('/edit', 'a.mp4', 10)
+    uploads.cleanup_sessions()
+    assert session.path.exists()
+    os.utime(session.path, (0, 0))
+    uploads.cleanup_sessions()
+    assert not session.path.exists()
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 import json
 from gallery import util
 
@@ -29,3 +30,48 @@ def test_write_metadata(tmp_path):
 
     for k in src:
         assert src[k] == ret[k]
+
+
+async def test_read_metadata_many(tmp_path):
+    paths = []
+    for i in range(10):
+        path = tmp_path / f'test{i}'
+        if i % 2:
+            util.write_metadata(path, {'title': f'foo{i}'})
+        paths.append(path)
+    album = tmp_path / 'album'
+    album.mkdir()
+    util.write_metadata(album, {'title': 'album'})
+    paths.append(album)
+
+    ret = await util.read_metadata_many(paths, concurrency=2)
+    assert set(ret) == set(paths)
+    for i in range(10):
+        assert ret[paths[i]]['title'] == (f'foo{i}' if i % 2 else '')
+    assert ret[album]['title'] == 'album'
+
+
+def test_update_metadata(tmp_path):
+    path = tmp_path / 'test'
+    util.write_metadata(path, {'title': 'foo', 'thumbnail': 'old'})
+
+    # concurrent updates of different keys all land
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda i: util.update_metadata(path, {f'key{i}': i}), range(50)))
+    ret = util.update_metadata(path, {'thumbnail': 'new'})
+    assert ret == util.read_metadata(path)
+    assert ret['title'] == 'foo'
+    assert ret['thumbnail'] == 'new'
+    assert all(ret[f'key{i}'] == i for i in range(50))
+
+
+def test_accepts_encoding():
+    assert util.accepts_encoding('gzip, deflate, br', 'gzip')
+    assert util.accepts_encoding('deflate, GZIP;q=0.5', 'gzip')
+    assert not util.accepts_encoding('', 'gzip')
+    assert not util.accepts_encoding('gzip;q=0', 'gzip')
+    assert not util.accepts_encoding('gzip; q=0.0, identity', 'gzip')
+    assert not util.accepts_encoding('x-gzip-ish', 'gzip')
+    assert util.accepts_encoding('*', 'gzip')
+    assert not util.accepts_encoding('*, gzip;q=0', 'gzip')
+    assert not util.accepts_encoding('*;q=0, identity', 'gzip')
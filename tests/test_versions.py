@@ -0,0 +1,137 @@
+import dataclasses
+from pathlib import Path
+
+import pytest
+
+from gallery import versions
+
+
+def test_hash_file(tmp_path):
+    path = tmp_path / 'test.jpg'
+    path.write_bytes(b'foo')
+    ret = versions.hash_file(path)
+    assert ret == versions.hash_file(path)
+
+    path.write_bytes(b'bar')
+    assert ret != versions.hash_file(path)
+
+
+async def test_version_cache(redis, tmp_path):
+    path = tmp_path / 'test.jpg'
+    path.write_bytes(b'foo')
+
+    cache = versions.VersionCache()
+    ret = cache.lookup(path)
+    assert ret == versions.hash_file(path)
+    assert cache.stats['misses'] == 1
+
+    assert cache.lookup(path) == ret
+    assert cache.stats['hits'] == 1
+
+    # wait for the background write to redis
+    for task in list(cache._tasks):
+        await task
+    assert len(redis.cache) == 1
+    assert redis.set.call_args.kwargs['ex'] == versions.ENV.VERSION_CACHE_TTL
+
+    cache2 = versions.VersionCache()
+    assert (await cache2.get_many([path])) == {path: ret}
+    assert cache2.stats['redis_hits'] == 1
+    assert cache2.lookup(path) == ret
+    assert cache2.stats['misses'] == 0
+
+
+async def test_version_cache_get_many(redis, tmp_path):
+    paths = []
+    for i in range(10):
+        path = tmp_path / f'{i}.jpg'
+        path.write_bytes(str(i).encode())
+        paths.append(path)
+
+    cache = versions.VersionCache()
+    ret = await cache.get_many(paths + [tmp_path / 'missing.jpg'])
+    assert ret == {path: versions.hash_file(path) for path in paths}
+    assert cache.stats['misses'] == 10
+    assert len(redis.cache) == 10
+
+    # misses are read and written in one round trip each
+    assert redis.mget.await_count == 1
+    assert redis.pipeline.call_count == 1
+    redis.get.assert_not_awaited()
+
+    ret2 = await cache.get_many(paths)
+    assert ret2 == ret
+    assert cache.stats['hits'] == 10
+    cache.close()
+
+    cache2 = versions.VersionCache()
+    assert (await cache2.get_many(paths)) == ret
+    assert cache2.stats['redis_hits'] == 10
+    assert redis.mget.await_count == 2
+    redis.get.assert_not_awaited()
+    cache2.close()
+
+
+async def test_version_cache_changed(redis, tmp_path):
+    path = tmp_path / 'test.jpg'
+    path.write_bytes(b'foo')
+
+    cache = versions.VersionCache()
+    ret = cache.lookup(path)
+
+    path.write_bytes(b'foobar')
+    assert cache.lookup(path) != ret
+    assert cache.stats['misses'] == 2
+
+
+def test_version_cache_lru(redis, tmp_path):
+    cache = versions.VersionCache(maxsize=2)
+    for i in range(3):
+        path = tmp_path / f'{i}.jpg'
+        path.write_bytes(str(i).encode())
+        cache.lookup(path)
+    assert len(cache.lru) == 2
+
+
+def test_hash_file_modes(tmp_path):
+    path = tmp_path / 'test.mp4'
+    data = bytearray(1024 * 1024)
+    path.write_bytes(data)
+    full = versions.hash_file(path, 'full')
+    fast = versions.hash_file(path, 'fast')
+    sampled = versions.hash_file(path, 'sampled')
+    assert len({full, fast, sampled}) == 3
+
+    # change the last byte
+    data[-1] = 1
+    path.write_bytes(data)
+    assert versions.hash_file(path, 'full') != full
+    assert versions.hash_file(path, 'fast') != fast
+    assert versions.hash_file(path, 'sampled') != sampled
+
+
+def test_hash_file_small(tmp_path):
+    path = tmp_path / 'test.mp4'
+    path.write_bytes(b'foo')
+    assert versions.hash_file(path, 'fast')
+    assert versions.hash_file(path, 'sampled')
+
+
+def test_hash_file_bad_mode(tmp_path):
+    path = tmp_path / 'test.mp4'
+    path.write_bytes(b'foo')
+    with pytest.raises(ValueError):
+        versions.hash_file(path, 'foo')
+
+
+def test_get_hash_mode():
+    assert versions.get_hash_mode(Path('a.jpg')) == versions.ENV.VERSION_HASH_IMAGE_MODE
+    assert versions.get_hash_mode(Path('a.mp4')) == versions.ENV.VERSION_HASH_VIDEO_MODE
+    assert versions.get_hash_mode(Path('a.txt')) == versions.ENV.VERSION_HASH_FILE_MODE
+
+
+def test_hash_mode_config():
+    for mode in ('full', 'fast', 'sampled'):
+        assert dataclasses.replace(versions.ENV, VERSION_HASH_FILE_MODE=mode).VERSION_HASH_FILE_MODE == mode
+    with pytest.raises(ValueError):
+        dataclasses.replace(versions.ENV, VERSION_HASH_VIDEO_MODE='slow')
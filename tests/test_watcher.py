@@ -0,0 +1,162 @@
+import asyncio
+import dataclasses
+from pathlib import Path
+
+import pytest
+
+from gallery import manifest, util, watcher
+
+
+@pytest.fixture
+def watch_source(monkeypatch, source):
+    def fn(mode='auto'):
+        env = dataclasses.replace(watcher.ENV, WATCH_MODE=mode, WATCH_DEBOUNCE=0.01)
+        monkeypatch.setattr(watcher, 'ENV', env)
+        return source
+    yield fn
+
+
+def test_affected_albums(watch_source):
+    root = watch_source()
+    assert watcher.affected_albums(root / 'a' / 'b' / 'img.jpg') == [root / 'a' / 'b', root / 'a', root]
+    assert watcher.affected_albums(root / 'a' / 'thumbnails' / 'img.jpg') == [root / 'a', root]
+    assert watcher.affected_albums(root / 'a' / 'index.meta.json') == [root / 'a', root]
+    assert watcher.affected_albums(root / 'img.jpg') == [root]
+    assert watcher.affected_albums(Path('/elsewhere/img.jpg')) == []
+
+
+def test_fs_type(tmp_path):
+    mounts = tmp_path / 'mounts'
+    mounts.write_text('/dev/sda1 / ext4 rw 0 0\n'
+                      'server:/export /mnt/my\\040albums nfs4 rw 0 0\n')
+    assert watcher.fs_type(Path('/srv/albums'), mounts) == 'ext4'
+    assert watcher.fs_type(Path('/mnt/my albums'), mounts) == 'nfs4'
+    assert watcher.fs_type(Path('/mnt/my albums/a'), mounts) == 'nfs4'
+    assert watcher.fs_type(Path('/mnt/my albums2'), mounts) == 'ext4'
+    assert watcher.fs_type(Path('/'), tmp_path / 'missing') is None
+
+
+def pages(redis):
+    return {key for key in redis.cache if key.startswith('page:')}
+
+
+async def test_watcher_inotify(watch_source, redis):
+    root = watch_source('inotify')
+    (root / 'a').mkdir()
+    cache = watcher.PageCache()
+    await cache.set('a', 'foo', None)
+    await cache.set('', 'foo', None)
+
+    w = watcher.Watcher(cache)
+    try:
+        await w.start()
+    except OSError:
+        pytest.skip('inotify not available')
+    try:
+        (root / 'a' / 'new').mkdir()
+        await asyncio.sleep(0.1)
+        assert not pages(redis)
+
+        # new dirs are watched too
+        await cache.set('a/new', 'foo', None)
+        (root / 'a' / 'new' / 'img.jpg').write_bytes(b'foo')
+        await asyncio.sleep(0.1)
+        assert not pages(redis)
+    finally:
+        await w.stop()
+
+
+def test_edited_children(watch_source):
+    root = watch_source()
+    assert watcher.edited_children(root / 'a' / 'img.jpg') == {root / 'a': ['img.jpg']}
+    assert watcher.edited_children(root / 'a' / 'img.meta.json') == {root / 'a': ['img']}
+    assert watcher.edited_children(root / 'a' / 'thumbnails' / 'img.jpg') == {root / 'a': ['img.jpg']}
+    assert watcher.edited_children(root / 'a' / 'index.meta.json') == {root / 'a': [], root: ['a']}
+    assert watcher.edited_children(root / 'index.meta.json') == {root: []}
+    assert watcher.edited_children(Path('/elsewhere/img.jpg')) == {}
+
+
+async def test_watcher_updates_manifests(watch_source, redis):
+    root = watch_source('inotify')
+    (root / 'a').mkdir()
+    (root / 'a' / 'img.txt').write_bytes(b'foo')
+    assert await manifest.build_manifest(root / 'a')
+
+    w = watcher.Watcher(watcher.PageCache())
+    try:
+        await w.start()
+    except OSError:
+        pytest.skip('inotify not available')
+    try:
+        # written in place, so only the watcher can tell
+        util.write_metadata(root / 'a' / 'img.txt', {'title': 'foo'})
+        await asyncio.sleep(0.2)
+        listing = manifest.read_manifest(root / 'a')
+        assert listing
+        assert listing.entry('img.txt')['meta']['title'] == 'foo'
+    finally:
+        await w.stop()
+
+
+async def test_watcher_poll(watch_source, redis):
+    root = watch_source('poll')
+    (root / 'a').mkdir()
+    cache = watcher.PageCache()
+
+    w = watcher.Watcher(cache)
+    await w.start()
+    try:
+        await cache.set('a', 'foo', None)
+        await cache.set('', 'foo', None)
+        await cache.set('b', 'foo', None)
+        (root / 'a' / 'img.jpg').write_bytes(b'foo')
+        await w.check()
+        await w.flush()
+        assert pages(redis) == {cache.key('b')}
+
+        # new sub-albums are scanned from then on
+        (root / 'a' / 'new').mkdir()
+        await w.check()
+        await w.flush()
+        await cache.set('a/new', 'foo', None)
+        await cache.set('b', 'foo', None)
+        (root / 'a' / 'new' / 'img.jpg').write_bytes(b'foo')
+        await w.check()
+        await w.flush()
+        assert pages(redis) == {cache.key('b')}
+    finally:
+        await w.stop()
+
+
+async def test_watcher_network_fs(watch_source, redis, monkeypatch):
+    watch_source('auto')
+    monkeypatch.setattr(watcher, 'fs_type', lambda path: 'nfs4')
+    w = watcher.Watcher(watcher.PageCache())
+    await w.start()
+    try:
+        assert not w.inotify
+        assert w._albums
+    finally:
+        await w.stop()
+
+
+async def test_watcher_leader(watch_source, redis):
+    watch_source('poll')
+    w1 = watcher.Watcher(watcher.PageCache())
+    w2 = watcher.Watcher(watcher.PageCache())
+    await w1.start()
+    await w2.start()
+    try:
+        assert w1.lock_token and w1._tasks
+        assert not w2.lock_token and not w2._tasks
+
+        await w1._elect()
+        assert w1.lock_token
+
+        # the other process takes over once the leader is gone
+        await w1.stop()
+        await w2._elect()
+        assert w2.lock_token and w2._tasks
+    finally:
+        await w1.stop()
+        await w2.stop()